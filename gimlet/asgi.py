@@ -0,0 +1,179 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import copy
+
+from webob import Request, Response
+
+from .backends.base import BaseBackend
+from .factories import session_factory_factory
+from .util import asbool
+from .writer import coalesce
+
+
+def make_request(scope):
+    """Make a :class:`webob.Request` for an ASGI HTTP ``scope``, with the
+    headers and connection details which sessions use."""
+    environ = {
+        'REQUEST_METHOD': scope.get('method', 'GET'),
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope.get('path', '/'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+    }
+    server = scope.get('server')
+    if server:
+        environ['SERVER_NAME'] = server[0]
+        if server[1] is not None:
+            environ['SERVER_PORT'] = str(server[1])
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        if name in environ:
+            sep = '; ' if name == 'HTTP_COOKIE' else ', '
+            value = environ[name] + sep + value
+        environ[name] = value
+    return Request(environ)
+
+
+class SessionSnapshot(BaseBackend):
+
+    """Stands in for an async backend during one request.
+
+    Sessions are loaded into it by :meth:`load`, so that they can be read
+    synchronously, and writes are recorded, to be sent to the async backend
+    by :meth:`flush`. Writes don't need the session to have been loaded.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.data = {}
+        self.loaded = set()
+        self.writes = {}
+        self.touches = set()
+
+    @property
+    def native_update(self):
+        return self.backend.native_update
+
+    async def load(self, keys):
+        for key in keys:
+            if key in self.loaded:
+                continue
+            try:
+                self.data[key] = await self.backend.get(key)
+            except KeyError:
+                pass
+            self.loaded.add(key)
+
+    def __getitem__(self, key):
+        if key not in self.loaded:
+            # Reading it as missing would let the session overwrite it.
+            raise RuntimeError('session %r was read before being loaded, '
+                               'see gimlet.asgi.load_session()' % key)
+        return copy.copy(self.data[key])
+
+    def __setitem__(self, key, value):
+        self.record(key, (copy.copy(value), None, None))
+
+    def update(self, key, changed, deleted):
+        self.record(key, (None, dict(changed), set(deleted)))
+
+    def touch(self, key):
+        self.touches.add(key)
+
+    def record(self, key, write):
+        if key in self.writes:
+            write = coalesce(self.writes[key], write)
+        self.writes[key] = write
+
+    async def flush(self):
+        writes, self.writes = self.writes, {}
+        touches, self.touches = self.touches, set()
+        for key, (value, changed, deleted) in writes.items():
+            if value is not None:
+                await self.backend.set(key, value)
+            else:
+                await self.backend.update(key, changed, deleted)
+        for key in touches.difference(writes):
+            await self.backend.touch(key)
+
+
+async def load_session(scope, scope_key='gimlet.session'):
+    """Load the backend data of the session in ``scope``, so that it can be
+    read. Does nothing if it's already loaded, or there's no backend."""
+    sess = scope[scope_key]
+    if isinstance(sess.backend, SessionSnapshot):
+        await sess.backend.load([channel.id for channel
+                                 in sess.channels.values()
+                                 if not channel.fresh])
+    return sess
+
+
+class AsyncSessionMiddleware(object):
+
+    """ASGI middleware which puts a session in ``scope[scope_key]``.
+
+    It accepts the same options as :class:`.middleware.SessionMiddleware`,
+    and uses the same cookies, so WSGI and ASGI services can share sessions
+    given the same secret and a backend storing the same data, e.g.
+    :class:`.backends.pyredis.RedisBackend` and
+    :class:`.backends.asyncredis.AsyncRedisBackend`. The backend must be a
+    subclass of :class:`.backends.asyncbase.AsyncBaseBackend`.
+
+    The app can't wait on the backend from synchronous session methods, so
+    before reading keys stored in the backend it must call
+    ``await load_session(scope)``. Writing doesn't need that, so requests
+    which only write, or never touch the session (static files, health
+    checks), don't read the backend at all. With ``preload`` set, sessions
+    named by the request cookies are instead loaded before the app is
+    called. Changes are written before the response headers are sent, and
+    those made after that once the app returns. The ``background_writes``
+    option isn't used.
+    """
+
+    def __init__(self, app, secret, scope_key='gimlet.session',
+                 preload=False, *args, **kwargs):
+        self.app = app
+        self.scope_key = scope_key
+        self.preload = asbool(preload)
+        self.session_factory = session_factory_factory(secret, *args, **kwargs)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        request = make_request(scope)
+        sess = self.session_factory(request)
+        sess.writer = None
+        snapshot = None
+        if sess.has_backend:
+            snapshot = sess.backend = SessionSnapshot(sess.backend)
+        scope[self.scope_key] = sess
+        if self.preload:
+            await load_session(scope, self.scope_key)
+
+        async def send_with_session(message):
+            if message['type'] == 'http.response.start':
+                response = Response()
+                sess.write_callback(request, response)
+                if snapshot is not None:
+                    await snapshot.flush()
+                headers = list(message.get('headers', []))
+                for name, value in response.headerlist:
+                    if name.lower() == 'set-cookie':
+                        headers.append((b'set-cookie',
+                                        value.encode('latin-1')))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        await self.app(scope, receive, send_with_session)
+        if snapshot is not None:
+            await snapshot.flush()
@@ -0,0 +1,39 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from .base import BaseBackend
+
+
+class AsyncBaseBackend(BaseBackend):
+
+    """Base class for backends whose I/O methods are coroutines, for use
+    with :class:`gimlet.asgi.AsyncSessionMiddleware`.
+
+    Sessions are read with :meth:`get` rather than ``[]``, which raises
+    KeyError if nothing is stored, and written with :meth:`set`. Async
+    backends require Python 3.
+    """
+
+    async def get(self, key):
+        raise NotImplementedError
+
+    async def set(self, key, value):
+        raise NotImplementedError
+
+    async def update(self, key, changed, deleted):
+        """Apply a partial update, as for :meth:`.base.BaseBackend.update`.
+        The default implementation reads the whole session, applies the
+        changes, and writes it back."""
+        try:
+            value = await self.get(key)
+        except KeyError:
+            value = {}
+        if not changed and not any((k in value) for k in deleted):
+            return
+        value.update(changed)
+        for k in deleted:
+            value.pop(k, None)
+        await self.set(key, value)
+
+    async def touch(self, key):
+        pass
@@ -0,0 +1,36 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import time
+
+from .asyncbase import AsyncBaseBackend
+
+
+class AsyncMemoryBackend(AsyncBaseBackend):
+
+    """Store sessions in a dict in this process, for development and
+    tests. Sessions are stored serialized, so they behave like they would
+    with a remote backend, and expire after :attr:`ttl` seconds if set.
+    """
+
+    def __init__(self, *args, **kw):
+        self.data = {}
+        AsyncBaseBackend.__init__(self, *args, **kw)
+
+    def expires_at(self):
+        if self.ttl:
+            return time.time() + self.ttl
+        return None
+
+    async def get(self, key):
+        raw, expires_at = self.data[key]
+        if expires_at is not None and expires_at < time.time():
+            del self.data[key]
+            raise KeyError('key %r not found' % key)
+        return self.deserialize(raw)
+
+    async def set(self, key, value):
+        self.data[key] = (self.serialize(value), self.expires_at())
+
+    async def touch(self, key):
+        if self.ttl and key in self.data:
+            self.data[key] = (self.data[key][0], self.expires_at())
@@ -0,0 +1,45 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from redis import asyncio as aioredis
+
+from .asyncbase import AsyncBaseBackend
+from .pyredis import make_connection_pool
+
+
+class AsyncRedisBackend(AsyncBaseBackend):
+
+    """Store each session as a single serialized value in Redis, using
+    :mod:`redis.asyncio`. It takes the same options as
+    :class:`.pyredis.RedisBackend`, and reads and writes the same data, so
+    sync and async services can share sessions.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None,
+                 unix_socket_path=None, max_connections=None,
+                 pool_timeout=20, socket_timeout=None,
+                 socket_connect_timeout=None, connection_pool=None,
+                 *args, **kw):
+        if connection_pool is None:
+            connection_pool = make_connection_pool(
+                aioredis, host=host, port=port, db=db, password=password,
+                unix_socket_path=unix_socket_path,
+                max_connections=max_connections, pool_timeout=pool_timeout,
+                socket_timeout=socket_timeout,
+                socket_connect_timeout=socket_connect_timeout)
+        self.client = aioredis.Redis(connection_pool=connection_pool)
+        AsyncBaseBackend.__init__(self, *args, **kw)
+
+    async def get(self, key):
+        raw = await self.client.get(self.prefixed_key(key))
+        if raw:
+            return self.deserialize(raw)
+        else:
+            raise KeyError('key %r not found' % key)
+
+    async def set(self, key, value):
+        raw = self.serialize(value)
+        await self.client.set(self.prefixed_key(key), raw, ex=self.ttl)
+
+    async def touch(self, key):
+        if self.ttl:
+            await self.client.expire(self.prefixed_key(key), self.ttl)
@@ -0,0 +1,91 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from datetime import datetime
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from .asyncbase import AsyncBaseBackend
+from .sql import SQLBackend
+
+
+class AsyncSQLBackend(AsyncBaseBackend, SQLBackend):
+
+    """Store sessions in a SQL table, using SQLAlchemy's asyncio extension.
+
+    It takes the same options as :class:`.sql.SQLBackend`, with an async
+    driver in ``url`` (e.g. ``postgresql+asyncpg://``) or an
+    :class:`~sqlalchemy.ext.asyncio.AsyncEngine` as ``engine``, and uses the
+    same table, so sync and async services can share sessions. The table
+    is created if necessary on first use.
+    """
+
+    # Writes don't go through the synchronous compare and set.
+    native_cas = False
+    native_version = False
+
+    def version(self, key):
+        return None
+
+    def make_engine(self, url, **kw):
+        return create_async_engine(url, **kw)
+
+    def create_table(self):
+        # Can't be done without awaiting, so wait until first use.
+        self.table_created = False
+
+    async def begin(self):
+        if not self.table_created:
+            async with self.engine.begin() as conn:
+                await conn.run_sync(self.table.create, checkfirst=True)
+            self.table_created = True
+        return self.engine.begin()
+
+    async def get(self, key):
+        async with await self.begin() as conn:
+            result = await conn.execute(self.select_stmt,
+                                        dict(_key=key,
+                                             _now=datetime.utcnow()))
+            raw = result.scalar()
+        if raw:
+            return self.deserialize(raw)
+        else:
+            raise KeyError('key %r not found' % key)
+
+    async def set(self, key, value):
+        row = self.make_row(key, value)
+        async with await self.begin() as conn:
+            if self.upsert_stmt is not None:
+                await conn.execute(self.upsert_stmt, row)
+                return
+            result = await conn.execute(self.exists_stmt, dict(_key=key))
+            if result.scalar():
+                await conn.execute(self.update_stmt,
+                                   dict(_key=key, _data=row['data'],
+                                        _expires_at=row['expires_at'],
+                                        _version=row['version']))
+            else:
+                await conn.execute(self.insert_stmt, row)
+
+    async def touch(self, key):
+        if self.ttl:
+            async with await self.begin() as conn:
+                await conn.execute(self.touch_stmt,
+                                   dict(_key=key,
+                                        _expires_at=self.expires_at()))
+
+    async def sweep(self, batch_size=10000):
+        """Delete expired sessions, as for :meth:`.sql.SQLBackend.sweep`."""
+        batch_size = int(batch_size)
+        expired, delete = self.sweep_statements(batch_size)
+        total = 0
+        while True:
+            async with await self.begin() as conn:
+                result = await conn.execute(expired,
+                                            dict(_now=datetime.utcnow()))
+                ids = [row[0] for row in result]
+                if ids:
+                    await conn.execute(delete, dict(_ids=ids))
+            total += len(ids)
+            if len(ids) < batch_size:
+                break
+        return total
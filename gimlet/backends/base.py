@@ -1,18 +1,193 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
-from six.moves import cPickle as pickle
+import logging
+
+import six
+
+from ..codec import (get_codec, get_compressor, encode, decode,
+                     DEFAULT_COMPRESS_THRESHOLD)
+
+log = logging.getLogger('gimlet.backends')
+
+# Number of times a partial update is retried when another writer changes the
+# session in between reading and writing it.
+CAS_ATTEMPTS = 10
 
 
 class BaseBackend(object):
 
-    def __init__(self, prefix=b'gimlet.'):
+    # Set to True by backends which can apply :meth:`update` without
+    # rewriting the whole session. When this is False and the session has
+    # already been read, it is cheaper to just write back the full dict.
+    native_update = False
+
+    # Set to True by backends which can look up individual session keys
+    # cheaply with :meth:`get_field`, :meth:`has_field`, and
+    # :meth:`field_count`, rather than reading the whole session.
+    native_fields = False
+
+    # Set to True by backends which implement :meth:`get_versioned` and
+    # :meth:`compare_and_set`, so that concurrent writes to a session don't
+    # overwrite each other's changes.
+    native_cas = False
+
+    # Set to True by backends whose :meth:`version` reports a version for
+    # every stored session.
+    native_version = False
+
+    # An :class:`gimlet.instrumentation.Observer` to report payload sizes to.
+    observer = None
+
+    def __init__(self, prefix=b'gimlet.', ttl=None, codec=None,
+                 compressor=None, compress_threshold=None):
+        if isinstance(prefix, six.text_type):
+            # Given as text in settings, but session ids are bytes.
+            prefix = prefix.encode('utf-8')
         self.prefix = prefix
+        # Number of seconds after the last write (or :meth:`touch`) that a
+        # session should expire, or None to keep sessions forever.
+        self.ttl = int(ttl) if ttl is not None else None
+        # The :class:`gimlet.codec.Codec` used to write data, or None for
+        # pickle. Data written with any codec can be read.
+        self.codec = get_codec(codec) if codec is not None else None
+        # The :class:`gimlet.codec.Compressor` used for payloads of at least
+        # ``compress_threshold`` bytes, or None to not compress.
+        self.compressor = (get_compressor(compressor)
+                           if compressor is not None else None)
+        self.compress_threshold = (int(compress_threshold)
+                                   if compress_threshold is not None
+                                   else DEFAULT_COMPRESS_THRESHOLD)
+
+    def set_defaults(self, ttl=None, codec=None, compressor=None,
+                     compress_threshold=None, observer=None):
+        """Apply session-wide options for any which weren't given to this
+        backend directly."""
+        if ttl is not None and self.ttl is None:
+            self.ttl = int(ttl)
+        if codec is not None and self.codec is None:
+            self.codec = get_codec(codec)
+        if compressor is not None and self.compressor is None:
+            self.compressor = get_compressor(compressor)
+            if compress_threshold is not None:
+                self.compress_threshold = int(compress_threshold)
+        if observer is not None and self.observer is None:
+            self.observer = observer
 
     def prefixed_key(self, key):
         return self.prefix + key
 
     def serialize(self, value):
-        return pickle.dumps(value)
+        raw = encode(value, self.codec, self.compressor,
+                     self.compress_threshold)
+        if self.observer is not None:
+            self.observer.payload(self, 'write', len(raw))
+        return raw
 
     def deserialize(self, raw):
-        return pickle.loads(raw)
+        if self.observer is not None:
+            self.observer.payload(self, 'read', len(raw))
+        return decode(raw)
+
+    def update(self, key, changed, deleted):
+        """Apply a partial update to the session stored at ``key``.
+
+        ``changed`` is a dict of session keys which were set, and
+        ``deleted`` is a set of session keys which were removed. The
+        default implementation reads the whole session, applies the
+        changes, and writes it back.
+
+        """
+        merge_update(self, key, changed, deleted)
+
+    def touch(self, key):
+        """Reset the expiry of the session stored at ``key`` to :attr:`ttl`
+        seconds from now, without rewriting it.
+
+        Backends which don't support expiry have nothing to do here.
+        """
+        pass
+
+    def version(self, key):
+        """Return a token which changes whenever the session stored at
+        ``key`` changes, or None if this backend can't cheaply tell."""
+        return None
+
+    def set_versioned(self, key, value):
+        """Store ``value`` at ``key`` like ``self[key] = value``, and return
+        the version it was stored as, or None if that isn't known."""
+        self[key] = value
+        return None
+
+    def get_versioned(self, key):
+        """Return ``(session, version)`` for ``key``, raising ``KeyError``
+        if it is missing. ``version`` is an opaque token which changes
+        whenever the session is written."""
+        raise NotImplementedError
+
+    def compare_and_set(self, key, value, version):
+        """Store ``value`` at ``key`` only if it is still at ``version``,
+        or if ``version`` is None, only if there's nothing stored there.
+        Return the new version if it was stored, True if it was stored but
+        the version isn't known, and False if it wasn't stored."""
+        raise NotImplementedError
+
+    def make_session_id(self):
+        """Return an id for a new session, or None to use a random one.
+        Backends can use this to choose where new sessions are stored."""
+        return None
+
+    def get_field(self, key, field):
+        """Return the value of ``field`` in the session stored at ``key``,
+        raising ``KeyError`` if either is missing."""
+        return self[key][field]
+
+    def has_field(self, key, field):
+        try:
+            return field in self[key]
+        except KeyError:
+            return False
+
+    def field_count(self, key):
+        try:
+            return len(self[key])
+        except KeyError:
+            return 0
+
+
+def merge_update(backend, key, changed, deleted):
+    """Apply a partial update to any mapping-like ``backend`` by rewriting
+    the whole value stored at ``key``."""
+    if getattr(backend, 'native_cas', False):
+        return cas_update(backend, key, changed, deleted)
+    try:
+        value = backend[key]
+    except KeyError:
+        value = {}
+    if not changed and not any((k in value) for k in deleted):
+        # Nothing would change, so skip the write.
+        return
+    value.update(changed)
+    for k in deleted:
+        value.pop(k, None)
+    backend[key] = value
+
+
+def cas_update(backend, key, changed, deleted):
+    """Apply a partial update by rewriting the whole value stored at ``key``
+    with :meth:`BaseBackend.compare_and_set`, re-reading and trying again if
+    another writer changed it in between."""
+    for attempt in range(CAS_ATTEMPTS):
+        try:
+            value, version = backend.get_versioned(key)
+        except KeyError:
+            value, version = {}, None
+        if not changed and not any((k in value) for k in deleted):
+            return
+        value.update(changed)
+        for k in deleted:
+            value.pop(k, None)
+        if backend.compare_and_set(key, value, version):
+            return
+    log.warn('Gave up updating %r after %d conflicting writes, overwriting',
+             key, CAS_ATTEMPTS)
+    backend[key] = value
@@ -0,0 +1,215 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import copy
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from ..codec import encode
+from ..util import asbool, make_backend, pop_options
+from .base import BaseBackend
+
+
+class CachedBackend(BaseBackend):
+
+    """Keep recently used sessions in an in-process LRU cache in front of
+    another backend.
+
+    ``inner`` is the backend to cache, either an instance or a name as for
+    the ``backend`` setting, in which case it is configured with the
+    ``inner.*`` options. At most ``max_entries`` sessions are kept, and if
+    ``max_bytes`` is set, at most that many bytes of serialized data
+    (which costs a serialization per entry to measure). Entries are
+    dropped after ``cache_ttl`` seconds, if given.
+
+    Writes go through to the inner backend and update the cache. If the
+    inner backend supports :meth:`.base.BaseBackend.version` (as the Redis
+    and SQL backends do), a cached session is also checked against it
+    before use, so writes from other processes are never missed. That check
+    is a round trip to the inner backend on every hit, so a hit only saves
+    transferring and deserializing the session. Setting ``check_versions``
+    to false skips it, in which case, as for inner backends which can't
+    report versions, ``cache_ttl`` is required and bounds how stale a
+    cached session can be.
+
+    Compare and set is forwarded to the inner backend, and sessions it
+    stores are kept in the cache under their new version.
+
+    Sessions are returned as shallow copies: values which are mutated in
+    place without calling :meth:`.session.Session.save` will be seen by
+    later requests served from this cache.
+    """
+
+    def __init__(self, inner, max_entries=1000, max_bytes=None,
+                 cache_ttl=None, check_versions=True, **kw):
+        self.inner = make_backend(inner, pop_options(kw, 'inner.'))
+        self.check_versions = asbool(check_versions)
+        if cache_ttl is None and not self.check_versions:
+            raise ValueError('cache_ttl is required when check_versions is '
+                             'false')
+        if cache_ttl is None and not self.inner.native_version:
+            raise ValueError('cache_ttl is required when the inner backend '
+                             "can't report session versions")
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes) if max_bytes is not None else None
+        self.cache_ttl = float(cache_ttl) if cache_ttl is not None else None
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+        BaseBackend.__init__(self, **kw)
+
+    @property
+    def native_update(self):
+        return self.inner.native_update
+
+    @property
+    def native_version(self):
+        return self.inner.native_version
+
+    @property
+    def native_cas(self):
+        return self.inner.native_cas
+
+    def set_defaults(self, **options):
+        BaseBackend.set_defaults(self, observer=options.get('observer'))
+        self.inner.set_defaults(**options)
+
+    def make_session_id(self):
+        return self.inner.make_session_id()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, entries=len(self.entries),
+                    bytes=self.size)
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            value, size, expires, version = entry
+            if expires is not None and expires < time.time():
+                self.size -= size
+                return None
+            # Re-insert to mark as most recently used.
+            self.entries[key] = entry
+        if (self.check_versions and (version is not None) and
+                (self.inner.version(key) != version)):
+            self.discard(key)
+            return None
+        return value, version
+
+    def store(self, key, value, version):
+        size = 0
+        if self.max_bytes is not None:
+            # Measured without inner.serialize(), which would report this
+            # to the observer as a write.
+            inner = self.inner
+            size = len(encode(value, inner.codec, inner.compressor,
+                              inner.compress_threshold))
+            if size > self.max_bytes:
+                self.discard(key)
+                return
+        expires = None
+        if self.cache_ttl is not None:
+            expires = time.time() + self.cache_ttl
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size, expires, version)
+            self.size += size
+            while (len(self.entries) > self.max_entries or
+                   (self.max_bytes is not None and
+                    self.size > self.max_bytes)):
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted[1]
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def get_versioned(self, key):
+        if not self.inner.native_version:
+            # Its compare and set tokens can't be checked with version(), so
+            # they aren't worth caching.
+            return self.inner.get_versioned(key)
+        entry = self.lookup(key)
+        if self.observer is not None:
+            self.observer.cache(self, entry is not None)
+        if entry is not None and entry[1] is not None:
+            self.hits += 1
+            return copy.copy(entry[0]), entry[1]
+        self.misses += 1
+        value, version = self.inner.get_versioned(key)
+        self.store(key, value, version)
+        return copy.copy(value), version
+
+    def __getitem__(self, key):
+        entry = self.lookup(key)
+        if self.observer is not None:
+            self.observer.cache(self, entry is not None)
+        if entry is not None:
+            self.hits += 1
+            return copy.copy(entry[0])
+        self.misses += 1
+        # Read the version first: if the session changes in between, the
+        # cached entry will just look stale next time.
+        version = self.inner.version(key)
+        value = self.inner[key]
+        self.store(key, value, version)
+        return copy.copy(value)
+
+    def __setitem__(self, key, value):
+        version = self.inner.set_versioned(key, value)
+        self.written(key, copy.copy(value), version)
+
+    def update(self, key, changed, deleted):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            self.inner.update(key, changed, deleted)
+            return
+        value = copy.copy(entry[0])
+        value.update(changed)
+        for k in deleted:
+            value.pop(k, None)
+        version = entry[3]
+        if self.inner.native_cas and version is not None:
+            # Write the merged session only if the cached one is still
+            # current, so that we know the version we wrote.
+            version = self.inner.compare_and_set(key, value, version)
+            if version:
+                self.written(key, value, version)
+                return
+            version = None
+        self.inner.update(key, changed, deleted)
+        self.written(key, value, version)
+
+    def compare_and_set(self, key, value, version):
+        stored = self.inner.compare_and_set(key, value, version)
+        if stored:
+            self.written(key, copy.copy(value), stored)
+        else:
+            self.discard(key)
+        return stored
+
+    def written(self, key, value, version):
+        if version is True:
+            version = None
+        if version is None and self.inner.native_version:
+            # Another process may have written since we did, so we can't
+            # tell which version our value corresponds to.
+            self.discard(key)
+        else:
+            self.store(key, value, version)
+
+    def touch(self, key):
+        self.inner.touch(key)
+
+    def version(self, key):
+        return self.inner.version(key)
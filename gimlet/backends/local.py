@@ -0,0 +1,122 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import sqlite3
+import threading
+import time
+
+from .base import BaseBackend, merge_update
+
+
+class LocalBackend(BaseBackend):
+
+    """Store sessions in a SQLite database file on the local disk, for
+    deployments where every worker runs on the same host and a network
+    round trip to a session server is pure overhead.
+
+    The database is in WAL mode, so any number of processes and threads can
+    read while another writes, and reads of recently used sessions come
+    straight from the memory-mapped file (up to ``mmap_size`` bytes of it).
+    Each thread of each process opens its own connection, so it is safe to
+    create the backend before forking workers. Writers wait up to
+    ``busy_timeout`` seconds for each other.
+
+    ``synchronous`` sets how hard SQLite works to make writes durable:
+    ``normal`` (the default) can lose the last few writes if the machine
+    loses power, but never corrupts the database, ``full`` syncs every
+    write, and ``off`` leaves it to the operating system. Options may be
+    passed as strings (e.g. from ``backend.*`` settings).
+    """
+
+    synchronous_modes = ('off', 'normal', 'full', 'extra')
+
+    def __init__(self, path, table_name='gimlet_sessions',
+                 synchronous='normal', mmap_size=256 * 1024 * 1024,
+                 busy_timeout=5, **kw):
+        if synchronous.lower() not in self.synchronous_modes:
+            raise ValueError('synchronous must be one of: %s' %
+                             ', '.join(self.synchronous_modes))
+        self.path = path
+        self.table_name = table_name
+        self.synchronous = synchronous.lower()
+        self.mmap_size = int(mmap_size)
+        self.busy_timeout = float(busy_timeout)
+        self.local = threading.local()
+
+        self.select_sql = (
+            'SELECT data FROM %s WHERE key = ? AND '
+            '(expires_at IS NULL OR expires_at > ?)' % table_name)
+        self.upsert_sql = (
+            'INSERT OR REPLACE INTO %s (key, data, expires_at) '
+            'VALUES (?, ?, ?)' % table_name)
+        self.touch_sql = ('UPDATE %s SET expires_at = ? WHERE key = ?' %
+                          table_name)
+        self.sweep_sql = ('DELETE FROM %s WHERE expires_at < ?' %
+                          table_name)
+
+        conn = self.connection()
+        # WAL mode is a property of the database file, so it only needs
+        # setting once.
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS %s ('
+                     'key BLOB PRIMARY KEY, '
+                     'data BLOB NOT NULL, '
+                     'expires_at REAL) WITHOUT ROWID' % table_name)
+        conn.execute('CREATE INDEX IF NOT EXISTS %s_expires_at ON %s '
+                     '(expires_at)' % (table_name, table_name))
+        BaseBackend.__init__(self, **kw)
+
+    def connection(self):
+        """Return this thread's connection, opening it if necessary."""
+        local = self.local
+        pid = os.getpid()
+        if getattr(local, 'pid', None) != pid:
+            # Connections can't be shared with a forked child.
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA synchronous = %s' % self.synchronous)
+            conn.execute('PRAGMA mmap_size = %d' % self.mmap_size)
+            conn.execute('PRAGMA temp_store = MEMORY')
+            local.conn = conn
+            local.pid = pid
+        return local.conn
+
+    def expires_at(self):
+        if self.ttl:
+            return time.time() + self.ttl
+        return None
+
+    def __getitem__(self, key):
+        row = self.connection().execute(
+            self.select_sql, (key, time.time())).fetchone()
+        if row is None:
+            raise KeyError('key %r not found' % key)
+        return self.deserialize(bytes(row[0]))
+
+    def __setitem__(self, key, value):
+        raw = self.serialize(value)
+        self.connection().execute(
+            self.upsert_sql, (key, sqlite3.Binary(raw), self.expires_at()))
+
+    def update(self, key, changed, deleted):
+        # Take the write lock up front, so that concurrent updates from
+        # other workers can't interleave with the read and the write.
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            merge_update(self, key, changed, deleted)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def touch(self, key):
+        if self.ttl:
+            self.connection().execute(self.touch_sql,
+                                      (self.expires_at(), key))
+
+    def sweep(self):
+        """Delete expired sessions, and return how many were deleted."""
+        return self.connection().execute(self.sweep_sql,
+                                         (time.time(),)).rowcount
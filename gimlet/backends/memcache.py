@@ -1,17 +1,138 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 import sys
+import time
 
+import six
+
+from ..util import asbool
 from .base import BaseBackend
 
 PY3 = sys.version_info[0] > 2
 
+# memcached treats expiry times longer than this many seconds as absolute
+# Unix timestamps.
+MAX_RELATIVE_EXPIRY = 30 * 24 * 60 * 60
+
 if not PY3:  # pragma: nocover
     import pylibmc
 
 
+def expire_time(ttl):
+    """Convert a TTL in seconds to a memcached expiry time, which is 0 for
+    none, and must be absolute for more than 30 days."""
+    if not ttl:
+        return 0
+    ttl = int(ttl)
+    if ttl > MAX_RELATIVE_EXPIRY:
+        return int(time.time()) + ttl
+    return ttl
+
+
+def parse_hosts(hosts):
+    """Convert ``hosts``, a list or a string separated by whitespace or
+    commas, of ``host:port`` or ``host`` into ``(host, port)`` pairs."""
+    if isinstance(hosts, six.string_types):
+        hosts = hosts.replace(',', ' ').split()
+    servers = []
+    for host in hosts:
+        if isinstance(host, six.string_types):
+            host, _, port = host.partition(':')
+            host = (host, int(port or 11211))
+        servers.append(host)
+    return servers
+
+
 class MemcacheBackend(BaseBackend):
 
+    """Store each session as a single serialized value in memcached, using
+    pymemcache.
+
+    Each command checks out a connection from a thread-safe pool of at
+    most ``max_pool_size`` connections per server. With several ``hosts``,
+    sessions are spread across them by rendezvous hashing, and a server
+    which stops responding is retried after ``dead_timeout`` seconds.
+    ``connect_timeout`` and ``timeout`` (for reads and writes) are in
+    seconds, and default to waiting forever.
+
+    With ``noreply`` set, writes don't wait for the server to acknowledge
+    them, which saves a round trip but means failed writes go unnoticed.
+    Compare and set, using memcached's ``gets`` and ``cas``, always waits.
+
+    ``client`` may be given instead, e.g. a
+    :class:`pymemcache.test.utils.MockMemcacheClient` for tests. The other
+    options may be passed as strings (e.g. from ``backend.*`` settings).
+    """
+
+    native_cas = True
+
+    def __init__(self, hosts='localhost:11211', max_pool_size=None,
+                 connect_timeout=None, timeout=None, noreply=False,
+                 dead_timeout=60, client=None, *args, **kw):
+        if client is None:
+            client = self.make_client(
+                parse_hosts(hosts),
+                max_pool_size=(int(max_pool_size)
+                               if max_pool_size is not None else None),
+                connect_timeout=(float(connect_timeout)
+                                 if connect_timeout is not None else None),
+                timeout=float(timeout) if timeout is not None else None,
+                dead_timeout=float(dead_timeout))
+        self.client = client
+        self.noreply = asbool(noreply)
+        BaseBackend.__init__(self, *args, **kw)
+
+    def make_client(self, servers, max_pool_size, connect_timeout, timeout,
+                    dead_timeout):
+        from pymemcache.client.base import PooledClient
+        from pymemcache.client.hash import HashClient
+
+        options = dict(connect_timeout=connect_timeout, timeout=timeout,
+                       no_delay=True, max_pool_size=max_pool_size)
+        if len(servers) == 1:
+            return PooledClient(servers[0], **options)
+        return HashClient(servers, use_pooling=True,
+                          dead_timeout=dead_timeout, **options)
+
+    def __getitem__(self, key):
+        raw = self.client.get(self.prefixed_key(key))
+        if raw:
+            return self.deserialize(raw)
+        else:
+            raise KeyError('key %r not found' % key)
+
+    def __setitem__(self, key, value):
+        raw = self.serialize(value)
+        self.client.set(self.prefixed_key(key), raw,
+                        expire=expire_time(self.ttl), noreply=self.noreply)
+
+    def get_versioned(self, key):
+        raw, token = self.client.gets(self.prefixed_key(key))
+        if raw:
+            return self.deserialize(raw), token
+        else:
+            raise KeyError('key %r not found' % key)
+
+    def compare_and_set(self, key, value, version):
+        raw = self.serialize(value)
+        expire = expire_time(self.ttl)
+        if version is None:
+            return bool(self.client.add(self.prefixed_key(key), raw,
+                                        expire=expire, noreply=False))
+        return bool(self.client.cas(self.prefixed_key(key), raw, version,
+                                    expire=expire, noreply=False))
+
+    def touch(self, key):
+        if self.ttl:
+            self.client.touch(self.prefixed_key(key), expire_time(self.ttl),
+                              noreply=self.noreply)
+
+
+class PylibmcBackend(BaseBackend):
+
+    """The original memcached backend, using pylibmc, which only supports
+    Python 2. Keys aren't prefixed."""
+
     def __init__(self, hosts=['localhost'], *args, **kw):
         client = pylibmc.Client(hosts)
         self.pool = pylibmc.ThreadMappedPool(client)
@@ -28,4 +149,9 @@ class MemcacheBackend(BaseBackend):
     def __setitem__(self, key, value):
         raw = self.serialize(value)
         with self.pool.reserve() as mc:
-            mc.set(key, raw)
+            mc.set(key, raw, time=expire_time(self.ttl))
+
+    def touch(self, key):
+        if self.ttl:
+            with self.pool.reserve() as mc:
+                mc.touch(key, expire_time(self.ttl))
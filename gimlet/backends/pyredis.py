@@ -1,29 +1,217 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
-from threading import Lock
+import hashlib
 
+import six
+import redis
 from redis import Redis
 
+from ..compat import PY3
 from .base import BaseBackend
 
-lock = Lock()
+# Sets KEYS[1] to ARGV[2] only if the SHA-1 digest of its current value is
+# ARGV[1], or if ARGV[1] is empty, only if it doesn't exist. ARGV[3] is the
+# TTL, or 0 for none.
+CAS_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current then
+    if redis.sha1hex(current) ~= ARGV[1] then
+        return 0
+    end
+elseif ARGV[1] ~= '' then
+    return 0
+end
+if tonumber(ARGV[3]) > 0 then
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+else
+    redis.call('SET', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+# Returns the SHA-1 digest of the value of KEYS[1], without sending it.
+VERSION_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current then
+    return redis.sha1hex(current)
+end
+return false
+"""
+
+
+def make_connection_pool(module, host, port, db, password, unix_socket_path,
+                         max_connections, pool_timeout, socket_timeout,
+                         socket_connect_timeout):
+    """Create a connection pool using the classes from ``module``, which is
+    either :mod:`redis` or :mod:`redis.asyncio`. Options may be strings."""
+    connection_kwargs = dict(db=int(db), password=password)
+    if socket_timeout is not None:
+        connection_kwargs['socket_timeout'] = float(socket_timeout)
+    if unix_socket_path:
+        connection_kwargs['path'] = unix_socket_path
+        connection_kwargs['connection_class'] = \
+            module.UnixDomainSocketConnection
+    else:
+        connection_kwargs['host'] = host
+        connection_kwargs['port'] = int(port)
+        if socket_connect_timeout is not None:
+            connection_kwargs['socket_connect_timeout'] = \
+                float(socket_connect_timeout)
+    if max_connections is not None:
+        return module.BlockingConnectionPool(
+            max_connections=int(max_connections),
+            timeout=float(pool_timeout),
+            **connection_kwargs)
+    return module.ConnectionPool(**connection_kwargs)
 
 
 class RedisBackend(BaseBackend):
 
-    def __init__(self, host='localhost', port=6379, db=0, *args, **kw):
-        self.client = Redis(host=host, port=port, db=db)
+    """Store each session as a single serialized value in Redis.
+
+    The client is thread-safe: each command checks out a connection from
+    ``connection_pool``, so concurrent requests do their I/O in parallel.
+    If no pool is given, one is created from the remaining options, which
+    may be passed as strings (e.g. from ``backend.*`` settings).
+
+    When ``max_connections`` is set, threads wait up to ``pool_timeout``
+    seconds for a free connection rather than failing immediately.
+
+    The version of a session is the SHA-1 digest of its stored value, which
+    a Lua script checks atomically before writing.
+    """
+
+    native_cas = True
+    native_version = True
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None,
+                 unix_socket_path=None, max_connections=None,
+                 pool_timeout=20, socket_timeout=None,
+                 socket_connect_timeout=None, connection_pool=None,
+                 *args, **kw):
+        if connection_pool is None:
+            connection_pool = make_connection_pool(
+                redis, host=host, port=port, db=db, password=password,
+                unix_socket_path=unix_socket_path,
+                max_connections=max_connections, pool_timeout=pool_timeout,
+                socket_timeout=socket_timeout,
+                socket_connect_timeout=socket_connect_timeout)
+        self.client = Redis(connection_pool=connection_pool)
+        self.cas_script = self.client.register_script(CAS_SCRIPT)
+        self.version_script = self.client.register_script(VERSION_SCRIPT)
         BaseBackend.__init__(self, *args, **kw)
 
     def __getitem__(self, key):
-        with lock:
-            raw = self.client.get(self.prefixed_key(key))
+        raw = self.client.get(self.prefixed_key(key))
         if raw:
             return self.deserialize(raw)
         else:
             raise KeyError('key %r not found' % key)
 
     def __setitem__(self, key, value):
+        self.set_versioned(key, value)
+
+    def set_versioned(self, key, value):
         raw = self.serialize(value)
-        with lock:
-            self.client.set(self.prefixed_key(key), raw)
+        self.client.set(self.prefixed_key(key), raw, ex=self.ttl)
+        return hashlib.sha1(raw).hexdigest()
+
+    def version(self, key):
+        version = self.version_script(keys=[self.prefixed_key(key)])
+        if version is None:
+            return None
+        return version.decode('ascii')
+
+    def get_versioned(self, key):
+        raw = self.client.get(self.prefixed_key(key))
+        if raw:
+            return self.deserialize(raw), hashlib.sha1(raw).hexdigest()
+        else:
+            raise KeyError('key %r not found' % key)
+
+    def compare_and_set(self, key, value, version):
+        raw = self.serialize(value)
+        if self.cas_script(keys=[self.prefixed_key(key)],
+                           args=[version or '', raw, self.ttl or 0]):
+            return hashlib.sha1(raw).hexdigest()
+        return False
+
+    def touch(self, key):
+        if self.ttl:
+            self.client.expire(self.prefixed_key(key), self.ttl)
+
+
+class RedisHashBackend(RedisBackend):
+
+    """Store each session as a Redis hash, with one field per session key.
+
+    Individual keys can be fetched, checked, and counted without reading
+    the rest of the session, and writes only send the keys that changed.
+    """
+
+    native_update = True
+    native_fields = True
+    native_cas = False
+    native_version = False
+
+    def encode_field(self, field):
+        if isinstance(field, six.text_type):
+            return field.encode('utf-8')
+        return field
+
+    def decode_field(self, raw):
+        if PY3:
+            return raw.decode('utf-8')
+        return raw
+
+    def __getitem__(self, key):
+        raw = self.client.hgetall(self.prefixed_key(key))
+        if raw:
+            return dict((self.decode_field(field), self.deserialize(value))
+                        for field, value in raw.items())
+        else:
+            raise KeyError('key %r not found' % key)
+
+    def __setitem__(self, key, value):
+        mapping = dict((self.encode_field(field), self.serialize(v))
+                       for field, v in value.items())
+        redis_key = self.prefixed_key(key)
+        pipe = self.client.pipeline()
+        pipe.delete(redis_key)
+        if mapping:
+            pipe.hset(redis_key, mapping=mapping)
+            if self.ttl:
+                pipe.expire(redis_key, self.ttl)
+        pipe.execute()
+
+    def set_versioned(self, key, value):
+        self[key] = value
+        return None
+
+    def update(self, key, changed, deleted):
+        redis_key = self.prefixed_key(key)
+        pipe = self.client.pipeline()
+        if deleted:
+            pipe.hdel(redis_key,
+                      *[self.encode_field(field) for field in deleted])
+        if changed:
+            pipe.hset(redis_key, mapping=dict(
+                (self.encode_field(field), self.serialize(v))
+                for field, v in changed.items()))
+        if self.ttl:
+            pipe.expire(redis_key, self.ttl)
+        pipe.execute()
+
+    def get_field(self, key, field):
+        raw = self.client.hget(self.prefixed_key(key),
+                               self.encode_field(field))
+        if raw is None:
+            raise KeyError('field %r not found in key %r' % (field, key))
+        return self.deserialize(raw)
+
+    def has_field(self, key, field):
+        return self.client.hexists(self.prefixed_key(key),
+                                   self.encode_field(field))
+
+    def field_count(self, key):
+        return self.client.hlen(self.prefixed_key(key))
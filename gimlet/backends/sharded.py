@@ -0,0 +1,233 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import binascii
+import hashlib
+import os
+from bisect import bisect
+from struct import Struct
+
+import six
+
+from ..util import asbool, make_backend, pop_options
+from .base import BaseBackend, merge_update
+
+point_struct = Struct(str('>I'))
+
+# Session ids with shard hints are 11 random bytes, then a check of this
+# many bytes, then the index of their shard, in hex.
+HINT_RANDOM_SIZE = 11
+HINT_CHECK_SIZE = 4
+
+
+def hint_check(random, index):
+    return hashlib.md5(random + index).digest()[:HINT_CHECK_SIZE]
+
+
+def hash_point(data):
+    """Return a position on the ring for the bytes ``data``."""
+    return point_struct.unpack(hashlib.md5(data).digest()[:4])[0]
+
+
+class ShardedBackend(BaseBackend):
+
+    """Spread sessions across several backends with a consistent hash ring,
+    so that adding a shard only moves about ``1 / len(shards)`` of the
+    sessions.
+
+    ``shards`` is a dict of backends by name, or a list of them, named by
+    their position. Each shard is placed on the ring ``vnodes`` times its
+    weight, from ``weights``, a dict by name or a list in the same order
+    as ``shards``, defaulting to 1. From settings, ``shards`` is a string
+    of names, each of which is configured like the ``backend`` setting::
+
+        gimlet.backend = sharded
+        gimlet.backend.shards = r1 r2
+        gimlet.backend.weights = 1 2
+        gimlet.backend.r1 = pyredis
+        gimlet.backend.r1.host = 10.0.0.1
+        gimlet.backend.r2 = pyredis
+        gimlet.backend.r2.host = 10.0.0.2
+
+    With ``shard_hints`` set, new session ids end with the index of the
+    shard they were placed on and a check of it, so they're routed without
+    hashing and never move when shards are added. Shards must then only ever
+    be appended, never removed or reordered, and there can be at most 256 of
+    them. Existing ids are still routed by the ring. About 1 in 4 billion of
+    them will pass the check by chance, so reads which miss the hinted shard
+    fall back to the one on the ring.
+    """
+
+    vnodes = 160
+
+    def __init__(self, shards, weights=None, vnodes=None, shard_hints=False,
+                 **kw):
+        if isinstance(shards, six.string_types):
+            names = shards.split()
+            for name in names:
+                if name not in kw:
+                    raise ValueError('no backend given for shard %r' % name)
+            shards = [(name, make_backend(kw.pop(name),
+                                          pop_options(kw, name + '.')))
+                      for name in names]
+        elif isinstance(shards, dict):
+            shards = sorted(shards.items())
+        else:
+            shards = [(str(ii), shard) for ii, shard in enumerate(shards)]
+        if not shards:
+            raise ValueError('at least one shard is required')
+        self.names = [name for name, shard in shards]
+        self.shards = [make_backend(shard, {}) for name, shard in shards]
+
+        if isinstance(weights, six.string_types):
+            weights = weights.split()
+        if weights is None:
+            weights = {}
+        elif not isinstance(weights, dict):
+            weights = dict(zip(self.names, weights))
+        if vnodes is not None:
+            self.vnodes = int(vnodes)
+        self.shard_hints = asbool(shard_hints)
+        if self.shard_hints and len(self.shards) > 256:
+            raise ValueError('shard hints support at most 256 shards')
+
+        ring = []
+        for index, name in enumerate(self.names):
+            count = int(float(weights.get(name, 1)) * self.vnodes)
+            for ii in range(count):
+                point = hash_point(('%s#%d' % (name, ii)).encode('utf-8'))
+                ring.append((point, index))
+        ring.sort()
+        self.points = [point for point, index in ring]
+        self.owners = [index for point, index in ring]
+        BaseBackend.__init__(self, **kw)
+
+    @property
+    def native_update(self):
+        return all(shard.native_update for shard in self.shards)
+
+    @property
+    def native_fields(self):
+        return all(shard.native_fields for shard in self.shards)
+
+    @property
+    def native_version(self):
+        return all(shard.native_version for shard in self.shards)
+
+    @property
+    def native_cas(self):
+        return all(shard.native_cas for shard in self.shards)
+
+    def set_defaults(self, **options):
+        BaseBackend.set_defaults(self, observer=options.get('observer'))
+        for shard in self.shards:
+            shard.set_defaults(**options)
+
+    def locate(self, key):
+        """Return the index of the shard which stores ``key``."""
+        if self.shard_hints:
+            index = self.hinted_index(key)
+            if index is not None:
+                return index
+        return self.ring_locate(key)
+
+    def hinted_index(self, key):
+        """Return the shard index hinted by ``key``, or None if it has no
+        valid hint."""
+        try:
+            raw = binascii.unhexlify(key)
+        except (TypeError, ValueError):
+            return None
+        split = HINT_RANDOM_SIZE + HINT_CHECK_SIZE
+        if len(raw) != split + 1:
+            return None
+        random, check, index = (raw[:HINT_RANDOM_SIZE],
+                                raw[HINT_RANDOM_SIZE:split], raw[split:])
+        if check != hint_check(random, index):
+            return None
+        index = ord(index)
+        if index >= len(self.shards):
+            return None
+        return index
+
+    def ring_locate(self, data):
+        pos = bisect(self.points, hash_point(data)) % len(self.points)
+        return self.owners[pos]
+
+    def shard(self, key):
+        return self.shards[self.locate(key)]
+
+    def make_session_id(self):
+        if not self.shard_hints:
+            return None
+        random = os.urandom(HINT_RANDOM_SIZE)
+        index = six.int2byte(self.ring_locate(random))
+        return binascii.hexlify(random + hint_check(random, index) + index)
+
+    def read(self, key, method, *args):
+        """Call ``method`` of the shard storing ``key``, returning its result
+        and whether it came from the shard on the ring instead of a hinted
+        one, which is tried if the hinted one raises KeyError."""
+        index = self.locate(key)
+        try:
+            return getattr(self.shards[index], method)(key, *args), False
+        except KeyError:
+            ring_index = self.ring_locate(key)
+            if ring_index == index:
+                raise
+            return getattr(self.shards[ring_index], method)(key, *args), True
+
+    def __getitem__(self, key):
+        return self.read(key, '__getitem__')[0]
+
+    def __setitem__(self, key, value):
+        self.shard(key)[key] = value
+
+    def set_versioned(self, key, value):
+        return self.shard(key).set_versioned(key, value)
+
+    def update(self, key, changed, deleted):
+        index = self.locate(key)
+        shard = self.shards[index]
+        if index != self.ring_locate(key):
+            # It may still be on the ring, so unless the hinted shard is
+            # known to have it, merge with what a read finds.
+            if not shard.native_update:
+                return merge_update(self, key, changed, deleted)
+            if shard.native_fields and not shard.field_count(key):
+                return merge_update(self, key, changed, deleted)
+        shard.update(key, changed, deleted)
+
+    def touch(self, key):
+        self.shard(key).touch(key)
+
+    def version(self, key):
+        return self.shard(key).version(key)
+
+    def get_versioned(self, key):
+        (value, version), fell_back = self.read(key, 'get_versioned')
+        if fell_back:
+            # Writes go to the hinted shard, which doesn't have it yet.
+            version = None
+        return value, version
+
+    def compare_and_set(self, key, value, version):
+        return self.shard(key).compare_and_set(key, value, version)
+
+    def get_field(self, key, field):
+        return self.read(key, 'get_field', field)[0]
+
+    def has_field(self, key, field):
+        return self.count(key, 'has_field', field)
+
+    def field_count(self, key):
+        return self.count(key, 'field_count')
+
+    def count(self, key, method, *args):
+        """Like :meth:`read`, for methods which return a false value rather
+        than raising KeyError for missing sessions."""
+        index = self.locate(key)
+        result = getattr(self.shards[index], method)(key, *args)
+        ring_index = self.ring_locate(key)
+        if result or ring_index == index:
+            return result
+        return getattr(self.shards[ring_index], method)(key, *args)
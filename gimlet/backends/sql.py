@@ -1,38 +1,256 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
-from sqlalchemy import MetaData, Table, Column, types, create_engine, select
+import random
+from datetime import datetime, timedelta
+
+import sqlite3
+
+from sqlalchemy import (MetaData, Table, Column, types, create_engine, select,
+                        bindparam, func, or_)
+from sqlalchemy.exc import IntegrityError
 
 from .base import BaseBackend
 
 
 class SQLBackend(BaseBackend):
 
-    def __init__(self, url, table_name='gimlet_channels', **engine_kwargs):
-        meta = MetaData(bind=create_engine(url, **engine_kwargs))
-        self.table = Table(table_name, meta,
-                           Column('id', types.Integer, primary_key=True),
-                           Column('key', types.CHAR(32), nullable=False,
-                                  unique=True),
-                           Column('data', types.LargeBinary, nullable=False))
-        self.table.create(checkfirst=True)
+    """Store sessions in a SQL table, using SQLAlchemy Core.
+
+    Statements are built once and reused with bound parameters, and every
+    operation checks a connection out of the engine's pool for exactly one
+    transaction. Either pass an existing ``engine``, or a ``url`` along with
+    pool options such as ``pool_size``, ``max_overflow``, ``pool_recycle``
+    and ``pool_timeout``, which may be given as strings (e.g. from
+    ``backend.*`` settings). Any other keyword arguments are passed to
+    :func:`sqlalchemy.create_engine`.
+
+    Each write stores a new random ``version``, so that concurrent updates
+    to a session can be detected with :meth:`compare_and_set`. Tables
+    created by earlier versions need a nullable ``version BIGINT`` column
+    adding.
+    """
+
+    native_cas = True
+    native_version = True
+
+    int_engine_options = ('pool_size', 'max_overflow', 'pool_recycle',
+                          'pool_timeout')
+
+    def __init__(self, url=None, table_name='gimlet_channels', ttl=None,
+                 engine=None, codec=None, compressor=None,
+                 compress_threshold=None, **engine_kwargs):
+        if engine is None:
+            for k in self.int_engine_options:
+                if k in engine_kwargs:
+                    engine_kwargs[k] = int(engine_kwargs[k])
+            engine = self.make_engine(url, **engine_kwargs)
+        self.engine = engine
+        self.table = table = Table(
+            table_name, MetaData(),
+            Column('id', types.Integer, primary_key=True),
+            Column('key', types.CHAR(32), nullable=False, unique=True),
+            Column('data', types.LargeBinary, nullable=False),
+            Column('created_at', types.DateTime, nullable=True),
+            Column('expires_at', types.DateTime, nullable=True, index=True),
+            Column('version', types.BigInteger, nullable=True))
+        self.create_table()
+        BaseBackend.__init__(self, ttl=ttl, codec=codec,
+                             compressor=compressor,
+                             compress_threshold=compress_threshold)
 
-    def __setitem__(self, key, value):
-        table = self.table
         key_col = table.c.key
-        raw = self.serialize(value)
-        # Check if this key exists with a SELECT FOR UPDATE, to protect
-        # against a race with other concurrent writers of this key.
-        r = table.count(key_col == key, for_update=True).scalar()
-        if r:
-            # If it exists, use an UPDATE.
-            table.update().values(data=raw).where(key_col == key).execute()
-        else:
-            # Otherwise INSERT.
-            table.insert().values(key=key, data=raw).execute()
+        live = or_(table.c.expires_at.is_(None),
+                   table.c.expires_at > bindparam('_now'))
+        self.select_stmt = select(table.c.data).where(
+            key_col == bindparam('_key'), live)
+        # Rows written before versions were added have none.
+        self.select_versioned_stmt = select(
+            table.c.data, func.coalesce(table.c.version, 0)).where(
+            key_col == bindparam('_key'), live)
+        self.select_version_stmt = select(
+            func.coalesce(table.c.version, 0)).where(
+            key_col == bindparam('_key'), live)
+        self.touch_stmt = table.update().\
+            where(key_col == bindparam('_key')).\
+            values(expires_at=bindparam('_expires_at'))
+        self.upsert_stmt = self.make_upsert(self.upsert_insert_class())
+        self.exists_stmt = select(func.count()).select_from(table).\
+            where(key_col == bindparam('_key')).with_for_update()
+        self.update_stmt = table.update().\
+            where(key_col == bindparam('_key')).\
+            values(data=bindparam('_data'),
+                   expires_at=bindparam('_expires_at'),
+                   version=bindparam('_version'))
+        self.insert_stmt = table.insert()
+        cas_values = dict(data=bindparam('_data'),
+                          expires_at=bindparam('_expires_at'),
+                          version=bindparam('_version'))
+        self.cas_stmt = table.update().where(
+            key_col == bindparam('_key'),
+            func.coalesce(table.c.version, 0) == bindparam('_old_version'),
+            live).values(**cas_values)
+        # An expired row is as good as absent, so compare and set can take
+        # it over.
+        self.replace_expired_stmt = table.update().where(
+            key_col == bindparam('_key'),
+            table.c.expires_at <= bindparam('_now')).values(**cas_values)
+
+    def make_engine(self, url, **kw):
+        return create_engine(url, **kw)
+
+    def create_table(self):
+        self.table.create(self.engine, checkfirst=True)
+
+    def upsert_insert_class(self):
+        """Return the dialect-specific insert construct supporting upserts,
+        or None if this database doesn't have one."""
+        name = self.engine.dialect.name
+        try:
+            if name == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+            elif name == 'mysql':
+                from sqlalchemy.dialects.mysql import insert
+            elif name == 'sqlite' and sqlite3.sqlite_version_info >= (3, 24):
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                return None
+        except ImportError:
+            return None
+        return insert
+
+    def make_upsert(self, insert_class):
+        if insert_class is None:
+            return None
+        stmt = insert_class(self.table)
+        if self.engine.dialect.name == 'mysql':
+            return stmt.on_duplicate_key_update(
+                data=stmt.inserted.data,
+                expires_at=stmt.inserted.expires_at,
+                version=stmt.inserted.version)
+        return stmt.on_conflict_do_update(
+            index_elements=[self.table.c.key],
+            set_=dict(data=stmt.excluded.data,
+                      expires_at=stmt.excluded.expires_at,
+                      version=stmt.excluded.version))
+
+    def expires_at(self):
+        if self.ttl:
+            return datetime.utcnow() + timedelta(seconds=self.ttl)
+        return None
+
+    def new_version(self):
+        # Random rather than incrementing, so that a session which is
+        # deleted and written again can't reuse a version. Never 0, which is
+        # the version of rows written before versions were added.
+        return random.randint(1, 2 ** 62)
+
+    def make_row(self, key, value):
+        return dict(key=key, data=self.serialize(value),
+                    created_at=datetime.utcnow(),
+                    expires_at=self.expires_at(),
+                    version=self.new_version())
+
+    def __setitem__(self, key, value):
+        self.set_versioned(key, value)
+
+    def set_versioned(self, key, value):
+        row = self.make_row(key, value)
+        raw, expires_at = row['data'], row['expires_at']
+        with self.engine.begin() as conn:
+            if self.upsert_stmt is not None:
+                # Insert or update in a single statement.
+                conn.execute(self.upsert_stmt, row)
+                return row['version']
+            # Check if this key exists with a SELECT FOR UPDATE, to protect
+            # against a race with other concurrent writers of this key.
+            if conn.execute(self.exists_stmt, dict(_key=key)).scalar():
+                # If it exists, use an UPDATE.
+                conn.execute(self.update_stmt,
+                             dict(_key=key, _data=raw,
+                                  _expires_at=expires_at,
+                                  _version=row['version']))
+            else:
+                # Otherwise INSERT.
+                conn.execute(self.insert_stmt, row)
+        return row['version']
+
+    def version(self, key):
+        with self.engine.connect() as conn:
+            return conn.execute(self.select_version_stmt,
+                                dict(_key=key,
+                                     _now=datetime.utcnow())).scalar()
+
+    def get_versioned(self, key):
+        with self.engine.connect() as conn:
+            row = conn.execute(self.select_versioned_stmt,
+                               dict(_key=key,
+                                    _now=datetime.utcnow())).first()
+        if row is None or not row[0]:
+            raise KeyError('key %r not found' % key)
+        return self.deserialize(row[0]), row[1]
+
+    def compare_and_set(self, key, value, version):
+        row = self.make_row(key, value)
+        params = dict(_key=key, _data=row['data'],
+                      _expires_at=row['expires_at'],
+                      _version=row['version'], _now=datetime.utcnow())
+        if version is not None:
+            with self.engine.begin() as conn:
+                result = conn.execute(self.cas_stmt,
+                                      dict(params, _old_version=version))
+            return row['version'] if result.rowcount == 1 else False
+        try:
+            with self.engine.begin() as conn:
+                result = conn.execute(self.replace_expired_stmt, params)
+                if result.rowcount == 0:
+                    conn.execute(self.insert_stmt, row)
+        except IntegrityError:
+            # Another writer created it first.
+            return False
+        return row['version']
 
     def __getitem__(self, key):
-        raw = select([self.table.c.data], self.table.c.key == key).scalar()
+        with self.engine.connect() as conn:
+            raw = conn.execute(self.select_stmt,
+                               dict(_key=key,
+                                    _now=datetime.utcnow())).scalar()
         if raw:
             return self.deserialize(raw)
         else:
             raise KeyError('key %r not found' % key)
+
+    def touch(self, key):
+        if self.ttl:
+            with self.engine.begin() as conn:
+                conn.execute(self.touch_stmt,
+                             dict(_key=key, _expires_at=self.expires_at()))
+
+    def sweep(self, batch_size=10000):
+        """Delete expired sessions, and return how many were deleted.
+
+        Rows are deleted ``batch_size`` at a time, each batch in its own
+        transaction, so that this can run alongside live traffic without
+        holding long locks.
+        """
+        batch_size = int(batch_size)
+        expired, delete = self.sweep_statements(batch_size)
+        total = 0
+        while True:
+            with self.engine.begin() as conn:
+                ids = [row[0] for row in
+                       conn.execute(expired, dict(_now=datetime.utcnow()))]
+                if ids:
+                    conn.execute(delete, dict(_ids=ids))
+            total += len(ids)
+            if len(ids) < batch_size:
+                break
+        return total
+
+    def sweep_statements(self, batch_size):
+        table = self.table
+        expired = select(table.c.id).\
+            where(table.c.expires_at < bindparam('_now')).\
+            limit(batch_size)
+        delete = table.delete().where(
+            table.c.id.in_(bindparam('_ids', expanding=True)))
+        return expired, delete
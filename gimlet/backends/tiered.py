@@ -0,0 +1,211 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import atexit
+import copy
+import logging
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
+
+from ..util import asbool, make_backend, pop_options
+from ..writer import apply_write, coalesce
+from .base import BaseBackend
+
+log = logging.getLogger('gimlet.backends.tiered')
+
+
+class TieredBackend(BaseBackend):
+
+    """Read sessions from a fast backend, falling back to a durable one.
+
+    ``fast`` and ``durable`` are backend instances, or names as for the
+    ``backend`` setting configured with the ``fast.*`` and ``durable.*``
+    options, e.g. ``backend.fast = pyredis`` and ``backend.durable = sql``.
+    Sessions missing from the fast tier are read from the durable tier and
+    copied into the fast one.
+
+    By default writes go to both tiers before returning. With
+    ``write_behind`` set, they go to the fast tier immediately and are
+    queued for the durable tier, which a background thread writes every
+    ``flush_interval`` seconds, at most ``batch_size`` at a time. Repeated
+    writes to the same session in between are combined into one. Anything
+    still queued is written at interpreter exit, but will be lost if the
+    process dies first.
+
+    Without ``write_behind``, compare and set is forwarded to the durable
+    tier. Sessions are then still read from the fast tier, but each read
+    also fetches the session's version from the durable one.
+    """
+
+    def __init__(self, fast, durable, write_behind=False, flush_interval=1,
+                 batch_size=100, **kw):
+        self.fast = make_backend(fast, pop_options(kw, 'fast.'))
+        self.durable = make_backend(durable, pop_options(kw, 'durable.'))
+        self.write_behind = asbool(write_behind)
+        self.flush_interval = float(flush_interval)
+        self.batch_size = int(batch_size)
+        self.pending = OrderedDict()
+        self.inflight = {}
+        self.lock = Lock()
+        self.wakeup = Condition(self.lock)
+        self.flush_lock = Lock()
+        self.thread = None
+        self.closed = False
+        if self.write_behind:
+            atexit.register(self.close)
+        BaseBackend.__init__(self, **kw)
+
+    @property
+    def native_update(self):
+        if self.write_behind:
+            return self.fast.native_update
+        return self.fast.native_update and self.durable.native_update
+
+    @property
+    def native_cas(self):
+        # Written behind, the durable tier's versions lag the fast tier.
+        return not self.write_behind and self.durable.native_cas
+
+    def set_defaults(self, **options):
+        self.fast.set_defaults(**options)
+        self.durable.set_defaults(**options)
+
+    def __getitem__(self, key):
+        try:
+            return self.fast[key]
+        except KeyError:
+            pass
+        if self.write_behind:
+            with self.lock:
+                queued = key in self.pending or key in self.inflight
+            if queued:
+                self.flush()
+        value = self.durable[key]
+        self.fast[key] = value
+        return value
+
+    def get_versioned(self, key):
+        if not self.durable.native_version:
+            value, version = self.durable.get_versioned(key)
+            self.fast[key] = value
+            return value, version
+        # Read the version first: the fast tier is written before the
+        # durable one, so a session changed in between fails its compare
+        # and set rather than being written back over the change.
+        version = self.durable.version(key)
+        if version is not None:
+            try:
+                return self.fast[key], version
+            except KeyError:
+                pass
+        value, version = self.durable.get_versioned(key)
+        self.fast[key] = value
+        return value, version
+
+    def compare_and_set(self, key, value, version):
+        stored = self.durable.compare_and_set(key, value, version)
+        if stored:
+            self.fast[key] = value
+        return stored
+
+    def __setitem__(self, key, value):
+        self.fast[key] = value
+        if self.write_behind:
+            self.enqueue(key, (copy.copy(value), None, None))
+        else:
+            self.durable[key] = value
+
+    def update(self, key, changed, deleted):
+        self.update_fast(key, changed, deleted)
+        if self.write_behind:
+            self.enqueue(key, (None, dict(changed), set(deleted)))
+        else:
+            self.durable.update(key, changed, deleted)
+
+    def update_fast(self, key, changed, deleted):
+        """Apply an update to the fast tier, but only if it still holds the
+        session. Updating an evicted session there would store just the
+        changed keys, which would then be served as the whole session;
+        left out, it's refilled from the durable tier on the next read."""
+        fast = self.fast
+        if fast.native_update and fast.native_fields:
+            if fast.field_count(key):
+                fast.update(key, changed, deleted)
+            return
+        try:
+            value = fast[key]
+        except KeyError:
+            return
+        value.update(changed)
+        for k in deleted:
+            value.pop(k, None)
+        fast[key] = value
+
+    def touch(self, key):
+        self.fast.touch(key)
+        self.durable.touch(key)
+
+    def enqueue(self, key, write):
+        with self.lock:
+            if key in self.pending:
+                write = coalesce(self.pending.pop(key), write)
+            self.pending[key] = write
+            if self.thread is None or not self.thread.is_alive():
+                # Started lazily, so that a forked worker starts its own.
+                self.closed = False
+                self.thread = Thread(target=self.run,
+                                     name='gimlet-write-behind')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.closed:
+                    self.wakeup.wait(self.flush_interval)
+                closed = self.closed
+            self.flush()
+            if closed:
+                return
+
+    def flush(self):
+        """Write every queued session to the durable tier."""
+        with self.flush_lock:
+            while True:
+                with self.lock:
+                    batch = []
+                    while self.pending and len(batch) < self.batch_size:
+                        batch.append(self.pending.popitem(last=False))
+                    self.inflight = dict(batch)
+                if not batch:
+                    return
+                try:
+                    for key, write in batch:
+                        apply_write(self.durable, key, write)
+                        del self.inflight[key]
+                except Exception:
+                    log.exception('Write-behind to %r failed', self.durable)
+                    with self.lock:
+                        # Retry next time, before anything queued since.
+                        retry = OrderedDict()
+                        for key, write in batch:
+                            if key in self.inflight:
+                                if key in self.pending:
+                                    write = coalesce(write,
+                                                     self.pending.pop(key))
+                                retry[key] = write
+                        retry.update(self.pending)
+                        self.pending = retry
+                        self.inflight = {}
+                    return
+                with self.lock:
+                    self.inflight = {}
+
+    def close(self):
+        """Write everything queued and stop the background thread."""
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+            thread = self.thread
+        if thread is not None and thread.is_alive():
+            thread.join()
+        self.flush()
@@ -0,0 +1,45 @@
+"""Benchmarks for gimlet, run with the ``gimlet-bench`` console script.
+
+They use :mod:`pyperf`, which is installed with the ``bench`` extra. All of
+pyperf's options are accepted: for instance, ``gimlet-bench -o
+results.json`` saves the results to compare later with ``python -m pyperf
+compare_to``. Cases can be selected with ``--select``, which takes a
+regular expression matched against case names.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import re
+
+from .cases import cases
+
+
+def time_case(loops, setup):
+    import pyperf
+    op = setup()
+    range_it = range(loops)
+    t0 = pyperf.perf_counter()
+    for _ in range_it:
+        op()
+    return pyperf.perf_counter() - t0
+
+
+def add_cmdline_args(cmd, args):
+    if args.select:
+        cmd.extend(('--select', args.select))
+
+
+def main(argv=None):
+    import pyperf
+    # Workers are started with ``-m``, which works whether this was run that
+    # way or with the console script.
+    runner = pyperf.Runner(
+        add_cmdline_args=add_cmdline_args,
+        program_args=('-m', 'gimlet.benchmarks'))
+    runner.argparser.add_argument(
+        '--select', metavar='REGEX',
+        help='only run cases whose names match REGEX')
+    args = runner.parse_args(argv)
+    pattern = re.compile(args.select) if args.select else None
+    for name, setup in cases():
+        if pattern is None or pattern.search(name):
+            runner.bench_time_func(name, time_case, setup)
@@ -0,0 +1,6 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from . import main
+
+main()
@@ -0,0 +1,263 @@
+"""Benchmark cases.
+
+Each case is a setup function which prepares everything it needs and
+returns the operation to be timed, a function taking no arguments. Setup
+isn't timed, and only runs for the cases which are selected.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import time
+from binascii import hexlify
+from collections import OrderedDict
+
+from webob import Request, Response
+
+from ..backends.base import BaseBackend
+from ..factories import session_factory_factory
+from ..middleware import SessionMiddleware
+from ..session import SessionChannel
+
+SECRET = 'benchmark-secret'
+ENCRYPTION_KEY = hexlify(os.urandom(32))
+
+# Number of keys in the session for each size.
+SIZES = OrderedDict([('small', 4), ('medium', 64), ('large', 1024)])
+
+
+def make_data(size):
+    return dict(('key%d' % ii, 'value %d' % ii) for ii in range(SIZES[size]))
+
+
+def make_id():
+    return hexlify(os.urandom(16))
+
+
+class DictBackend(BaseBackend):
+
+    """Serializes into a dict, to measure gimlet's own overhead."""
+
+    def __init__(self, *args, **kw):
+        self.data = {}
+        BaseBackend.__init__(self, *args, **kw)
+
+    def __getitem__(self, key):
+        return self.deserialize(self.data[key])
+
+    def __setitem__(self, key, value):
+        self.data[key] = self.serialize(value)
+
+
+def client_cookies(factory, size):
+    """Return cookies for a session with ``size`` data stored client side."""
+    cookies = {}
+    for key, name in factory.channel_names.items():
+        channel = SessionChannel(make_id(), int(time.time()), None,
+                                 fresh=True)
+        if key == 'perm':
+            channel.client_data = make_data(size)
+        cookies[name] = factory.serializer.dumps(channel)
+    return cookies
+
+
+def serializer_dumps(size, encrypted=False, cipher=None):
+    factory = session_factory_factory(
+        SECRET, encryption_key=ENCRYPTION_KEY if encrypted else None,
+        cipher=cipher)
+    channel = SessionChannel(make_id(), int(time.time()), None, fresh=True,
+                             client_data=make_data(size))
+    return lambda: factory.serializer.dumps(channel)
+
+
+def serializer_loads(size, encrypted=False, cipher=None):
+    factory = session_factory_factory(
+        SECRET, encryption_key=ENCRYPTION_KEY if encrypted else None,
+        cipher=cipher)
+    channel = SessionChannel(make_id(), int(time.time()), None, fresh=True,
+                             client_data=make_data(size))
+    cookie = factory.serializer.dumps(channel)
+    return lambda: factory.serializer.loads(cookie)
+
+
+def session_load(size):
+    """Build a session from cookies and read one key."""
+    factory = session_factory_factory(SECRET)
+    request = Request.blank('/', cookies=client_cookies(factory, size))
+    return lambda: factory(request)['key0']
+
+
+def session_get(size):
+    factory = session_factory_factory(SECRET, backend=DictBackend())
+    sess = factory(Request.blank('/'))
+    sess.update(make_data(size))
+    return lambda: sess['key0']
+
+
+def session_set(size):
+    """Set a server-side key and write the session."""
+    backend = DictBackend()
+    factory = session_factory_factory(SECRET, backend=backend)
+    cookies = client_cookies(factory, 'small')
+    request = Request.blank('/', cookies=cookies)
+    id = factory(request).id
+    backend[id] = make_data(size)
+
+    def op():
+        sess = factory(request)
+        sess['key0'] = 'changed'
+        sess.write_callback(request, Response())
+    return op
+
+
+def middleware_request(size):
+    """A full WSGI request which reads one key and sets another."""
+    def app(environ, start_response):
+        sess = environ['gimlet.session']
+        sess.get('key0')
+        sess['last_seen'] = 1
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'ok']
+
+    backend = DictBackend()
+    middleware = SessionMiddleware(app, SECRET, backend=backend)
+    factory = middleware.session_factory
+    cookies = client_cookies(factory, 'small')
+    request = Request.blank('/', cookies=cookies)
+    backend[factory(request).id] = make_data(size)
+    cookie_header = request.environ['HTTP_COOKIE']
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    def op():
+        environ = Request.blank('/').environ
+        environ['HTTP_COOKIE'] = cookie_header
+        middleware(environ, start_response)
+    return op
+
+
+def backend_get(make_backend, size):
+    backend = make_backend()
+    id = make_id()
+    backend[id] = make_data(size)
+    return lambda: backend[id]
+
+
+def backend_set(make_backend, size):
+    backend = make_backend()
+    id = make_id()
+    data = make_data(size)
+    return lambda: backend.__setitem__(id, data)
+
+
+def backend_update(make_backend, size):
+    backend = make_backend()
+    id = make_id()
+    backend[id] = make_data(size)
+    changed = {'key0': 'changed'}
+    deleted = set(['key1'])
+    return lambda: backend.update(id, changed, deleted)
+
+
+def sqlite_backend():
+    from ..backends.sql import SQLBackend
+    return SQLBackend(url='sqlite://')
+
+
+def redis_pool():
+    """Return a connection pool for a local redis-server if one is running,
+    otherwise for fakeredis if it's installed and can run the Redis
+    backends' Lua scripts, or else None."""
+    import redis
+    pool = redis.ConnectionPool()
+    try:
+        redis.Redis(connection_pool=pool).ping()
+        return pool
+    except redis.ConnectionError:
+        pass
+    try:
+        import fakeredis
+    except ImportError:
+        return None
+    pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection,
+                                server=fakeredis.FakeServer())
+    try:
+        redis.Redis(connection_pool=pool).eval('return redis.sha1hex("")', 0)
+    except redis.ResponseError:
+        # Without lupa, fakeredis doesn't know EVAL or EVALSHA, and some
+        # versions don't provide redis.sha1hex() to scripts.
+        return None
+    return pool
+
+
+def redis_backend():
+    from ..backends.pyredis import RedisBackend
+    return RedisBackend(connection_pool=redis_pool(),
+                        prefix=b'gimlet-bench.')
+
+
+def redis_hash_backend():
+    from ..backends.pyredis import RedisHashBackend
+    return RedisHashBackend(connection_pool=redis_pool(),
+                            prefix=b'gimlet-bench.')
+
+
+def cached_sqlite_backend():
+    from ..backends.cached import CachedBackend
+    return CachedBackend(sqlite_backend())
+
+
+def aead_available():
+    try:
+        import cryptography  # noqa
+    except ImportError:
+        return False
+    return True
+
+
+def backends():
+    """Return the backends which can run here, by name."""
+    available = OrderedDict([
+        ('dict', DictBackend),
+        ('sqlite', sqlite_backend),
+        ('cached-sqlite', cached_sqlite_backend),
+    ])
+    if redis_pool() is not None:
+        available['redis'] = redis_backend
+        available['redis-hash'] = redis_hash_backend
+    return available
+
+
+def cases():
+    """Return every case as ``(name, setup)`` pairs."""
+    for size in SIZES:
+        yield ('serializer.dumps[%s]' % size,
+               lambda size=size: serializer_dumps(size))
+        yield ('serializer.loads[%s]' % size,
+               lambda size=size: serializer_loads(size))
+        yield ('serializer.dumps.encrypted[%s]' % size,
+               lambda size=size: serializer_dumps(size, encrypted=True))
+        yield ('serializer.loads.encrypted[%s]' % size,
+               lambda size=size: serializer_loads(size, encrypted=True))
+        if aead_available():
+            yield ('serializer.dumps.aes-gcm[%s]' % size,
+                   lambda size=size: serializer_dumps(size, encrypted=True,
+                                                      cipher='aes-gcm'))
+            yield ('serializer.loads.aes-gcm[%s]' % size,
+                   lambda size=size: serializer_loads(size, encrypted=True,
+                                                      cipher='aes-gcm'))
+        yield ('session.load[%s]' % size,
+               lambda size=size: session_load(size))
+        yield ('session.get[%s]' % size,
+               lambda size=size: session_get(size))
+        yield ('session.set[%s]' % size,
+               lambda size=size: session_set(size))
+        yield ('middleware.request[%s]' % size,
+               lambda size=size: middleware_request(size))
+    for name, make_backend in backends().items():
+        for op, setup in (('get', backend_get), ('set', backend_set),
+                          ('update', backend_update)):
+            for size in SIZES:
+                yield ('backend.%s.%s[%s]' % (name, op, size),
+                       lambda setup=setup, make_backend=make_backend,
+                       size=size: setup(make_backend, size))
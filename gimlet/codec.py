@@ -0,0 +1,227 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import json
+import zlib
+
+import six
+from six.moves import cPickle as pickle
+
+
+class PickleNotAccepted(ValueError):
+    """Raised when decoding a pickled payload with pickles disabled."""
+
+
+class Codec(object):
+
+    """Converts session data to bytes and back.
+
+    Encoded payloads start with the codec's ``tag`` byte, so that data
+    written with one codec can still be read after switching to another.
+    Payloads with no recognized tag are treated as pickles, which is how
+    all data was stored before codecs were introduced. Tags are control
+    characters, which no pickle can start with.
+    """
+
+    name = None
+    tag = None
+
+    def dumps(self, value):
+        raise NotImplementedError
+
+    def loads(self, raw):
+        raise NotImplementedError
+
+
+class PickleCodec(Codec):
+
+    # Pickles are written untagged, so that they remain readable by older
+    # versions of gimlet.
+    name = 'pickle'
+
+    def dumps(self, value):
+        return pickle.dumps(value)
+
+    def loads(self, raw):
+        return pickle.loads(raw)
+
+
+class JSONCodec(Codec):
+
+    name = 'json'
+    tag = b'\x01'
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, raw):
+        return json.loads(raw.decode('utf-8'))
+
+
+class MsgpackCodec(Codec):
+
+    name = 'msgpack'
+    tag = b'\x02'
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def dumps(self, value):
+        return self.msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, raw):
+        return self.msgpack.unpackb(raw, raw=False)
+
+
+class Compressor(object):
+
+    """Compresses encoded payloads.
+
+    Compressed payloads start with the compressor's ``tag`` byte, which is
+    distinct from every codec tag, so compressed and uncompressed payloads
+    can be mixed freely.
+    """
+
+    name = None
+    tag = None
+
+    def compress(self, raw):
+        raise NotImplementedError
+
+    def decompress(self, raw):
+        raise NotImplementedError
+
+
+class ZlibCompressor(Compressor):
+
+    name = 'zlib'
+    tag = b'\x10'
+
+    def compress(self, raw):
+        return zlib.compress(raw)
+
+    def decompress(self, raw):
+        return zlib.decompress(raw)
+
+
+class ZstdCompressor(Compressor):
+
+    name = 'zstd'
+    tag = b'\x11'
+
+    def __init__(self):
+        import zstandard
+        self.compressor = zstandard.ZstdCompressor()
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, raw):
+        return self.compressor.compress(raw)
+
+    def decompress(self, raw):
+        return self.decompressor.decompress(raw)
+
+
+class LZ4Compressor(Compressor):
+
+    name = 'lz4'
+    tag = b'\x12'
+
+    def __init__(self):
+        import lz4.frame
+        self.frame = lz4.frame
+
+    def compress(self, raw):
+        return self.frame.compress(raw)
+
+    def decompress(self, raw):
+        return self.frame.decompress(raw)
+
+
+codec_classes = dict((cls.name, cls) for cls in
+                     (PickleCodec, JSONCodec, MsgpackCodec))
+
+codec_tags = dict((cls.tag, cls.name) for cls in codec_classes.values()
+                  if cls.tag)
+
+compressor_classes = dict((cls.name, cls) for cls in
+                          (ZlibCompressor, ZstdCompressor, LZ4Compressor))
+
+compressor_tags = dict((cls.tag, cls.name) for cls in
+                       compressor_classes.values())
+
+# Payloads smaller than this many bytes aren't worth compressing.
+DEFAULT_COMPRESS_THRESHOLD = 1024
+
+_instances = {}
+
+
+def _get_instance(cls):
+    if cls not in _instances:
+        _instances[cls] = cls()
+    return _instances[cls]
+
+
+def get_codec(codec):
+    """Return a :class:`Codec` instance, given either an instance or the
+    name of a built-in codec."""
+    if isinstance(codec, Codec):
+        return codec
+    if isinstance(codec, six.string_types):
+        try:
+            cls = codec_classes[codec]
+        except KeyError:
+            raise ValueError('unknown codec %r, must be one of: %s' %
+                             (codec, ', '.join(sorted(codec_classes))))
+        return _get_instance(cls)
+    raise ValueError('codec must be a Codec instance or name')
+
+
+def get_compressor(compressor):
+    """Return a :class:`Compressor` instance, given either an instance or
+    the name of a built-in compressor."""
+    if isinstance(compressor, Compressor):
+        return compressor
+    if isinstance(compressor, six.string_types):
+        try:
+            cls = compressor_classes[compressor]
+        except KeyError:
+            raise ValueError('unknown compressor %r, must be one of: %s' %
+                             (compressor,
+                              ', '.join(sorted(compressor_classes))))
+        return _get_instance(cls)
+    raise ValueError('compressor must be a Compressor instance or name')
+
+
+def encode(value, codec=None, compressor=None,
+           compress_threshold=DEFAULT_COMPRESS_THRESHOLD):
+    """Encode ``value`` with ``codec``, which defaults to pickle.
+
+    If a ``compressor`` is given, payloads of at least
+    ``compress_threshold`` bytes are compressed, unless that doesn't make
+    them any smaller.
+    """
+    codec = get_codec(codec or 'pickle')
+    raw = codec.dumps(value)
+    if codec.tag:
+        raw = codec.tag + raw
+    if compressor is not None and len(raw) >= compress_threshold:
+        compressor = get_compressor(compressor)
+        compressed = compressor.tag + compressor.compress(raw)
+        if len(compressed) < len(raw):
+            raw = compressed
+    return raw
+
+
+def decode(raw, accept_pickle=True):
+    """Decode a payload written by :func:`encode` with any codec and
+    compressor. Unless ``accept_pickle`` is true, pickled payloads raise
+    :class:`PickleNotAccepted` rather than being unpickled."""
+    name = compressor_tags.get(raw[:1])
+    if name is not None:
+        raw = get_compressor(name).decompress(raw[1:])
+    name = codec_tags.get(raw[:1])
+    if name is None:
+        if not accept_pickle:
+            raise PickleNotAccepted('pickled payloads are not accepted')
+        return get_codec('pickle').loads(raw)
+    return get_codec(name).loads(raw[1:])
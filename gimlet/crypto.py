@@ -1,26 +1,54 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 import binascii
+import hashlib
+import os
+
+import six
+
+
+RECOMMENDED = ("The recommended method for generating the key is "
+               "hexlify(os.urandom(32)).")
+
+
+def parse_key(key, sizes=(16, 24, 32)):
+    """Convert a hex encryption key to bytes, checking its length."""
+    try:
+        key = binascii.unhexlify(key)
+    except (TypeError, ValueError):
+        raise ValueError("Encryption key must be 64 hex digits (32 bytes"
+                         "). " + RECOMMENDED)
+
+    if len(key) not in sizes:
+        raise ValueError("Encryption key must be %s bytes. " %
+                         ' or '.join(str(size) for size in sizes) +
+                         RECOMMENDED)
+    return key
+
+
+class DecryptionError(ValueError):
+    """A payload couldn't be decrypted and authenticated."""
 
 
 class Crypter(object):
-    recommended = ("The recommended method for generating the key is "
-                   "hexlify(os.urandom(32)).")
 
-    def __init__(self, key):
-        from Crypto.Cipher import AES
+    """Encrypt with AES in ECB mode, padding with NUL bytes.
 
-        try:
-            key = binascii.unhexlify(key)
-        except TypeError:
-            raise ValueError("Encryption key must be 64 hex digits (32 bytes"
-                             "). " + self.recommended)
+    This is unauthenticated, so cookies encrypted with it must also be
+    signed, and trailing NUL bytes are lost. It is kept so that existing
+    cookies can still be read; new deployments should use
+    :class:`AEADCrypter`.
+    """
+
+    recommended = RECOMMENDED
+
+    # Whether decryption also verifies the payload.
+    authenticated = False
 
-        if len(key) not in (16, 24, 32):
-            raise ValueError("Encryption key must be 16, 24, or 32 bytes. " +
-                             self.recommended)
+    def __init__(self, key):
+        from Crypto.Cipher import AES
 
-        self.aes = AES.new(key, AES.MODE_ECB)
+        self.aes = AES.new(parse_key(key), AES.MODE_ECB)
 
     def pad(self, cleartext):
         extra = 16 - (len(cleartext) % 16)
@@ -35,3 +63,114 @@ class Crypter(object):
 
     def decrypt(self, ciphertext):
         return self.unpad(self.aes.decrypt(ciphertext))
+
+
+class AEADCrypter(object):
+
+    """Encrypt and authenticate in one pass with AES-GCM or
+    ChaCha20-Poly1305, using :mod:`cryptography`.
+
+    ``keys`` is a hex key or a list of them: the first is used to encrypt,
+    and all of them to decrypt, so keys can be rotated by adding a new one
+    at the front and dropping the old one once its cookies have expired.
+    ChaCha20-Poly1305 needs 32 byte keys.
+
+    Payloads are enveloped as a version byte, which names the cipher, a
+    key id, which picks the key to decrypt with, and a random nonce,
+    followed by the ciphertext and tag.
+    """
+
+    authenticated = True
+
+    ciphers = {
+        'aes-gcm': b'\x01',
+        'chacha20-poly1305': b'\x02',
+    }
+
+    key_id_size = 4
+    nonce_size = 12
+    tag_size = 16
+
+    def __init__(self, keys, cipher='aes-gcm'):
+        from cryptography.hazmat.primitives.ciphers.aead import (
+            AESGCM, ChaCha20Poly1305)
+
+        if cipher not in self.ciphers:
+            raise ValueError('unknown cipher %r, must be one of: %s' %
+                             (cipher, ', '.join(sorted(self.ciphers))))
+        if isinstance(keys, six.string_types + (bytes,)):
+            keys = [keys]
+        if not keys:
+            raise ValueError('at least one encryption key is required')
+
+        self.version = self.ciphers[cipher]
+        self.keys = []
+        self.aeads = {}
+        for key in keys:
+            key = parse_key(key)
+            if cipher == 'chacha20-poly1305' and len(key) != 32:
+                raise ValueError("ChaCha20-Poly1305 keys must be 32 bytes. " +
+                                 RECOMMENDED)
+            key_id = hashlib.sha256(key).digest()[:self.key_id_size]
+            self.keys.append((key_id, key))
+            # Payloads written with either cipher can be read.
+            self.aeads[(self.ciphers['aes-gcm'], key_id)] = AESGCM(key)
+            if len(key) == 32:
+                self.aeads[(self.ciphers['chacha20-poly1305'], key_id)] = \
+                    ChaCha20Poly1305(key)
+        self.key_id = self.keys[0][0]
+        self.header = self.version + self.key_id
+        self.aead = self.aeads[(self.version, self.key_id)]
+        self.legacy = None
+
+    def encrypt(self, cleartext):
+        nonce = os.urandom(self.nonce_size)
+        return (self.header + nonce +
+                self.aead.encrypt(nonce, cleartext, self.header))
+
+    def decrypt(self, envelope):
+        from cryptography.exceptions import InvalidTag
+
+        split = 1 + self.key_id_size
+        if len(envelope) < split + self.nonce_size + self.tag_size:
+            raise DecryptionError('payload is too short')
+        header = envelope[:split]
+        aead = self.aeads.get((header[:1], header[1:]))
+        if aead is None:
+            raise DecryptionError('unknown cipher or key')
+        nonce = envelope[split:split + self.nonce_size]
+        try:
+            return aead.decrypt(nonce, envelope[split + self.nonce_size:],
+                                header)
+        except (InvalidTag, ValueError):
+            raise DecryptionError('payload failed authentication')
+
+    def legacy_decryptions(self, ciphertext):
+        """Yield the AES-ECB decryption of ``ciphertext`` with each key, to
+        read payloads written by :class:`Crypter`. Nothing is yielded if
+        pycrypto isn't installed."""
+        if self.legacy is None:
+            try:
+                self.legacy = [Crypter(binascii.hexlify(key))
+                               for key_id, key in self.keys]
+            except ImportError:
+                self.legacy = []
+        for crypter in self.legacy:
+            try:
+                yield crypter.decrypt(ciphertext)
+            except ValueError:
+                # Not a whole number of blocks.
+                return
+
+
+def make_crypter(keys, cipher=None):
+    """Return a crypter for ``keys``, a hex key or list of them, using
+    ``cipher``: ``aes-gcm``, ``chacha20-poly1305`` or, the default for
+    compatibility, ``aes-ecb``, which only supports a single key."""
+    if isinstance(keys, six.string_types + (bytes,)):
+        keys = [keys]
+    if cipher in (None, 'aes-ecb'):
+        if len(keys) != 1:
+            raise ValueError('multiple encryption keys need an AEAD cipher')
+        return Crypter(keys[0])
+    return AEADCrypter(keys, cipher)
@@ -2,10 +2,13 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 from datetime import datetime
 
-from .crypto import Crypter
+from .backends.base import BaseBackend
+from .codec import get_codec, get_compressor, DEFAULT_COMPRESS_THRESHOLD
+from .crypto import make_crypter
 from .serializer import URLSafeCookieSerializer
 from .session import Session
 from .util import parse_settings
+from .writer import BackgroundWriter
 
 
 def session_factory_factory(secret,
@@ -14,8 +17,36 @@ def session_factory_factory(secret,
                             cookie_name_temporary='gimlet-n',
                             cookie_name_permanent='gimlet-p',
                             encryption_key=None,
-                            permanent=False):
-    """Configure a :class:`.session.Session` subclass."""
+                            cipher=None,
+                            permanent=False,
+                            ttl=None,
+                            refresh_interval=None,
+                            codec=None,
+                            accept_pickle=True,
+                            compressor=None,
+                            compress_threshold=None,
+                            compress_encrypted=False,
+                            background_writes=False,
+                            writer_threads=1,
+                            writer_queue_size=1000,
+                            writer_timeout=None,
+                            observer=None,
+                            cookie_chunk_size=None):
+    """Configure a :class:`.session.Session` subclass.
+
+    The options are described under :ref:`configuration` in the docs:
+
+    - ``secret``: a secret, or list of them to rotate, to sign cookies.
+    - ``encryption_key``, ``cipher``: encrypt cookies.
+    - ``ttl``, ``refresh_interval``: session expiry.
+    - ``codec``, ``accept_pickle``: how payloads are encoded.
+    - ``compressor``, ``compress_threshold``, ``compress_encrypted``:
+      payload compression.
+    - ``background_writes``, ``writer_threads``, ``writer_queue_size``,
+      ``writer_timeout``: write to the backend off the request thread.
+    - ``cookie_chunk_size``: split long cookies.
+    - ``observer``: an :class:`.instrumentation.Observer` for metrics.
+    """
     if backend is None:
         if clientside is False:
             raise ValueError('cannot configure default of clientside=False '
@@ -25,10 +56,29 @@ def session_factory_factory(secret,
         clientside = bool(clientside)
 
     if encryption_key:
-        crypter = Crypter(encryption_key)
+        crypter = make_crypter(encryption_key, cipher)
     else:
         crypter = None
 
+    if codec is not None:
+        codec = get_codec(codec)
+    if not accept_pickle and (codec is None or codec.tag is None):
+        raise ValueError('accept_pickle can only be disabled with a codec '
+                         'other than pickle')
+    if compressor is not None:
+        compressor = get_compressor(compressor)
+    if isinstance(backend, BaseBackend):
+        backend.set_defaults(ttl=ttl, codec=codec, compressor=compressor,
+                             compress_threshold=compress_threshold,
+                             observer=observer)
+    if compress_threshold is None:
+        compress_threshold = DEFAULT_COMPRESS_THRESHOLD
+
+    writer = None
+    if background_writes and backend is not None:
+        writer = BackgroundWriter(writer_threads, writer_queue_size,
+                                  writer_timeout)
+
     future = datetime.fromtimestamp(0x7FFFFFFF)
 
     configuration = {
@@ -46,12 +96,27 @@ def session_factory_factory(secret,
             'clientside': clientside,
         },
 
-        'serializer': URLSafeCookieSerializer(secret, backend, crypter),
+        'serializer': URLSafeCookieSerializer(
+            secret, backend, crypter, codec, compressor, compress_threshold,
+            accept_pickle, compress_encrypted),
+
+        'ttl': ttl,
+
+        'refresh_interval': refresh_interval,
+
+        'writer': writer,
+
+        'observer': observer,
+
+        'cookie_chunk_size': cookie_chunk_size,
     }
 
     configuration['channel_names']['perm'] = cookie_name_permanent
     configuration['channel_names']['nonperm'] = cookie_name_temporary
-    configuration['channel_opts']['perm'] = {'expires': future}
+    if ttl:
+        configuration['channel_opts']['perm'] = {'max_age': ttl}
+    else:
+        configuration['channel_opts']['perm'] = {'expires': future}
     configuration['channel_opts']['nonperm'] = {}
 
     return type(str('SessionFactory'), (Session,), configuration)
@@ -0,0 +1,136 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+
+def backend_name(backend):
+    return type(backend).__name__
+
+
+class Observer(object):
+
+    """Receives measurements of the work gimlet does for each request.
+
+    Pass an instance as the ``observer`` option of
+    :func:`.factories.session_factory_factory`. Every method does nothing,
+    so subclasses only need to override the ones they're interested in.
+    When no observer is configured, nothing is measured at all.
+
+    Methods are called from whichever thread did the work, including
+    background writer threads, so they should be thread-safe.
+    """
+
+    def backend_call(self, backend, operation, seconds):
+        """A call to ``backend`` took ``seconds``. ``operation`` is one of
+        ``read``, ``get_field``, ``has_field``, ``field_count``, ``write``
+        (a whole session), ``update`` or ``touch``. Writes handed to a
+        background writer are timed by how long it took to queue them.
+        """
+
+    def payload(self, backend, operation, size):
+        """``backend`` serialized (``write``) or deserialized (``read``)
+        ``size`` bytes of session data: a whole session, or one field for
+        backends which store fields separately."""
+
+    def cookie(self, name, size):
+        """A cookie ``name`` of ``size`` bytes was set on the response."""
+
+    def bad_signature(self, name):
+        """The cookie ``name`` failed verification, and was discarded."""
+
+    def cache(self, backend, hit):
+        """A caching ``backend`` found (or didn't find) a session."""
+
+    def request(self, backend_calls):
+        """A request which used the session finished, having made
+        ``backend_calls`` calls to the backend, which may be zero."""
+
+
+class StatsdObserver(Observer):
+
+    """Send measurements to statsd, using a client with the interface of
+    :class:`statsd.StatsClient`. Sizes are sent as timers, since plain
+    statsd has no histogram type and timers give percentiles.
+    """
+
+    def __init__(self, client, prefix='gimlet'):
+        self.client = client
+        self.prefix = prefix
+
+    def stat(self, *parts):
+        return '.'.join((self.prefix,) + parts)
+
+    def backend_call(self, backend, operation, seconds):
+        self.client.timing(self.stat('backend', backend_name(backend),
+                                     operation), seconds * 1000)
+
+    def payload(self, backend, operation, size):
+        self.client.timing(self.stat('payload', backend_name(backend),
+                                     operation), size)
+
+    def cookie(self, name, size):
+        self.client.timing(self.stat('cookie', name), size)
+
+    def bad_signature(self, name):
+        self.client.incr(self.stat('bad_signature', name))
+
+    def cache(self, backend, hit):
+        self.client.incr(self.stat('cache', backend_name(backend),
+                                   'hit' if hit else 'miss'))
+
+    def request(self, backend_calls):
+        self.client.incr(self.stat('requests',
+                                   'backend' if backend_calls else
+                                   'no_backend'))
+
+
+class PrometheusObserver(Observer):
+
+    """Record measurements as :mod:`prometheus_client` metrics, registered
+    with ``registry`` (the default registry if None)."""
+
+    def __init__(self, registry=None, namespace='gimlet'):
+        from prometheus_client import REGISTRY, Counter, Histogram
+        if registry is None:
+            registry = REGISTRY
+        opts = dict(namespace=namespace, registry=registry)
+        size_buckets = (64, 256, 1024, 2048, 4096, 16384, 65536, 262144,
+                        1048576)
+        self.backend_seconds = Histogram(
+            'backend_seconds', 'Time spent in session backend calls',
+            ['backend', 'operation'], **opts)
+        self.payload_bytes = Histogram(
+            'payload_bytes', 'Size of serialized sessions in backends',
+            ['backend', 'operation'], buckets=size_buckets, **opts)
+        self.cookie_bytes = Histogram(
+            'cookie_bytes', 'Size of session cookies set', ['cookie'],
+            buckets=size_buckets, **opts)
+        self.bad_signatures = Counter(
+            'bad_signatures', 'Session cookies which failed verification',
+            ['cookie'], **opts)
+        self.cache_lookups = Counter(
+            'cache_lookups', 'Session lookups in caching backends',
+            ['backend', 'result'], **opts)
+        self.requests = Counter(
+            'requests', 'Requests which used the session',
+            ['backend_used'], **opts)
+
+    def backend_call(self, backend, operation, seconds):
+        self.backend_seconds.labels(backend_name(backend),
+                                    operation).observe(seconds)
+
+    def payload(self, backend, operation, size):
+        self.payload_bytes.labels(backend_name(backend),
+                                  operation).observe(size)
+
+    def cookie(self, name, size):
+        self.cookie_bytes.labels(name).observe(size)
+
+    def bad_signature(self, name):
+        self.bad_signatures.labels(name).inc()
+
+    def cache(self, backend, hit):
+        self.cache_lookups.labels(backend_name(backend),
+                                  'hit' if hit else 'miss').inc()
+
+    def request(self, backend_calls):
+        self.requests.labels('true' if backend_calls else 'false').inc()
@@ -1,51 +1,185 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 import binascii
+import hashlib
 
-from six.moves import cPickle as pickle
-
+from collections import OrderedDict
 from struct import Struct
 
-from itsdangerous import Serializer, URLSafeSerializerMixin
+from itsdangerous import (BadData, BadSignature, Serializer,
+                          URLSafeSerializerMixin, base64_decode,
+                          base64_encode, want_bytes)
+
+import six
+
+from .codec import (encode, decode, PickleNotAccepted,
+                    DEFAULT_COMPRESS_THRESHOLD)
+from .compat import to_native_str
+from .crypto import DecryptionError
 
 
 class CookieSerializer(Serializer):
     packer = Struct(str('16si'))
 
-    def __init__(self, secret, backend, crypter):
-        Serializer.__init__(self, secret)
+    # Marks cookies encrypted with an authenticated cipher, which aren't
+    # signed. It can't start a signed cookie, which is URL-safe base64, or
+    # '.' if compressed.
+    aead_prefix = '~'
+
+    # Separates the id of the secret a cookie was signed with from the
+    # signed value, which never contains it.
+    key_id_sep = '!'
+
+    def __init__(self, secret, backend, crypter, codec=None, compressor=None,
+                 compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                 accept_pickle=True, compress_encrypted=False):
+        # ``secret`` may be a list: the first signs, and all of them verify.
+        if isinstance(secret, six.string_types + (bytes,)):
+            secret = [secret]
+        if not secret:
+            raise ValueError('at least one secret is required')
+        Serializer.__init__(self, secret[0])
+        self.secrets = OrderedDict((self.key_id(want_bytes(s)),
+                                    want_bytes(s)) for s in secret)
+        self.current_key_id = next(iter(self.secrets))
         self.backend = backend
         self.crypter = crypter
+        self.codec = codec
+        self.compressor = compressor
+        self.compress_threshold = compress_threshold
+        self.accept_pickle = accept_pickle
+        self.compress_encrypted = compress_encrypted
+
+    @property
+    def aead(self):
+        return (self.crypter is not None) and self.crypter.authenticated
+
+    @staticmethod
+    def key_id(secret):
+        return to_native_str(base64_encode(
+            hashlib.sha256(b'gimlet.key-id' + secret).digest()[:3]))
+
+    def make_signer(self, salt=None, secret=None):
+        if salt is None:
+            salt = self.salt
+        if secret is None:
+            secret = self.secret_key
+        return self.signer(secret, salt=salt, **self.signer_kwargs)
+
+    def dumps(self, channel, salt=None):
+        """
+        Convert a SessionChannel into a cookie value.
+        """
+        return self.dumps_packed(self.pack(channel), salt)
+
+    def dumps_packed(self, payload, salt=None):
+        """
+        Convert a payload from :meth:`pack` into a cookie value. With an
+        authenticated cipher the encrypted payload is used as is, since
+        signing it as well would be redundant. Otherwise it is signed with
+        the first secret, and prefixed with its id.
+        """
+        if self.aead:
+            payload = self.crypter.encrypt(payload)
+            return self.aead_prefix + to_native_str(base64_encode(payload))
+        return (self.current_key_id + self.key_id_sep +
+                Serializer.dumps(self, payload, salt))
+
+    def loads(self, s, salt=None):
+        """
+        Convert a cookie value into the id, created timestamp and client data
+        of a SessionChannel.
+        """
+        return self.unpack(self.loads_packed(s, salt))
+
+    def loads_packed(self, s, salt=None):
+        """
+        Verify and decrypt a cookie value, returning the payload as it was
+        given to :meth:`dumps_packed`.
+        """
+        s = to_native_str(s)
+        if self.aead and s.startswith(self.aead_prefix):
+            try:
+                payload = base64_decode(s[len(self.aead_prefix):])
+                return self.crypter.decrypt(payload)
+            except (BadData, DecryptionError) as e:
+                raise BadSignature(str(e))
+        key_id, sep, signed = s.rpartition(self.key_id_sep)
+        if sep:
+            try:
+                secret = self.secrets[key_id]
+            except KeyError:
+                raise BadSignature('unknown secret %r' % key_id)
+            return self.load_payload(
+                self.make_signer(salt, secret).unsign(want_bytes(signed)))
+        # Cookies from before key ids were added could have been signed
+        # with any of the secrets.
+        for secret in self.secrets.values():
+            try:
+                payload = self.make_signer(salt, secret).unsign(
+                    want_bytes(signed))
+            except BadSignature as e:
+                error = e
+            else:
+                return self.load_payload(payload)
+        raise error
 
     def load_payload(self, payload):
         """
-        Convert a cookie into a SessionChannel instance.
+        Decrypt the payload of a signed cookie, if necessary.
+        """
+        if not self.crypter:
+            return payload
+        if not self.crypter.authenticated:
+            return self.crypter.decrypt(payload)
+        # Written with AES-ECB before switching to an authenticated cipher.
+        # The signature shows we wrote it, but not with which key.
+        for cleartext in self.crypter.legacy_decryptions(payload):
+            try:
+                self.unpack(cleartext)
+            except Exception:
+                pass
+            else:
+                return cleartext
+        raise BadSignature('legacy cookie could not be decrypted')
+
+    def dump_payload(self, payload):
+        """
+        Encrypt the payload of a signed cookie, if necessary.
         """
         if self.crypter:
-            payload = self.crypter.decrypt(payload)
+            payload = self.crypter.encrypt(payload)
+        return payload
 
+    def unpack(self, payload):
         raw_id, created_timestamp = \
             self.packer.unpack(payload[:self.packer.size])
-        client_data_pkl = payload[self.packer.size:]
+        client_data_raw = payload[self.packer.size:]
 
         id = binascii.hexlify(raw_id)
-        client_data = pickle.loads(client_data_pkl)
+        try:
+            client_data = decode(client_data_raw, self.accept_pickle)
+        except PickleNotAccepted as e:
+            raise BadSignature(str(e))
         return id, created_timestamp, client_data
 
-    def dump_payload(self, channel):
+    def pack(self, channel):
         """
-        Convert a Session instance into a cookie by packing it precisely into a
-        string.
+        Pack a SessionChannel precisely into a string.
         """
-        client_data_pkl = pickle.dumps(channel.client_data)
+        # Compression happens before encryption, since ciphertext doesn't
+        # compress. Then the length of the cookie depends on how much of its
+        # content repeats, which can leak secrets in it to anyone able to
+        # add their own guesses to it (as in CRIME), so encrypted cookies
+        # are only compressed if ``compress_encrypted`` is set.
+        compressor = self.compressor
+        if self.crypter is not None and not self.compress_encrypted:
+            compressor = None
+        client_data_raw = encode(channel.cookie_data, self.codec,
+                                 compressor, self.compress_threshold)
         raw_id = binascii.unhexlify(channel.id)
-        payload = (self.packer.pack(raw_id, channel.created_timestamp) +
-                   client_data_pkl)
-
-        if self.crypter:
-            payload = self.crypter.encrypt(payload)
-
-        return payload
+        return (self.packer.pack(raw_id, channel.created_timestamp) +
+                client_data_raw)
 
 
 class URLSafeCookieSerializer(URLSafeSerializerMixin, CookieSerializer):
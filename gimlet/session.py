@@ -9,11 +9,14 @@ import time
 
 from binascii import hexlify
 from datetime import datetime
+from timeit import default_timer
 from collections import MutableMapping
 
 from itsdangerous import BadSignature
 
+from .backends.base import BaseBackend
 from .compat import to_native_str
+from .writer import apply_write
 
 log = logging.getLogger('gimlet')
 
@@ -22,10 +25,27 @@ log = logging.getLogger('gimlet')
 # passed.
 DEFAULT = object()
 
+# Client data key used to carry :attr:`SessionChannel.refreshed_timestamp`
+# in the cookie. It is hidden from the session itself.
+REFRESHED_KEY = '_gimlet_refreshed_'
+
+# Separates the number of chunks from the rest of the first chunk of a cookie
+# split by :meth:`Session.set_cookie`. It never appears in cookie values.
+CHUNK_COUNT_SEP = '*'
+
+
+def chunk_name(name, index):
+    return '%s.%d' % (name, index)
+
 
 class Session(MutableMapping):
 
-    """Abstract front end for multiple session channels."""
+    """Abstract front end for multiple session channels.
+
+    Channels are read from the request cookies lazily, the first time they
+    are needed, so a request which never touches the session doesn't pay to
+    verify or decode its cookies, and doesn't have any cookies set.
+    """
 
     # Subclasses need to define all of these
     backend = abc.abstractproperty
@@ -34,24 +54,50 @@ class Session(MutableMapping):
     defaults = abc.abstractproperty
     serializer = abc.abstractproperty
 
+    # Number of seconds that an idle session lives for, or None to never
+    # expire. If ``refresh_interval`` is set, activity on a session slides its
+    # expiry forward, at most once per ``refresh_interval`` seconds.
+    ttl = None
+    refresh_interval = None
+
+    # A :class:`.writer.BackgroundWriter` to hand backend writes to, so that
+    # responses don't wait for them, or None to write synchronously.
+    writer = None
+
+    # An :class:`.instrumentation.Observer` to report measurements to.
+    observer = None
+
+    # Cookie values longer than this many characters are split across
+    # several cookies, or None to never split them.
+    cookie_chunk_size = None
+
     def __init__(self, request):
         self.request = request
         self.flushed = False
-
-        channels = {}
-        for key in self.channel_names:
-            channels[key] = self.read_channel(key)
-        self.channels = channels
-
-        self.has_backend = all(
-            (ch.backend is not None) for ch in channels.values())
+        self._channels = {}
+        self.has_backend = self.backend is not None
 
         if hasattr(request, 'add_response_callback'):
             request.add_response_callback(self.write_callback)
 
+    def channel(self, key):
+        """Return the channel for ``key``, reading it if necessary."""
+        try:
+            return self._channels[key]
+        except KeyError:
+            channel = self._channels[key] = self.read_channel(key)
+            return channel
+
+    @property
+    def channels(self):
+        """All channels, keyed like :attr:`channel_names`."""
+        for key in self.channel_names:
+            self.channel(key)
+        return self._channels
+
     @property
     def default_channel(self):
-        return self.channels['perm']
+        return self.channel('perm')
 
     @property
     def id(self):
@@ -67,8 +113,15 @@ class Session(MutableMapping):
 
     def write_callback(self, request, response):
         self.flushed = True
-        for key in self.channels:
-            self.write_channel(request, response, key, self.channels[key])
+        # Channels which were never read can't have changed.
+        for key in self.channel_names:
+            if key in self._channels:
+                channel = self._channels[key]
+                self.refresh_channel(channel)
+                self.write_channel(request, response, key, channel)
+        if self.observer is not None and self._channels:
+            self.observer.request(sum(channel.backend_calls for channel
+                                      in self._channels.values()))
 
     def response_callback(self, request, response):
         # This is a noop, but exists for compatibilty with usage of previous
@@ -77,9 +130,9 @@ class Session(MutableMapping):
 
     def __getitem__(self, key):
         """Get value for ``key`` from the first channel it's found in."""
-        for channel in self.channels.values():
+        for name in self.channel_names:
             try:
-                return channel.get(key)
+                return self.channel(name).get(key)
             except KeyError:
                 pass
         raise KeyError(key)
@@ -105,7 +158,7 @@ class Session(MutableMapping):
         else:
             channel_key = 'nonperm'
 
-        return self.channels[channel_key], clientside
+        return self.channel(channel_key), clientside
 
     def get(self, key, default=None, permanent=DEFAULT, clientside=DEFAULT):
         """Get value for ``key`` or ``default`` if ``key`` isn't present.
@@ -137,29 +190,44 @@ class Session(MutableMapping):
         return self.set(key, val)
 
     def set(self, key, val, permanent=None, clientside=None):
-        if key in self:
-            del self[key]
         channel, clientside = self._check_options(permanent, clientside)
+        # Remove any copy of ``key`` stored elsewhere, without reading the
+        # backend now: server-side copies are recorded as deleted, and
+        # resolved when each channel is written (which only avoids reading
+        # with a ``native_update`` backend).
+        for name in self.channel_names:
+            other = self.channel(name)
+            if other is channel:
+                other.discard(key, clientside=not clientside)
+            else:
+                other.discard(key)
         channel.set(key, val, clientside=clientside)
 
         # If the response has already been flushed, we need to explicitly
         # persist this set to the backend.
         if self.flushed:
-            channel.backend_write()
+            for other in self._channels.values():
+                if other.backend_dirty:
+                    other.backend_write(self.writer)
 
     def save(self, permanent=None, clientside=None):
         channel, clientside = self._check_options(permanent, clientside)
         if clientside:
             channel.client_dirty = True
         else:
+            # We don't know which values were mutated in place, so every
+            # key which has been loaded needs to be written back.
+            channel.dirty_keys.update(channel.backend_data)
             channel.backend_dirty = True
 
     def __delitem__(self, key):
-        if key not in self:
-            raise KeyError(key)
+        found = False
         for channel in self.channels.values():
             if key in channel:
-                channel.delete(key)
+                channel.discard(key)
+                found = True
+        if not found:
+            raise KeyError(key)
 
     def __contains__(self, key):
         return any((key in channel) for channel in self.channels.values())
@@ -171,7 +239,7 @@ class Session(MutableMapping):
         return sum([len(ch) for ch in self.channels.values()])
 
     def is_permanent(self, key):
-        return key in self.channels.get('perm', {})
+        return key in self.channel('perm')
 
     def __repr__(self):
         keys = '\n'.join(["-- %s --\n%r" % (k, v) for k, v in
@@ -179,23 +247,79 @@ class Session(MutableMapping):
         return "<Session \n%s\n>" % keys
 
     def make_session_id(self):
+        if isinstance(self.backend, BaseBackend):
+            id = self.backend.make_session_id()
+            if id is not None:
+                return id
         return hexlify(os.urandom(16))
 
+    def read_cookie(self, name):
+        """Return the value of cookie ``name``, reassembled from chunks if
+        it was split by :meth:`set_cookie`, or None if it isn't present."""
+        cookies = self.request.cookies
+        if name in cookies:
+            return cookies[name]
+        first = cookies.get(chunk_name(name, 0))
+        if first is None:
+            return None
+        # The first chunk starts with the number of chunks.
+        count, sep, value = first.partition(CHUNK_COUNT_SEP)
+        if not (sep and count.isdigit()):
+            raise BadSignature('malformed first chunk of %s' % name)
+        parts = [value]
+        for ii in range(1, int(count)):
+            part = cookies.get(chunk_name(name, ii))
+            if part is None:
+                raise BadSignature('missing chunk %d of %s' % (ii, name))
+            parts.append(part)
+        return ''.join(parts)
+
     def read_channel(self, key):
         name = self.channel_names[key]
-        if name in self.request.cookies:
-            try:
-                id, created_timestamp, client_data = \
-                    self.serializer.loads(self.request.cookies[name])
-            except BadSignature as e:
-                log.warn('Request from %s contained bad sig. %s',
-                         self.request.remote_addr, e)
+        try:
+            cookie = self.read_cookie(name)
+            if cookie is None:
                 return self.fresh_channel()
-            else:
-                return SessionChannel(id, created_timestamp, self.backend,
-                                      fresh=False, client_data=client_data)
-        else:
+            payload = self.serializer.loads_packed(cookie)
+            id, created_timestamp, client_data = \
+                self.serializer.unpack(payload)
+        except BadSignature as e:
+            log.warn('Request from %s contained bad sig. %s',
+                     self.request.remote_addr, e)
+            if self.observer is not None:
+                self.observer.bad_signature(name)
             return self.fresh_channel()
+        else:
+            if self.writer is not None and self.has_backend:
+                # Don't read past our own writes which are still queued.
+                self.writer.wait(self.backend, id)
+            channel = SessionChannel(id, created_timestamp, self.backend,
+                                     fresh=False, client_data=client_data,
+                                     observer=self.observer)
+            channel.loaded_payload = payload
+            return channel
+
+    def set_cookie(self, req, resp, key, name, value):
+        """Set cookie ``name`` to ``value``, split into numbered chunks if
+        it is longer than :attr:`cookie_chunk_size`, and delete any chunks
+        of a previous value which are no longer used."""
+        opts = dict(httponly=True, secure=req.scheme == 'https',
+                    **self.channel_opts[key])
+        size = self.cookie_chunk_size
+        if (size is None) or (len(value) <= size):
+            resp.set_cookie(name, value, **opts)
+            count = 0
+        else:
+            parts = [value[ii:ii + size] for ii in range(0, len(value), size)]
+            count = len(parts)
+            parts[0] = '%d%s%s' % (count, CHUNK_COUNT_SEP, parts[0])
+            for ii, part in enumerate(parts):
+                resp.set_cookie(chunk_name(name, ii), part, **opts)
+            if name in req.cookies:
+                resp.delete_cookie(name)
+        while chunk_name(name, count) in req.cookies:
+            resp.delete_cookie(chunk_name(name, count))
+            count += 1
 
     def write_channel(self, req, resp, key, channel):
         name = self.channel_names[key]
@@ -204,26 +328,48 @@ class Session(MutableMapping):
         # - data has been changed on the client
         # OR
         # - the cookie is fresh
+        # AND
+        # - the payload differs from the one the client already has
         if channel.client_dirty or channel.fresh:
-            resp.set_cookie(name,
-                            self.serializer.dumps(channel),
-                            httponly=True,
-                            secure=req.scheme == 'https',
-                            **self.channel_opts[key])
+            payload = self.serializer.pack(channel)
+            if payload != channel.loaded_payload:
+                cookie = self.serializer.dumps_packed(payload)
+                if self.observer is not None:
+                    self.observer.cookie(name, len(cookie))
+                self.set_cookie(req, resp, key, name, cookie)
 
         # Write to the backend IFF the following conditions:
         # - data has been changed on the backend
         if channel.backend_dirty:
-            channel.backend_write()
+            channel.backend_write(self.writer)
+
+    def refresh_channel(self, channel):
+        """Slide the expiry of ``channel`` forward, if it's due.
+
+        The cookie is re-issued with a new max age, and the backend's
+        expiry is reset without rewriting the data (unless the data is going
+        to be written anyway).
+        """
+        if channel.fresh or not (self.ttl and self.refresh_interval):
+            return
+        now = int(time.time())
+        if now - channel.refreshed_timestamp < self.refresh_interval:
+            return
+        channel.refreshed_timestamp = now
+        channel.client_dirty = True
+        if isinstance(channel.backend, BaseBackend) and \
+                not channel.backend_dirty:
+            channel.call_backend('touch', channel.backend.touch, channel.id)
 
     def fresh_channel(self):
         return SessionChannel(
-            self.make_session_id(), int(time.time()), self.backend, fresh=True)
+            self.make_session_id(), int(time.time()), self.backend, fresh=True,
+            observer=self.observer)
 
     def invalidate(self):
         self.clear()
-        for key in self.channels:
-            self.channels[key] = self.fresh_channel()
+        for key in self.channel_names:
+            self._channels[key] = self.fresh_channel()
 
     # Flash & CSRF methods taken directly from pyramid_beaker.
     # These are part of the Pyramid Session API.
@@ -256,8 +402,11 @@ class Session(MutableMapping):
 class SessionChannel(object):
 
     def __init__(self, id, created_timestamp, backend, fresh,
-                 client_data=None):
+                 client_data=None, observer=None):
         self.dirty_keys = set()
+        self.observer = observer
+        # Number of calls made to the backend.
+        self.backend_calls = 0
         self.id = id
         self.created_timestamp = created_timestamp
         self.backend = backend
@@ -265,37 +414,150 @@ class SessionChannel(object):
 
         self.client_data = client_data or {}
         self.client_dirty = False
+        # The packed cookie payload this channel was read from, if any.
+        self.loaded_payload = None
+        self.refreshed_timestamp = self.client_data.pop(REFRESHED_KEY,
+                                                        created_timestamp)
 
         self.backend_data = {}
         self.backend_dirty = False
-        self.backend_loaded = False
+        # A fresh channel can't have anything stored for it yet.
+        self.backend_loaded = fresh
+        # With a backend supporting compare and set, the version of the
+        # stored session, if ``versioned`` is set.
+        self.backend_version = None
+        self.versioned = fresh
+
+    @property
+    def native_fields(self):
+        return ((not self.backend_loaded) and
+                getattr(self.backend, 'native_fields', False))
+
+    def call_backend(self, operation, func, *args):
+        """Call ``func``, timing it if there is an observer."""
+        self.backend_calls += 1
+        observer = self.observer
+        if observer is None:
+            return func(*args)
+        start = default_timer()
+        try:
+            return func(*args)
+        finally:
+            observer.backend_call(self.backend, operation,
+                                  default_timer() - start)
 
     def backend_read(self):
         if (not self.backend_loaded) and (self.backend is not None):
             try:
-                self.backend_data = self.backend[self.id]
+                if getattr(self.backend, 'native_cas', False):
+                    data, self.backend_version = self.call_backend(
+                        'read', self.backend.get_versioned, self.id)
+                else:
+                    data = self.call_backend('read', self.backend.__getitem__,
+                                             self.id)
             except KeyError:
-                self.backend_data = {}
+                data = {}
+                self.backend_version = None
+            self.versioned = True
+            # Local changes which haven't been written yet take precedence
+            # over what is stored.
+            for k in list(self.dirty_keys):
+                if k in self.backend_data:
+                    data[k] = self.backend_data[k]
+                elif k in data:
+                    del data[k]
+                else:
+                    # Deleted, but there was nothing stored to delete.
+                    self.dirty_keys.discard(k)
+            self.backend_data = data
             self.backend_loaded = True
 
-    def backend_write(self):
-        self.backend[self.id] = self.backend_data
+    def backend_write(self, writer=None):
+        """Write pending changes to the backend, or queue them with
+        ``writer`` if one is given."""
+        if not self.dirty_keys:
+            self.backend_dirty = False
+            return
+        backend = self.backend
+        data = self.backend_data
+        write = None
+        if self.backend_loaded and not getattr(backend, 'native_update',
+                                               False):
+            if not getattr(backend, 'native_cas', False):
+                # We already hold the complete session, so writing it back
+                # whole is no more expensive than a read-modify-write.
+                write = (data, None, None)
+            elif self.versioned and writer is None:
+                # Write it back whole, unless another request has written
+                # it since we read it, in which case only our own changes
+                # are applied on top of what it wrote.
+                self.versioned = False
+                if self.call_backend('write', backend.compare_and_set,
+                                     self.id, data, self.backend_version):
+                    self.dirty_keys.clear()
+                    self.backend_dirty = False
+                    return
+        if write is None:
+            changed = dict((k, data[k]) for k in self.dirty_keys if k in data)
+            deleted = self.dirty_keys.difference(data)
+            write = (None, changed, deleted)
+        operation = 'update' if write[0] is None else 'write'
+        if writer is None:
+            self.call_backend(operation, apply_write, backend, self.id, write)
+        else:
+            self.call_backend(operation, writer.submit, backend, self.id,
+                              write)
+        self.dirty_keys.clear()
+        self.backend_dirty = False
 
     @property
     def created_time(self):
         return datetime.utcfromtimestamp(self.created_timestamp)
 
+    @property
+    def cookie_data(self):
+        """The client data to be stored in the cookie."""
+        if self.refreshed_timestamp == self.created_timestamp:
+            return self.client_data
+        data = dict(self.client_data)
+        data[REFRESHED_KEY] = self.refreshed_timestamp
+        return data
+
     def __iter__(self):
         self.backend_read()
         return itertools.chain(iter(self.client_data), iter(self.backend_data))
 
     def __len__(self):
+        if self.native_fields and not self.dirty_keys:
+            return (self.call_backend('field_count',
+                                      self.backend.field_count, self.id) +
+                    len(self.client_data))
         self.backend_read()
         return len(self.backend_data) + len(self.client_data)
 
+    def __contains__(self, key):
+        if (key in self.client_data) or (key in self.backend_data):
+            return True
+        if (self.backend is None) or (key in self.dirty_keys):
+            return False
+        if self.native_fields:
+            return self.call_backend('has_field', self.backend.has_field,
+                                     self.id, key)
+        self.backend_read()
+        return key in self.backend_data
+
     def get(self, key, clientside=None):
         if ((clientside is None) and (key in self.client_data)) or clientside:
             return self.client_data[key]
+        elif (key in self.backend_data) or (key in self.dirty_keys):
+            # Either known locally, or deleted locally.
+            return self.backend_data[key]
+        elif self.native_fields:
+            # Fetch just this key, and remember it for later lookups.
+            value = self.call_backend('get_field', self.backend.get_field,
+                                      self.id, key)
+            self.backend_data[key] = value
+            return value
         else:
             self.backend_read()
             return self.backend_data[key]
@@ -306,8 +568,26 @@ class SessionChannel(object):
             self.client_dirty = True
         else:
             self.backend_data[key] = value
+            self.dirty_keys.add(key)
             self.backend_dirty = True
 
+    def discard(self, key, clientside=None):
+        """Remove ``key`` if it is present, without reading the backend.
+
+        If ``clientside`` is True or False, only remove it from the client
+        or server side respectively. If the backend hasn't been read, the
+        key is recorded as deleted so that it is removed when the channel
+        is written.
+        """
+        if (clientside is not False) and (key in self.client_data):
+            del self.client_data[key]
+            self.client_dirty = True
+        if (clientside is not True) and (self.backend is not None):
+            if (not self.backend_loaded) or (key in self.backend_data):
+                self.backend_data.pop(key, None)
+                self.dirty_keys.add(key)
+                self.backend_dirty = True
+
     def delete(self, key):
         if key in self.client_data:
             del self.client_data[key]
@@ -315,6 +595,7 @@ class SessionChannel(object):
         else:
             self.backend_read()
             del self.backend_data[key]
+            self.dirty_keys.add(key)
             self.backend_dirty = True
 
     def __repr__(self):
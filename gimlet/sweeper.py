@@ -0,0 +1,34 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import argparse
+import logging
+import time
+
+from .backends.sql import SQLBackend
+
+log = logging.getLogger('gimlet.sweeper')
+
+
+def main(argv=None):
+    """Delete expired sessions from a :class:`.backends.sql.SQLBackend`
+    table, either once or continuously."""
+    parser = argparse.ArgumentParser(
+        description='Delete expired gimlet sessions from a SQL database.')
+    parser.add_argument('url', help='SQLAlchemy database URL')
+    parser.add_argument('--table', default='gimlet_channels',
+                        help='session table name (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='rows deleted per transaction '
+                        '(default: %(default)s)')
+    parser.add_argument('--interval', type=float, default=0,
+                        help='keep running, sweeping every INTERVAL seconds')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    backend = SQLBackend(args.url, table_name=args.table)
+    while True:
+        count = backend.sweep(batch_size=args.batch_size)
+        log.info('Deleted %d expired sessions', count)
+        if not args.interval:
+            return count
+        time.sleep(args.interval)
@@ -0,0 +1,85 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import asyncio
+
+from gimlet.asgi import load_session
+
+# Kept out of test_asgi, which has to be importable by older Pythons to be
+# skipped.
+
+loop = asyncio.new_event_loop()
+
+
+def run(coro):
+    return loop.run_until_complete(coro)
+
+
+async def sample_app(scope, receive, send):
+    """An ASGI app which gets and sets session keys, like the WSGI
+    ``SampleApp`` in :mod:`.test_middleware`."""
+    sess = scope['gimlet.session']
+    parts = scope['path'].strip('/').split('/')
+    status = 200
+    if parts[0] == 'set':
+        sess[parts[1]] = parts[2]
+        body = 'ok'
+    elif parts[0] == 'setclient':
+        sess.set(parts[1], parts[2], clientside=True)
+        body = 'ok'
+    elif parts[0] == 'static':
+        body = 'ok'
+    else:
+        await load_session(scope)
+        body = sess.get(parts[1])
+        if body is None:
+            status, body = 404, 'not found'
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': body.encode('utf-8')})
+
+
+def count_reads(backend):
+    """Record the key of every ``get`` on an async ``backend`` in the
+    returned list."""
+    reads = []
+    get = backend.get
+
+    async def counting_get(key):
+        reads.append(key)
+        return await get(key)
+
+    backend.get = counting_get
+    return reads
+
+
+class ASGIClient(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.cookies = {}
+
+    def get(self, path):
+        headers = []
+        if self.cookies:
+            cookie = '; '.join('%s=%s' % item for item in
+                               self.cookies.items())
+            headers.append((b'cookie', cookie.encode('latin-1')))
+        scope = {'type': 'http', 'method': 'GET', 'path': path,
+                 'scheme': 'http', 'headers': headers,
+                 'client': ('127.0.0.1', 1234)}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        run(self.app(scope, receive, send))
+        start, body = messages
+        for name, value in start['headers']:
+            if name == b'set-cookie':
+                cookie = value.decode('latin-1').split(';')[0]
+                name, _, value = cookie.partition('=')
+                self.cookies[name] = value
+        return start['status'], body['body'].decode('utf-8')
@@ -0,0 +1,129 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import sys
+import tempfile
+from unittest import SkipTest, TestCase, skipIf
+
+if sys.version_info < (3, 5):
+    raise SkipTest('ASGI support needs Python 3.5 or later')
+
+from redis.asyncio import BlockingConnectionPool
+from webob import Request
+
+from gimlet.asgi import AsyncSessionMiddleware, SessionSnapshot
+from gimlet.backends.asyncmemory import AsyncMemoryBackend
+from gimlet.backends.asyncredis import AsyncRedisBackend
+from gimlet.backends.sql import SQLBackend
+from gimlet.factories import session_factory_factory
+
+from .asgi_app import ASGIClient, count_reads, run, sample_app
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+else:
+    from gimlet.backends.asyncsql import AsyncSQLBackend
+
+
+class TestAsyncSessionMiddleware(TestCase):
+
+    def setUp(self):
+        self.backend = AsyncMemoryBackend()
+        self.app = AsyncSessionMiddleware(sample_app, 'secret',
+                                          backend=self.backend)
+        self.client = ASGIClient(self.app)
+
+    def test_set_get(self):
+        self.assertEqual(self.client.get('/set/foo/bar'), (200, 'ok'))
+        self.assertEqual(len(self.backend.data), 1)
+        self.assertEqual(self.client.get('/get/foo'), (200, 'bar'))
+
+    def test_missing(self):
+        self.assertEqual(self.client.get('/get/foo')[0], 404)
+        self.assertEqual(self.backend.data, {})
+
+    def test_update(self):
+        self.client.get('/set/foo/bar')
+        self.client.get('/set/baz/quux')
+        self.assertEqual(self.client.get('/get/foo'), (200, 'bar'))
+        self.assertEqual(self.client.get('/get/baz'), (200, 'quux'))
+
+    def test_cookies_shared_with_wsgi(self):
+        self.client.get('/setclient/foo/bar')
+        factory = session_factory_factory('secret')
+        sess = factory(Request.blank('/', cookies=self.client.cookies))
+        self.assertEqual(sess['foo'], 'bar')
+
+    def test_expiry(self):
+        self.backend.ttl = -1
+        self.client.get('/set/foo/bar')
+        self.assertEqual(self.client.get('/get/foo')[0], 404)
+
+    def test_unused_session_not_loaded(self):
+        self.client.get('/set/foo/bar')
+        reads = count_reads(self.backend)
+        self.assertEqual(self.client.get('/static/app.css'), (200, 'ok'))
+        self.assertEqual(reads, [])
+        self.assertEqual(self.client.get('/get/foo'), (200, 'bar'))
+        self.assertEqual(len(reads), 2)
+
+    def test_preload(self):
+        self.client.get('/set/foo/bar')
+        app = AsyncSessionMiddleware(sample_app, 'secret',
+                                     backend=self.backend, preload='true')
+        client = ASGIClient(app)
+        client.cookies = self.client.cookies
+        self.assertEqual(client.get('/get/foo'), (200, 'bar'))
+
+    def test_read_before_load(self):
+        snapshot = SessionSnapshot(self.backend)
+        with self.assertRaises(RuntimeError):
+            snapshot[b'foo']
+        run(snapshot.load([b'foo']))
+        with self.assertRaises(KeyError):
+            snapshot[b'foo']
+
+
+class TestAsyncRedisBackend(TestCase):
+
+    def test_pool_from_settings(self):
+        backend = AsyncRedisBackend(max_connections='5', pool_timeout='2',
+                                    socket_timeout='1.5')
+        pool = backend.client.connection_pool
+        self.assertIsInstance(pool, BlockingConnectionPool)
+        self.assertEqual(pool.max_connections, 5)
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 1.5)
+
+
+@skipIf(aiosqlite is None, 'aiosqlite is not installed')
+class TestAsyncSQLBackend(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.backend = AsyncSQLBackend(
+            url='sqlite+aiosqlite:///' + self.path, ttl=60)
+        self.addCleanup(run, self.backend.engine.dispose())
+
+    def test_getset(self):
+        run(self.backend.set(b'foo', {'a': 1}))
+        self.assertEqual(run(self.backend.get(b'foo')), {'a': 1})
+        run(self.backend.update(b'foo', {'b': 2}, set(['a'])))
+        self.assertEqual(run(self.backend.get(b'foo')), {'b': 2})
+        with self.assertRaises(KeyError):
+            run(self.backend.get(b'missing'))
+
+    def test_shared_with_sync(self):
+        run(self.backend.set(b'foo', {'a': 1}))
+        sync = SQLBackend(url='sqlite:///' + self.path)
+        self.assertEqual(sync[b'foo'], {'a': 1})
+        sync[b'foo'] = {'a': 2}
+        self.assertEqual(run(self.backend.get(b'foo')), {'a': 2})
+
+    def test_sweep(self):
+        self.backend.ttl = -1
+        run(self.backend.set(b'foo', {'a': 1}))
+        self.assertEqual(run(self.backend.sweep()), 1)
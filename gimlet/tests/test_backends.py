@@ -1,11 +1,32 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+import os
+import shutil
 import sys
+import tempfile
+import time
+from binascii import hexlify
+from datetime import datetime, timedelta
 from unittest import TestCase, skipIf
 
-from gimlet.backends.pyredis import RedisBackend
+from pymemcache.client.base import PooledClient
+from pymemcache.client.hash import HashClient
+from pymemcache.test.utils import MockMemcacheClient
+from redis import BlockingConnectionPool, UnixDomainSocketConnection
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from gimlet.backends import base
+from gimlet.backends.base import BaseBackend
+from gimlet.backends.cached import CachedBackend
+from gimlet.backends.local import LocalBackend
+from gimlet.backends.tiered import TieredBackend
+from gimlet.backends.sharded import ShardedBackend
+from gimlet.backends.pyredis import RedisBackend, RedisHashBackend
 from gimlet.backends.sql import SQLBackend
-from gimlet.backends.memcache import MemcacheBackend
+from gimlet.backends.memcache import (MemcacheBackend, PylibmcBackend,
+                                      expire_time, parse_hosts)
+from gimlet import sweeper
 
 PY3 = sys.version_info[0] > 2
 
@@ -32,15 +53,745 @@ class TestBackendClass(TestCase):
             self.backend[b'missing']
 
 
+class DictBackend(BaseBackend):
+
+    def __init__(self, *args, **kw):
+        self.data = {}
+        BaseBackend.__init__(self, *args, **kw)
+
+    def __getitem__(self, key):
+        return self.deserialize(self.data[key])
+
+    def __setitem__(self, key, value):
+        self.data[key] = self.serialize(value)
+
+
+class TestBaseBackendUpdate(TestCase):
+
+    def setUp(self):
+        self.backend = DictBackend()
+
+    def test_update_merges(self):
+        self.backend[b'sess'] = {'a': 1, 'b': 2, 'c': 3}
+        self.backend.update(b'sess', {'a': 10, 'd': 4}, set(['b']))
+        self.assertEqual(self.backend[b'sess'], {'a': 10, 'c': 3, 'd': 4})
+
+    def test_update_missing(self):
+        self.backend.update(b'sess', {'a': 1}, set(['b']))
+        self.assertEqual(self.backend[b'sess'], {'a': 1})
+
+
+class CASDictBackend(DictBackend):
+
+    native_cas = True
+
+    def __init__(self, *args, **kw):
+        self.versions = {}
+        # Called before each compare and set, to simulate other writers.
+        self.interfere = None
+        DictBackend.__init__(self, *args, **kw)
+
+    def get_versioned(self, key):
+        return self[key], self.versions[key]
+
+    def __setitem__(self, key, value):
+        DictBackend.__setitem__(self, key, value)
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def compare_and_set(self, key, value, version):
+        if self.interfere:
+            self.interfere()
+        if self.versions.get(key) != version:
+            return False
+        self[key] = value
+        return True
+
+
+class TestCASUpdate(TestCase):
+
+    def setUp(self):
+        self.backend = CASDictBackend()
+        self.backend[b'sess'] = {'a': 1, 'b': 2}
+
+    def test_retries_conflicts(self):
+        writes = []
+
+        def interfere():
+            if not writes:
+                writes.append(1)
+                self.backend[b'sess'] = {'a': 1, 'b': 2, 'c': 3}
+
+        self.backend.interfere = interfere
+        self.backend.update(b'sess', {'a': 10}, set(['b']))
+        self.assertEqual(self.backend[b'sess'], {'a': 10, 'c': 3})
+        self.assertEqual(self.backend.versions[b'sess'], 3)
+
+    def test_missing(self):
+        self.backend.update(b'new', {'a': 1}, set())
+        self.assertEqual(self.backend[b'new'], {'a': 1})
+
+    def test_gives_up(self):
+        def interfere():
+            self.backend[b'sess'] = {'z': 0}
+
+        self.backend.interfere = interfere
+        self.backend.update(b'sess', {'a': 10}, set())
+        self.assertEqual(self.backend[b'sess'], {'z': 0, 'a': 10})
+        self.assertEqual(self.backend.versions[b'sess'],
+                         2 + base.CAS_ATTEMPTS)
+
+
+class VersionedDictBackend(DictBackend):
+
+    native_version = True
+
+    def __init__(self, *args, **kw):
+        self.versions = {}
+        DictBackend.__init__(self, *args, **kw)
+
+    def __setitem__(self, key, value):
+        DictBackend.__setitem__(self, key, value)
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def set_versioned(self, key, value):
+        self[key] = value
+        return self.versions[key]
+
+    def version(self, key):
+        return self.versions.get(key)
+
+
+class TestCachedBackend(TestBackendClass):
+    backend_class = CachedBackend
+    backend_kwargs = dict(inner=DictBackend(), cache_ttl=60)
+
+
+class TestCachedBackendLRU(TestCase):
+
+    def setUp(self):
+        self.inner = DictBackend()
+        self.backend = CachedBackend(self.inner, max_entries=2, cache_ttl=60)
+
+    def test_hits(self):
+        self.backend[b'a'] = {'x': 1}
+        self.inner.data.clear()
+        self.assertEqual(self.backend[b'a'], {'x': 1})
+        self.assertEqual(self.backend.stats()['hits'], 1)
+
+    def test_copies(self):
+        self.backend[b'a'] = {'x': 1}
+        self.backend[b'a']['x'] = 2
+        self.assertEqual(self.backend[b'a'], {'x': 1})
+
+    def test_evicts_least_recently_used(self):
+        for key in (b'a', b'b', b'c'):
+            self.inner[key] = {'key': key}
+            self.backend[key]
+        self.backend[b'b']
+        self.backend[b'a']
+        stats = self.backend.stats()
+        self.assertEqual(stats['misses'], 4)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(list(self.backend.entries), [b'b', b'a'])
+
+    def test_max_bytes(self):
+        backend = CachedBackend(self.inner, max_bytes=100, cache_ttl=60)
+        backend[b'small'] = {'x': 1}
+        backend[b'big'] = {'x': 'y' * 200}
+        self.assertEqual(list(backend.entries), [b'small'])
+        self.assertLessEqual(backend.stats()['bytes'], 100)
+
+    def test_cache_ttl(self):
+        backend = CachedBackend(self.inner, cache_ttl=-1)
+        backend[b'a'] = {'x': 1}
+        self.inner[b'a'] = {'x': 2}
+        self.assertEqual(backend[b'a'], {'x': 2})
+
+    def test_update(self):
+        self.backend[b'a'] = {'x': 1, 'y': 2}
+        self.backend.update(b'a', {'z': 3}, set(['y']))
+        self.inner.data.clear()
+        self.assertEqual(self.backend[b'a'], {'x': 1, 'z': 3})
+
+    def test_version(self):
+        inner = VersionedDictBackend()
+        backend = CachedBackend(inner)
+        inner[b'a'] = {'x': 1}
+        self.assertEqual(backend[b'a'], {'x': 1})
+        self.assertEqual(backend[b'a'], {'x': 1})
+        inner[b'a'] = {'x': 2}
+        self.assertEqual(backend[b'a'], {'x': 2})
+        self.assertEqual(backend.stats()['hits'], 1)
+
+    def test_set_defaults(self):
+        self.backend.set_defaults(ttl=60, codec='json')
+        self.assertEqual(self.inner.ttl, 60)
+        self.assertEqual(self.inner.codec.name, 'json')
+
+    def test_unversioned_needs_cache_ttl(self):
+        with self.assertRaises(ValueError):
+            CachedBackend(self.inner)
+        with self.assertRaises(ValueError):
+            CachedBackend(MemcacheBackend(client=MockMemcacheClient()))
+
+    def test_sql_writes_from_other_processes(self):
+        inner = SQLBackend(url='sqlite://')
+        first = CachedBackend(inner)
+        second = CachedBackend(inner)
+        first[b'a'] = {'x': 1}
+        self.assertEqual(second[b'a'], {'x': 1})
+        self.assertEqual(second[b'a'], {'x': 1})
+        first[b'a'] = {'x': 2}
+        self.assertEqual(second[b'a'], {'x': 2})
+        first.update(b'a', {'y': 3}, set())
+        self.assertEqual(second[b'a'], {'x': 2, 'y': 3})
+        self.assertEqual(second.stats()['hits'], 1)
+
+    def test_sql_writes_stay_cached(self):
+        inner = SQLBackend(url='sqlite://')
+        backend = CachedBackend(inner)
+        backend[b'a'] = {'x': 1}
+        self.assertEqual(backend[b'a'], {'x': 1})
+        backend.update(b'a', {'y': 2}, set())
+        self.assertEqual(backend[b'a'], {'x': 1, 'y': 2})
+        self.assertEqual(backend.stats()['hits'], 2)
+        self.assertEqual(inner[b'a'], {'x': 1, 'y': 2})
+
+    def test_update_after_write_elsewhere(self):
+        inner = SQLBackend(url='sqlite://')
+        backend = CachedBackend(inner)
+        backend[b'a'] = {'x': 1}
+        inner[b'a'] = {'x': 2}
+        backend.update(b'a', {'y': 3}, set())
+        self.assertEqual(backend[b'a'], {'x': 2, 'y': 3})
+
+    def test_compare_and_set(self):
+        inner = SQLBackend(url='sqlite://')
+        backend = CachedBackend(inner)
+        self.assertTrue(backend.native_cas)
+        inner[b'a'] = {'x': 1}
+        value, version = backend.get_versioned(b'a')
+        self.assertEqual(backend.get_versioned(b'a'), (value, version))
+        version = backend.compare_and_set(b'a', {'x': 2}, version)
+        self.assertTrue(version)
+        self.assertEqual(backend.get_versioned(b'a'), ({'x': 2}, version))
+        inner[b'a'] = {'x': 3}
+        self.assertFalse(backend.compare_and_set(b'a', {'x': 4}, version))
+        self.assertEqual(backend[b'a'], {'x': 3})
+        self.assertEqual(backend.stats()['hits'], 2)
+
+    def test_skip_version_checks(self):
+        with self.assertRaises(ValueError):
+            CachedBackend(VersionedDictBackend(), check_versions='false')
+        inner = VersionedDictBackend()
+        backend = CachedBackend(inner, check_versions='false', cache_ttl=60)
+        backend[b'a'] = {'x': 1}
+        inner.version = None
+        self.assertEqual(backend[b'a'], {'x': 1})
+        self.assertEqual(backend.stats()['hits'], 1)
+
+
+class CountingDictBackend(DictBackend):
+
+    def __init__(self, *args, **kw):
+        self.writes = 0
+        DictBackend.__init__(self, *args, **kw)
+
+    def __setitem__(self, key, value):
+        self.writes += 1
+        DictBackend.__setitem__(self, key, value)
+
+
+class BrokenBackend(DictBackend):
+
+    def __setitem__(self, key, value):
+        raise IOError('backend is down')
+
+
+class TestTieredBackend(TestBackendClass):
+    backend_class = TieredBackend
+    backend_kwargs = dict(fast=DictBackend(), durable=DictBackend())
+
+
+class TestTieredBackendTiers(TestCase):
+
+    def setUp(self):
+        self.fast = DictBackend()
+        self.durable = CountingDictBackend()
+        self.backend = TieredBackend(self.fast, self.durable)
+
+    def test_write_through(self):
+        self.backend[b'a'] = {'x': 1}
+        self.backend.update(b'a', {'y': 2}, set(['x']))
+        self.assertEqual(self.fast[b'a'], {'y': 2})
+        self.assertEqual(self.durable[b'a'], {'y': 2})
+
+    def test_read_populates_fast(self):
+        self.durable[b'a'] = {'x': 1}
+        self.assertEqual(self.backend[b'a'], {'x': 1})
+        self.assertEqual(self.fast[b'a'], {'x': 1})
+
+    def test_update_after_eviction(self):
+        self.backend[b'a'] = {'x': 1, 'y': 2}
+        del self.fast.data[b'a']
+        self.backend.update(b'a', {'z': 3}, set(['x']))
+        self.assertNotIn(b'a', self.fast.data)
+        self.assertEqual(self.backend[b'a'], {'y': 2, 'z': 3})
+        self.assertEqual(self.fast[b'a'], {'y': 2, 'z': 3})
+
+    def test_compare_and_set(self):
+        backend = TieredBackend(self.fast, SQLBackend(url='sqlite://'))
+        self.assertTrue(backend.native_cas)
+        backend[b'a'] = {'x': 1}
+        value, version = backend.get_versioned(b'a')
+        self.assertEqual(value, {'x': 1})
+        backend.durable[b'a'] = {'x': 2}
+        self.assertFalse(backend.compare_and_set(b'a', {'x': 3}, version))
+        value, version = backend.get_versioned(b'a')
+        self.assertTrue(backend.compare_and_set(b'a', {'x': 4}, version))
+        self.assertEqual(self.fast[b'a'], {'x': 4})
+        self.assertEqual(backend.durable[b'a'], {'x': 4})
+
+
+class TestTieredBackendWriteBehind(TestCase):
+
+    def setUp(self):
+        self.fast = DictBackend()
+        self.durable = CountingDictBackend()
+        self.backend = TieredBackend(self.fast, self.durable,
+                                     write_behind='true', flush_interval=60)
+        self.addCleanup(self.backend.close)
+
+    def test_update_after_eviction(self):
+        self.backend[b'a'] = {'x': 1, 'y': 2}
+        del self.fast.data[b'a']
+        self.backend.update(b'a', {'z': 3}, set())
+        self.assertNotIn(b'a', self.fast.data)
+        self.assertEqual(self.backend[b'a'], {'x': 1, 'y': 2, 'z': 3})
+
+    def test_queued(self):
+        self.backend[b'a'] = {'x': 1}
+        self.assertEqual(self.fast[b'a'], {'x': 1})
+        self.assertNotIn(b'a', self.durable.data)
+        self.backend.flush()
+        self.assertEqual(self.durable[b'a'], {'x': 1})
+
+    def test_coalesce(self):
+        self.backend[b'a'] = {'x': 1}
+        self.backend.update(b'a', {'y': 2}, set())
+        self.backend.update(b'a', {'z': 3}, set(['x']))
+        self.backend.flush()
+        self.assertEqual(self.durable.writes, 1)
+        self.assertEqual(self.durable[b'a'], {'y': 2, 'z': 3})
+
+    def test_coalesce_updates(self):
+        self.durable[b'a'] = {'x': 1, 'y': 1}
+        self.backend.update(b'a', {'x': 2}, set(['y']))
+        self.backend.update(b'a', {'y': 3}, set(['x']))
+        self.backend.flush()
+        self.assertEqual(self.durable[b'a'], {'y': 3})
+
+    def test_fast_miss_flushes(self):
+        self.backend[b'a'] = {'x': 1}
+        self.fast.data.clear()
+        self.assertEqual(self.backend[b'a'], {'x': 1})
+
+    def test_close(self):
+        self.backend[b'a'] = {'x': 1}
+        self.backend.close()
+        self.assertFalse(self.backend.thread.is_alive())
+        self.assertEqual(self.durable[b'a'], {'x': 1})
+
+    def test_retry(self):
+        self.backend.durable = BrokenBackend()
+        self.backend[b'a'] = {'x': 1}
+        self.backend.flush()
+        self.assertIn(b'a', self.backend.pending)
+        self.backend.durable = self.durable
+        self.backend.flush()
+        self.assertEqual(self.durable[b'a'], {'x': 1})
+
+
 class TestRedisBackend(TestBackendClass):
     backend_class = RedisBackend
 
 
-@skipIf(PY3, "memcached backend is not supported on python 3")
+class TestRedisBackendPool(TestCase):
+
+    def test_pool_from_settings(self):
+        backend = RedisBackend(port='6380', db='2', max_connections='8',
+                               socket_timeout='1.5',
+                               socket_connect_timeout='0.5')
+        pool = backend.client.connection_pool
+        self.assertIsInstance(pool, BlockingConnectionPool)
+        self.assertEqual(pool.max_connections, 8)
+        self.assertEqual(pool.connection_kwargs['port'], 6380)
+        self.assertEqual(pool.connection_kwargs['db'], 2)
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 1.5)
+        self.assertEqual(pool.connection_kwargs['socket_connect_timeout'],
+                         0.5)
+
+    def test_unix_socket(self):
+        backend = RedisBackend(unix_socket_path='/tmp/redis.sock')
+        pool = backend.client.connection_pool
+        self.assertIs(pool.connection_class, UnixDomainSocketConnection)
+        self.assertEqual(pool.connection_kwargs['path'], '/tmp/redis.sock')
+
+    def test_shared_pool(self):
+        first = RedisBackend()
+        second = RedisBackend(connection_pool=first.client.connection_pool)
+        self.assertIs(second.client.connection_pool,
+                      first.client.connection_pool)
+
+
+class TestRedisHashBackend(TestCase):
+
+    def setUp(self):
+        self.backend = RedisHashBackend()
+        self.backend[b'sess'] = {'a': 1, 'b': [2]}
+
+    def test_getset(self):
+        self.assertEqual(self.backend[b'sess'], {'a': 1, 'b': [2]})
+        self.backend[b'sess'] = {'c': 3}
+        self.assertEqual(self.backend[b'sess'], {'c': 3})
+
+    def test_set_empty(self):
+        self.backend[b'sess'] = {}
+        with self.assertRaises(KeyError):
+            self.backend[b'sess']
+
+    def test_missing(self):
+        with self.assertRaises(KeyError):
+            self.backend[b'missing']
+
+    def test_update(self):
+        self.backend.update(b'sess', {'a': 10, 'c': 3}, set(['b']))
+        self.assertEqual(self.backend[b'sess'], {'a': 10, 'c': 3})
+
+    def test_ttl(self):
+        self.backend.ttl = 60
+        key = self.backend.prefixed_key(b'sess')
+        self.backend.update(b'sess', {'a': 2}, set())
+        self.assertGreater(self.backend.client.ttl(key), 0)
+        self.backend.client.persist(key)
+        self.backend.touch(b'sess')
+        self.assertGreater(self.backend.client.ttl(key), 0)
+
+    def test_fields(self):
+        self.assertEqual(self.backend.get_field(b'sess', 'b'), [2])
+        with self.assertRaises(KeyError):
+            self.backend.get_field(b'sess', 'missing')
+        self.assertTrue(self.backend.has_field(b'sess', 'a'))
+        self.assertFalse(self.backend.has_field(b'sess', 'missing'))
+        self.assertEqual(self.backend.field_count(b'sess'), 2)
+        self.assertEqual(self.backend.field_count(b'missing'), 0)
+
+
 class TestMemcacheBackend(TestBackendClass):
     backend_class = MemcacheBackend
 
+    def setUp(self):
+        self.client = MockMemcacheClient()
+        self.backend = MemcacheBackend(client=self.client)
+
+    def test_prefix(self):
+        self.backend[b'sess'] = {'a': 1}
+        self.assertIsNotNone(self.client.get(b'gimlet.sess'))
+        self.assertIsNone(self.client.get(b'sess'))
+
+    def test_ttl(self):
+        self.backend.ttl = 60
+        self.backend[b'sess'] = {'a': 1}
+        self.backend.touch(b'sess')
+        self.assertEqual(self.backend[b'sess'], {'a': 1})
+
+    def test_long_ttl(self):
+        self.assertEqual(expire_time(None), 0)
+        self.assertEqual(expire_time('3600'), 3600)
+        year = 365 * 24 * 60 * 60
+        self.assertGreater(expire_time(year), time.time() + year - 60)
+        self.backend.ttl = year
+        self.backend[b'sess'] = {'a': 1}
+        self.assertEqual(self.backend[b'sess'], {'a': 1})
+
+    def test_parse_hosts(self):
+        self.assertEqual(parse_hosts('a:11212, b'),
+                         [('a', 11212), ('b', 11211)])
+
+    def test_clients(self):
+        backend = MemcacheBackend(hosts='localhost:11211', timeout='0.5')
+        self.assertIsInstance(backend.client, PooledClient)
+        backend = MemcacheBackend(hosts=['a', 'b'], noreply='true')
+        self.assertIsInstance(backend.client, HashClient)
+        self.assertTrue(backend.noreply)
+
+
+class CASMockMemcacheClient(MockMemcacheClient):
+
+    def __init__(self, *args, **kw):
+        self.tokens = {}
+        MockMemcacheClient.__init__(self, *args, **kw)
+
+    def set(self, key, *args, **kw):
+        self.tokens[key] = self.tokens.get(key, 0) + 1
+        return MockMemcacheClient.set(self, key, *args, **kw)
+
+    def gets(self, key):
+        return self.get(key), self.tokens.get(key)
+
+    def cas(self, key, value, cas, expire=0, noreply=False):
+        if self.get(key) is None:
+            return None
+        if self.tokens.get(key) != cas:
+            return False
+        return self.set(key, value, expire, noreply)
+
+
+class TestMemcacheBackendCAS(TestCase):
+
+    def setUp(self):
+        self.backend = MemcacheBackend(client=CASMockMemcacheClient())
+
+    def test_compare_and_set(self):
+        self.assertTrue(self.backend.compare_and_set(b'sess', {'a': 1},
+                                                     None))
+        self.assertFalse(self.backend.compare_and_set(b'sess', {'a': 2},
+                                                      None))
+        value, version = self.backend.get_versioned(b'sess')
+        self.assertEqual(value, {'a': 1})
+        self.assertTrue(self.backend.compare_and_set(b'sess', {'a': 3},
+                                                     version))
+        self.assertFalse(self.backend.compare_and_set(b'sess', {'a': 4},
+                                                      version))
+        self.assertEqual(self.backend[b'sess'], {'a': 3})
+        with self.assertRaises(KeyError):
+            self.backend.get_versioned(b'missing')
+
+
+@skipIf(PY3, "pylibmc is not supported on python 3")
+class TestPylibmcBackend(TestBackendClass):
+    backend_class = PylibmcBackend
+
+
+def expire(backend):
+    with backend.engine.begin() as conn:
+        conn.execute(backend.table.update().values(
+            expires_at=datetime.utcnow() - timedelta(seconds=1)))
+
+
+class TestLocalBackend(TestBackendClass):
+    backend_class = LocalBackend
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'sessions.db')
+        self.backend = LocalBackend(self.path)
+
+    def test_shared_between_instances(self):
+        other = LocalBackend(self.path, synchronous='full')
+        self.backend[b'sess'] = {'a': 1}
+        self.assertEqual(other[b'sess'], {'a': 1})
+        other.update(b'sess', {'b': 2}, set(['a']))
+        self.assertEqual(self.backend[b'sess'], {'b': 2})
+
+    def test_wal(self):
+        mode = self.backend.connection().execute(
+            'PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'wal')
+
+    def test_ttl(self):
+        self.backend.ttl = 60
+        self.backend[b'sess'] = {'a': 1}
+        self.backend.ttl = -1
+        self.backend.touch(b'sess')
+        with self.assertRaises(KeyError):
+            self.backend[b'sess']
+        self.assertEqual(self.backend.sweep(), 1)
+
+    def test_bad_synchronous(self):
+        with self.assertRaises(ValueError):
+            LocalBackend(self.path, synchronous='sometimes')
+
 
 class TestSQLBackend(TestBackendClass):
     backend_class = SQLBackend
     backend_kwargs = dict(url='sqlite://')
+
+
+class TestSQLBackendNoUpsert(TestSQLBackend):
+
+    def setUp(self):
+        TestSQLBackend.setUp(self)
+        self.backend.upsert_stmt = None
+
+
+class TestSQLBackendCAS(TestCase):
+
+    def setUp(self):
+        self.backend = SQLBackend(url='sqlite://', ttl=60)
+
+    def test_compare_and_set(self):
+        backend = self.backend
+        self.assertTrue(backend.compare_and_set(b'sess', {'a': 1}, None))
+        self.assertFalse(backend.compare_and_set(b'sess', {'a': 2}, None))
+        value, version = backend.get_versioned(b'sess')
+        self.assertEqual(value, {'a': 1})
+        self.assertTrue(backend.compare_and_set(b'sess', {'a': 3}, version))
+        self.assertFalse(backend.compare_and_set(b'sess', {'a': 4}, version))
+        self.assertEqual(backend[b'sess'], {'a': 3})
+
+    def test_update(self):
+        self.backend[b'sess'] = {'a': 1, 'b': 2}
+        self.backend.update(b'sess', {'c': 3}, set(['a']))
+        self.assertEqual(self.backend[b'sess'], {'b': 2, 'c': 3})
+
+    def test_unversioned_row(self):
+        self.backend[b'sess'] = {'a': 1}
+        with self.backend.engine.begin() as conn:
+            conn.execute(self.backend.table.update().values(version=None))
+        value, version = self.backend.get_versioned(b'sess')
+        self.assertEqual(version, 0)
+        self.assertTrue(self.backend.compare_and_set(b'sess', {'a': 2},
+                                                     version))
+
+    def test_replaces_expired(self):
+        self.backend[b'sess'] = {'a': 1}
+        expire(self.backend)
+        with self.assertRaises(KeyError):
+            self.backend.get_versioned(b'sess')
+        self.assertTrue(self.backend.compare_and_set(b'sess', {'a': 2},
+                                                     None))
+        self.assertEqual(self.backend[b'sess'], {'a': 2})
+
+
+class TestSQLBackendPool(TestCase):
+
+    def test_pool_from_settings(self):
+        backend = SQLBackend(url='sqlite:///:memory:', pool_size='3',
+                             max_overflow='2', pool_recycle='60',
+                             poolclass=QueuePool)
+        pool = backend.engine.pool
+        self.assertEqual(pool.size(), 3)
+        self.assertEqual(pool._max_overflow, 2)
+        self.assertEqual(pool._recycle, 60)
+
+    def test_engine(self):
+        engine = create_engine('sqlite://')
+        backend = SQLBackend(engine=engine)
+        self.assertIs(backend.engine, engine)
+        backend[b'foo'] = b'bar'
+        self.assertEqual(backend[b'foo'], b'bar')
+
+
+class TestSQLBackendExpiry(TestCase):
+
+    def setUp(self):
+        self.backend = SQLBackend(url='sqlite://', ttl=60)
+        self.backend[b'foo'] = b'bar'
+
+    def expire(self):
+        expire(self.backend)
+
+    def test_expired(self):
+        self.assertEqual(self.backend[b'foo'], b'bar')
+        self.expire()
+        with self.assertRaises(KeyError):
+            self.backend[b'foo']
+
+    def test_touch(self):
+        self.expire()
+        self.backend.touch(b'foo')
+        self.assertEqual(self.backend[b'foo'], b'bar')
+
+    def test_sweep(self):
+        for ii in range(5):
+            self.backend[('old%d' % ii).encode('ascii')] = b'x'
+        self.expire()
+        self.backend[b'new'] = b'y'
+        self.assertEqual(self.backend.sweep(batch_size=2), 6)
+        self.assertEqual(self.backend[b'new'], b'y')
+        self.assertEqual(self.backend.sweep(), 0)
+
+
+class TestSweeper(TestCase):
+
+    def test_main(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        url = 'sqlite:///' + path
+        backend = SQLBackend(url=url, ttl=60)
+        backend[b'foo'] = b'bar'
+        expire(backend)
+        self.assertEqual(sweeper.main([url, '--batch-size', '10']), 1)
+
+
+class TestShardedBackend(TestBackendClass):
+    backend_class = ShardedBackend
+    backend_kwargs = dict(shards=[DictBackend(), DictBackend()])
+
+
+class TestShardedBackendRing(TestCase):
+
+    def setUp(self):
+        self.shards = dict(a=DictBackend(), b=DictBackend(), c=DictBackend())
+        self.backend = ShardedBackend(self.shards)
+
+    def test_spreads_sessions(self):
+        for ii in range(300):
+            self.backend[hexlify(os.urandom(16))] = {'x': ii}
+        for shard in self.shards.values():
+            self.assertGreater(len(shard.data), 50)
+
+    def test_adding_shard_moves_few(self):
+        keys = [hexlify(os.urandom(16)) for ii in range(1000)]
+        before = [self.backend.names[self.backend.locate(key)]
+                  for key in keys]
+        self.shards['d'] = DictBackend()
+        grown = ShardedBackend(self.shards)
+        after = [grown.names[grown.locate(key)] for key in keys]
+        moved = [old for old, new in zip(before, after) if old != new]
+        self.assertLess(len(moved), 400)
+        self.assertEqual(set(after).difference(before), set(['d']))
+
+    def test_weights(self):
+        backend = ShardedBackend(self.shards, weights=dict(a=3))
+        counts = dict((name, 0) for name in self.shards)
+        for ii in range(1000):
+            counts[backend.names[backend.locate(os.urandom(16))]] += 1
+        self.assertGreater(counts['a'], counts['b'] + counts['c'] - 200)
+
+    def test_shard_hints(self):
+        backend = ShardedBackend(self.shards, shard_hints=True)
+        key = backend.make_session_id()
+        self.assertEqual(len(key), 32)
+        backend[key] = {'x': 1}
+        grown = ShardedBackend(dict(self.shards, z=DictBackend()),
+                               shard_hints=True)
+        self.assertEqual(grown[key], {'x': 1})
+
+    def test_unhinted_ids_readable(self):
+        shards = [CASDictBackend() for ii in range(3)]
+        backend = ShardedBackend(shards, shard_hints=True)
+        key = hexlify(os.urandom(16))
+        self.assertIsNone(backend.hinted_index(key))
+        self.assertIsNone(backend.hinted_index(b'not hex'))
+        # An existing id which happens to look hinted.
+        ShardedBackend(shards)[key] = {'x': 1}
+        ring_index = backend.ring_locate(key)
+        backend.locate = lambda key: (ring_index + 1) % 3
+        self.assertEqual(backend[key], {'x': 1})
+        self.assertEqual(backend.get_versioned(key), ({'x': 1}, None))
+        backend.update(key, {'y': 2}, set())
+        self.assertEqual(backend[key], {'x': 1, 'y': 2})
+
+    def test_settings(self):
+        backend = ShardedBackend('one two', weights='1 2', vnodes='10',
+                                 one='gimlet.tests.test_backends:DictBackend',
+                                 two='gimlet.tests.test_backends:DictBackend',
+                                 **{'two.ttl': 60})
+        self.assertEqual(backend.names, ['one', 'two'])
+        self.assertEqual(len(backend.points), 30)
+        self.assertEqual(backend.shards[1].ttl, 60)
@@ -0,0 +1,20 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from unittest import TestCase
+
+from gimlet.benchmarks.cases import cases
+
+
+class TestBenchmarkCases(TestCase):
+
+    def test_cases_run(self):
+        names = set()
+        for name, setup in cases():
+            if '[large]' in name:
+                continue
+            op = setup()
+            op()
+            op()
+            names.add(name)
+        self.assertIn('middleware.request[small]', names)
+        self.assertIn('backend.sqlite.update[medium]', names)
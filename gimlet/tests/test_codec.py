@@ -0,0 +1,193 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+from binascii import hexlify
+from unittest import TestCase, skipUnless
+
+from six.moves import cPickle as pickle
+from webtest import TestApp
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from gimlet.backends.base import BaseBackend
+from gimlet.codec import (JSONCodec, ZlibCompressor, PickleNotAccepted,
+                          get_codec, get_compressor, encode, decode)
+from gimlet.factories import session_factory_factory
+from gimlet.middleware import SessionMiddleware
+from gimlet.session import SessionChannel
+
+from .test_middleware import SampleApp
+
+
+class TestCodec(TestCase):
+    value = {'user': 'frodo', 'cart': [1, 2, 3], 'ring': None}
+
+    def test_pickle_is_untagged(self):
+        self.assertEqual(encode(self.value), pickle.dumps(self.value))
+
+    def test_json(self):
+        raw = encode(self.value, 'json')
+        self.assertEqual(raw[:1], JSONCodec.tag)
+        self.assertEqual(decode(raw), self.value)
+
+    @skipUnless(msgpack, "msgpack not available")
+    def test_msgpack(self):
+        raw = encode(self.value, 'msgpack')
+        self.assertEqual(decode(raw), self.value)
+
+    def test_legacy_pickle(self):
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            raw = pickle.dumps(self.value, protocol)
+            self.assertEqual(decode(raw), self.value)
+
+    def test_reject_pickle(self):
+        with self.assertRaises(PickleNotAccepted):
+            decode(encode(self.value), accept_pickle=False)
+        with self.assertRaises(PickleNotAccepted):
+            decode(encode(self.value, compressor='zlib', compress_threshold=0),
+                   accept_pickle=False)
+        raw = encode(self.value, 'json')
+        self.assertEqual(decode(raw, accept_pickle=False), self.value)
+
+    def test_get_codec(self):
+        codec = JSONCodec()
+        self.assertIs(get_codec(codec), codec)
+        self.assertIs(get_codec('json'), get_codec('json'))
+        with self.assertRaises(ValueError):
+            get_codec('yaml')
+        with self.assertRaises(ValueError):
+            get_codec(42)
+
+    def test_backend_codec(self):
+        backend = BaseBackend(codec='json')
+        raw = backend.serialize(self.value)
+        self.assertEqual(raw[:1], JSONCodec.tag)
+        self.assertEqual(backend.deserialize(raw), self.value)
+
+    def test_factory_propagates_codec(self):
+        backend = BaseBackend()
+        factory = session_factory_factory('secret', backend=backend,
+                                          codec='json')
+        self.assertIs(backend.codec, get_codec('json'))
+        self.assertIs(factory.serializer.codec, get_codec('json'))
+
+
+class TestCompression(TestCase):
+    value = {'cart': ['widget %d' % ii for ii in range(200)]}
+
+    def assertCompresses(self, compressor):
+        plain = encode(self.value)
+        raw = encode(self.value, compressor=compressor)
+        self.assertEqual(raw[:1], get_compressor(compressor).tag)
+        self.assertLess(len(raw), len(plain))
+        self.assertEqual(decode(raw), self.value)
+
+    def test_zlib(self):
+        self.assertCompresses('zlib')
+
+    @skipUnless(zstandard, "zstandard not available")
+    def test_zstd(self):
+        self.assertCompresses('zstd')
+
+    @skipUnless(lz4, "lz4 not available")
+    def test_lz4(self):
+        self.assertCompresses('lz4')
+
+    def test_with_codec(self):
+        raw = encode(self.value, codec='json', compressor='zlib')
+        self.assertEqual(raw[:1], ZlibCompressor.tag)
+        self.assertEqual(decode(raw), self.value)
+
+    def test_below_threshold(self):
+        raw = encode(self.value, compressor='zlib',
+                     compress_threshold=100000)
+        self.assertEqual(raw, encode(self.value))
+
+    def test_incompressible(self):
+        value = os.urandom(2000)
+        self.assertEqual(encode(value, compressor='zlib',
+                                compress_threshold=0),
+                         encode(value))
+
+    def test_get_compressor(self):
+        with self.assertRaises(ValueError):
+            get_compressor('rar')
+        with self.assertRaises(ValueError):
+            get_compressor(None)
+
+    def test_backend_compressor(self):
+        backend = BaseBackend(compressor='zlib', compress_threshold='10')
+        raw = backend.serialize(self.value)
+        self.assertEqual(raw[:1], ZlibCompressor.tag)
+        self.assertEqual(backend.deserialize(raw), self.value)
+
+    def test_factory_propagates_compressor(self):
+        backend = BaseBackend()
+        factory = session_factory_factory('secret', backend=backend,
+                                          compressor='zlib',
+                                          compress_threshold=10)
+        self.assertIs(backend.compressor, get_compressor('zlib'))
+        self.assertEqual(backend.compress_threshold, 10)
+        self.assertIs(factory.serializer.compressor, get_compressor('zlib'))
+
+    def test_encrypted_cookies_not_compressed(self):
+        key = hexlify(os.urandom(32))
+        channel = SessionChannel(hexlify(os.urandom(16)), 0, None,
+                                 fresh=True,
+                                 client_data={'x': 'a' * 1000})
+        for compress_encrypted, compressed in ((False, False), (True, True)):
+            factory = session_factory_factory(
+                'secret', encryption_key=key, compressor='zlib',
+                compress_encrypted=compress_encrypted)
+            payload = factory.serializer.pack(channel)
+            self.assertEqual(len(payload) < 1000, compressed)
+
+
+class TestCodecRollover(TestCase):
+
+    def test_pickle_cookie_readable_with_json(self):
+        app = TestApp(SessionMiddleware(SampleApp(), 's3krit'))
+        app.get('/set/frodo/baggins?clientside=1')
+
+        # Switch codecs, keeping the cookies from the pickle app.
+        json_app = TestApp(SessionMiddleware(SampleApp(), 's3krit',
+                                             codec='json'))
+        json_app.cookiejar = app.cookiejar
+        resp = json_app.get('/get/frodo')
+        resp.mustcontain('baggins')
+
+        json_app.get('/set/samwise/gamgee?clientside=1')
+        resp = json_app.get('/get/frodo')
+        resp.mustcontain('baggins')
+        resp = json_app.get('/get/samwise')
+        resp.mustcontain('gamgee')
+
+    def test_pickle_cookie_rejected(self):
+        app = TestApp(SessionMiddleware(SampleApp(), 's3krit'))
+        app.get('/set/frodo/baggins?clientside=1')
+
+        strict_app = TestApp(SessionMiddleware(SampleApp(), 's3krit',
+                                               codec='json',
+                                               accept_pickle=False))
+        strict_app.cookiejar = app.cookiejar
+        strict_app.get('/get/frodo', status=404)
+        strict_app.get('/set/samwise/gamgee?clientside=1')
+        resp = strict_app.get('/get/samwise')
+        resp.mustcontain('gamgee')
+
+    def test_reject_pickle_needs_codec(self):
+        with self.assertRaises(ValueError):
+            session_factory_factory('secret', accept_pickle=False)
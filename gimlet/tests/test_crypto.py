@@ -4,6 +4,7 @@ import os
 import binascii
 from unittest import TestCase, skipUnless
 
+from itsdangerous import base64_decode, base64_encode
 from webtest import TestApp
 
 try:
@@ -13,6 +14,14 @@ except ImportError:
 else:
     encryption_available = AES
 
+try:
+    import cryptography
+except ImportError:
+    aead_available = False
+else:
+    aead_available = cryptography
+
+from gimlet.crypto import AEADCrypter, DecryptionError
 from gimlet.middleware import SessionMiddleware
 
 from .test_middleware import SampleApp
@@ -52,3 +61,89 @@ class TestEncryptedSession(TestCase):
         with self.assertRaises(ValueError):
             SessionMiddleware(self.inner_app, 's3krit',
                               encryption_key=('s' * 64))
+
+
+@skipUnless(aead_available, "cryptography not available")
+class TestAEADCrypter(TestCase):
+
+    def setUp(self):
+        self.key = binascii.hexlify(os.urandom(32))
+
+    def test_roundtrip(self):
+        for cipher in ('aes-gcm', 'chacha20-poly1305'):
+            crypter = AEADCrypter(self.key, cipher)
+            cleartext = b'payload ending in NUL\0\0'
+            self.assertEqual(crypter.decrypt(crypter.encrypt(cleartext)),
+                             cleartext)
+
+    def test_reads_either_cipher(self):
+        ciphertext = AEADCrypter(self.key, 'chacha20-poly1305').encrypt(b'x')
+        self.assertEqual(AEADCrypter(self.key).decrypt(ciphertext), b'x')
+
+    def test_tampered(self):
+        crypter = AEADCrypter(self.key)
+        ciphertext = bytearray(crypter.encrypt(b'secret'))
+        ciphertext[-1] ^= 1
+        with self.assertRaises(DecryptionError):
+            crypter.decrypt(bytes(ciphertext))
+
+    def test_truncated(self):
+        crypter = AEADCrypter(self.key)
+        ciphertext = crypter.encrypt(b'secret')
+        for length in (0, 5, 9, 17, 20, len(ciphertext) - 1):
+            with self.assertRaises(DecryptionError):
+                crypter.decrypt(ciphertext[:length])
+
+    def test_rotation(self):
+        new_key = binascii.hexlify(os.urandom(32))
+        ciphertext = AEADCrypter(self.key).encrypt(b'x')
+        rotated = AEADCrypter([new_key, self.key])
+        self.assertEqual(rotated.decrypt(ciphertext), b'x')
+        with self.assertRaises(DecryptionError):
+            AEADCrypter(new_key).decrypt(ciphertext)
+
+    def test_chacha_key_length(self):
+        with self.assertRaises(ValueError):
+            AEADCrypter(binascii.hexlify(os.urandom(16)), 'chacha20-poly1305')
+
+
+@skipUnless(aead_available, "cryptography not available")
+class TestAEADSession(TestCase):
+
+    def setUp(self):
+        self.key = binascii.hexlify(os.urandom(32))
+
+    def make_app(self, **kwargs):
+        return TestApp(SessionMiddleware(inner_app, 's3krit',
+                                         encryption_key=self.key, **kwargs))
+
+    def test_getset_basic(self):
+        app = self.make_app(cipher='aes-gcm')
+        app.get('/set/foo/bar')
+        self.assertTrue(app.cookies['gimlet-n'].startswith('~'))
+        resp = app.get('/get/foo')
+        resp.mustcontain('bar')
+
+    def test_bad_cookie(self):
+        app = self.make_app(cipher='aes-gcm')
+        app.get('/set/foo/bar')
+        app.set_cookie('gimlet-n', '~' + 'A' * 60)
+        app.get('/get/foo', status=404)
+
+    def test_truncated_cookie(self):
+        app = self.make_app(cipher='aes-gcm')
+        app.get('/set/foo/bar')
+        envelope = base64_decode(app.cookies['gimlet-n'][1:])
+        for length in (5, 9, 20):
+            truncated = base64_encode(envelope[:length]).decode('ascii')
+            app.set_cookie('gimlet-n', '~' + truncated)
+            app.get('/get/foo', status=404)
+
+    @skipUnless(encryption_available, "pycrypto not available")
+    def test_reads_ecb_cookies(self):
+        app = self.make_app()
+        app.get('/set/foo/bar')
+        migrated = self.make_app(cipher='aes-gcm')
+        migrated.set_cookie('gimlet-n', app.cookies['gimlet-n'])
+        resp = migrated.get('/get/foo')
+        resp.mustcontain('bar')
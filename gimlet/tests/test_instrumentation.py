@@ -0,0 +1,124 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from unittest import TestCase
+
+from webob import Request, Response
+
+from gimlet.backends.cached import CachedBackend
+from gimlet.factories import session_factory_factory
+from gimlet.instrumentation import Observer, StatsdObserver
+
+from .test_backends import DictBackend
+from .test_session import RecordingBackend, make_session
+
+
+class RecordingObserver(Observer):
+
+    def __init__(self):
+        self.events = []
+
+    def backend_call(self, backend, operation, seconds):
+        self.events.append(('backend_call', operation))
+
+    def payload(self, backend, operation, size):
+        self.events.append(('payload', operation))
+
+    def cookie(self, name, size):
+        self.events.append(('cookie', name))
+
+    def bad_signature(self, name):
+        self.events.append(('bad_signature', name))
+
+    def cache(self, backend, hit):
+        self.events.append(('cache', hit))
+
+    def request(self, backend_calls):
+        self.events.append(('request', backend_calls))
+
+
+class FakeStatsClient(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def timing(self, stat, value):
+        self.sent.append(('timing', stat))
+
+    def incr(self, stat):
+        self.sent.append(('incr', stat))
+
+
+class TestObserver(TestCase):
+
+    def setUp(self):
+        self.observer = RecordingObserver()
+
+    def test_backend_calls(self):
+        backend = RecordingBackend(native_update=True)
+        sess = make_session(backend, observer=self.observer)
+        backend.data[sess.channels['nonperm'].id] = {'a': 1}
+        self.assertEqual(sess['a'], 1)
+        sess['b'] = 2
+        sess.write_callback(sess.request, Response())
+        events = self.observer.events
+        calls = [event for event in events if event[0] == 'backend_call']
+        self.assertIn(('backend_call', 'read'), calls)
+        self.assertEqual(events[-1], ('request', len(calls)))
+
+    def test_clientside_request(self):
+        sess = make_session(observer=self.observer)
+        sess['a'] = 1
+        sess.write_callback(sess.request, Response())
+        self.assertEqual(self.observer.events[-2:],
+                         [('cookie', 'gimlet-n'), ('request', 0)])
+
+    def test_unused_session_not_reported(self):
+        sess = make_session(RecordingBackend(), observer=self.observer)
+        sess.write_callback(sess.request, Response())
+        self.assertEqual(self.observer.events, [])
+
+    def test_bad_signature(self):
+        factory = session_factory_factory('secret', observer=self.observer)
+        request = Request.blank('/', cookies={'gimlet-n': 'garbage'})
+        sess = factory(request)
+        self.assertNotIn('a', sess)
+        self.assertIn(('bad_signature', 'gimlet-n'), self.observer.events)
+
+    def test_backend_payloads(self):
+        backend = DictBackend()
+        backend.set_defaults(observer=self.observer)
+        backend[b'a'] = {'x': 1}
+        self.assertEqual(backend[b'a'], {'x': 1})
+        self.assertEqual(self.observer.events,
+                         [('payload', 'write'), ('payload', 'read')])
+
+    def test_cache_hits(self):
+        backend = CachedBackend(DictBackend(), max_bytes=1000,
+                                cache_ttl=60)
+        backend.set_defaults(observer=self.observer)
+        backend[b'a'] = {'x': 1}
+        backend[b'a']
+        self.assertEqual(self.observer.events,
+                         [('payload', 'write'), ('cache', True)])
+
+    def test_backend_keeps_own_observer(self):
+        own = RecordingObserver()
+        backend = DictBackend()
+        backend.set_defaults(observer=own)
+        backend.set_defaults(observer=self.observer)
+        self.assertIs(backend.observer, own)
+
+
+class TestStatsdObserver(TestCase):
+
+    def test_stats(self):
+        client = FakeStatsClient()
+        observer = StatsdObserver(client)
+        observer.backend_call(DictBackend(), 'read', 0.002)
+        observer.cookie('gimlet-p', 120)
+        observer.request(0)
+        self.assertEqual(client.sent, [
+            ('timing', 'gimlet.backend.DictBackend.read'),
+            ('timing', 'gimlet.cookie.gimlet-p'),
+            ('incr', 'gimlet.requests.no_backend'),
+        ])
@@ -1,5 +1,7 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+import os
+from binascii import hexlify
 from datetime import datetime, timedelta
 from unittest import TestCase
 
@@ -298,3 +300,38 @@ class TestNoBackend(TestCase):
     def test_bad_middleware_config(self):
         with self.assertRaises(ValueError):
             SessionMiddleware(inner_app, 's3krit', clientside=False)
+
+
+class TestChunkedCookies(TestCase):
+
+    def setUp(self):
+        wrapped_app = SessionMiddleware(inner_app, 's3krit',
+                                        cookie_chunk_size=200)
+        self.app = TestApp(wrapped_app)
+        # Random, so that it doesn't compress.
+        self.value = hexlify(os.urandom(250)).decode('ascii')
+
+    def test_chunks(self):
+        self.app.get('/set/foo/' + self.value)
+        self.assertNotIn('gimlet-n', self.app.cookies)
+        self.assertIn('gimlet-n.2', self.app.cookies)
+        resp = self.app.get('/get/foo')
+        resp.mustcontain(self.value)
+
+    def test_shrink_removes_chunks(self):
+        self.app.get('/set/foo/' + self.value)
+        self.app.get('/set/foo/bar')
+        self.assertIn('gimlet-n', self.app.cookies)
+        self.assertNotIn('gimlet-n.0', self.app.cookies)
+        self.assertNotIn('gimlet-n.1', self.app.cookies)
+        resp = self.app.get('/get/foo')
+        resp.mustcontain('bar')
+
+    def test_missing_chunk(self):
+        self.app.get('/set/foo/' + self.value)
+        cookies = self.app.cookies
+        del cookies['gimlet-n.1']
+        self.app.reset()
+        for name, value in cookies.items():
+            self.app.set_cookie(name, value)
+        self.app.get('/get/foo', status=404)
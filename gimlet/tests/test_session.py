@@ -1,12 +1,95 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+import os
+import time
+from binascii import hexlify
 from unittest import TestCase
 
 from webob import Request, Response
 
 import webtest
 
+from gimlet.backends.base import BaseBackend, merge_update
+from gimlet.backends.cached import CachedBackend
+from gimlet.backends.sql import SQLBackend
 from gimlet.factories import session_factory_factory
+from gimlet.session import SessionChannel
+
+
+class RecordingBackend(BaseBackend):
+
+    def __init__(self, native_update=False, native_fields=False):
+        self.data = {}
+        self.reads = []
+        self.writes = []
+        self.native_update = native_update
+        self.native_fields = native_fields
+        BaseBackend.__init__(self)
+
+    def __getitem__(self, key):
+        self.reads.append(('get', key))
+        return dict(self.data[key])
+
+    def get_field(self, key, field):
+        self.reads.append(('get_field', key, field))
+        return self.data[key][field]
+
+    def has_field(self, key, field):
+        self.reads.append(('has_field', key, field))
+        return field in self.data.get(key, {})
+
+    def field_count(self, key):
+        self.reads.append(('field_count', key))
+        return len(self.data.get(key, {}))
+
+    def __setitem__(self, key, value):
+        self.writes.append(('set', key, dict(value)))
+        self.data[key] = dict(value)
+
+    def touch(self, key):
+        self.writes.append(('touch', key))
+
+    def update(self, key, changed, deleted):
+        self.writes.append(('update', key, changed, deleted))
+        value = self.data.setdefault(key, {})
+        value.update(changed)
+        for k in deleted:
+            value.pop(k, None)
+
+
+class VersionedBackend(RecordingBackend):
+
+    native_cas = True
+
+    def __init__(self, **kw):
+        self.versions = {}
+        RecordingBackend.__init__(self, **kw)
+
+    def get_versioned(self, key):
+        return self[key], self.versions[key]
+
+    def __setitem__(self, key, value):
+        RecordingBackend.__setitem__(self, key, value)
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def compare_and_set(self, key, value, version):
+        self.writes.append(('cas', key, dict(value), version))
+        if self.versions.get(key) != version:
+            return False
+        self.data[key] = dict(value)
+        self.versions[key] = (version or 0) + 1
+        return True
+
+
+def make_session(backend=None, **options):
+    """Make a session whose channels are read from existing cookies."""
+    factory = session_factory_factory('secret', backend=backend, **options)
+    cookies = {}
+    for name in factory.channel_names.values():
+        channel = SessionChannel(hexlify(os.urandom(16)), int(time.time()),
+                                 None, fresh=True)
+        cookies[name] = factory.serializer.dumps(channel)
+    return factory(Request.blank('/', cookies=cookies))
 
 
 class TestSession(TestCase):
@@ -46,6 +129,21 @@ class TestSession(TestCase):
         sess.flash('xyz', allow_duplicate=False)
         self.assertEqual(sess.peek_flash(), ['xyz'])
 
+    def test_lazy_channels(self):
+        factory = session_factory_factory('secret')
+        cookie = factory.serializer.dumps(
+            SessionChannel(b'a' * 32, 0, None, fresh=True))
+        request = Request.blank('/', cookies={'gimlet-p': cookie})
+        sess = factory(request)
+        resp = Response()
+        sess.write_callback(request, resp)
+        self.assertEqual(sess._channels, {})
+        self.assertNotIn('Set-Cookie', resp.headers)
+
+        sess = factory(request)
+        self.assertEqual(sess.id, b'a' * 32)
+        self.assertEqual(list(sess._channels), ['perm'])
+
     def test_csrf(self):
         sess = self._make_session()
         self.assertNotIn('_csrft_', sess)
@@ -55,6 +153,351 @@ class TestSession(TestCase):
         self.assertEqual(token, sess.get_csrf_token())
 
 
+class TestDirtyTracking(TestCase):
+
+    def _make_session(self, backend):
+        return make_session(backend)
+
+    def test_delta_write(self):
+        backend = RecordingBackend(native_update=True)
+        sess = self._make_session(backend)
+        channel = sess.channels['nonperm']
+        backend.data[channel.id] = {'big': 'x' * 1000, 'old': 1}
+        sess['last_seen'] = 42
+        del sess['old']
+        sess.write_callback(sess.request, Response())
+        self.assertEqual(backend.writes, [
+            ('update', channel.id, {'last_seen': 42}, set(['old'])),
+        ])
+        self.assertEqual(backend.data[channel.id],
+                         {'big': 'x' * 1000, 'last_seen': 42})
+
+    def test_whole_write_when_loaded(self):
+        backend = RecordingBackend()
+        sess = self._make_session(backend)
+        self.assertNotIn('a', sess)
+        sess['a'] = 1
+        sess.write_callback(sess.request, Response())
+        channel = sess.channels['nonperm']
+        self.assertEqual(backend.writes, [('set', channel.id, {'a': 1})])
+
+    def test_save_marks_loaded_keys_dirty(self):
+        backend = RecordingBackend(native_update=True)
+        sess = self._make_session(backend)
+        channel = sess.channels['nonperm']
+        backend.data[channel.id] = {'a': [1]}
+        sess['a'].append(2)
+        sess.save(permanent=False)
+        sess.write_callback(sess.request, Response())
+        self.assertEqual(backend.writes, [
+            ('update', channel.id, {'a': [1, 2]}, set()),
+        ])
+
+    def test_blind_set(self):
+        backend = RecordingBackend(native_update=True)
+        sess = self._make_session(backend)
+        sess.set('a', 1, permanent=True)
+        sess['a'] = 2
+        self.assertEqual(sess['a'], 2)
+        sess.write_callback(sess.request, Response())
+        self.assertEqual(backend.reads, [])
+        self.assertEqual(sorted(backend.writes), sorted([
+            ('update', sess.channels['perm'].id, {}, set(['a'])),
+            ('update', sess.channels['nonperm'].id, {'a': 2}, set()),
+        ]))
+
+    def test_blind_set_whole_write_backend(self):
+        backend = RecordingBackend()
+        sess = self._make_session(backend)
+        perm = sess.channels['perm']
+        backend.data[perm.id] = {'a': 1, 'b': 2}
+        sess['a'] = 2
+        sess.write_callback(sess.request, Response())
+        self.assertEqual(backend.data[perm.id], {'b': 2})
+
+    def test_blind_set_whole_write_backend_reads(self):
+        # Backends storing whole sessions have to read them to apply the
+        # write, but only once each, and only when writing.
+        backend = RecordingBackend()
+        sess = self._make_session(backend)
+        perm = sess.channels['perm']
+        nonperm = sess.channels['nonperm']
+        backend.data[perm.id] = {'b': 2}
+        sess['a'] = 1
+        self.assertEqual(backend.reads, [])
+        backend.update = lambda key, changed, deleted: merge_update(
+            backend, key, changed, deleted)
+        sess.write_callback(sess.request, Response())
+        self.assertEqual(sorted(backend.reads), sorted([
+            ('get', perm.id), ('get', nonperm.id)]))
+        self.assertEqual(backend.writes, [('set', nonperm.id, {'a': 1})])
+
+    def test_set_moves_key_to_backend(self):
+        backend = RecordingBackend(native_update=True)
+        sess = self._make_session(backend)
+        sess.set('a', 1, clientside=True)
+        sess.set('a', 2, clientside=False)
+        channel = sess.channels['nonperm']
+        self.assertEqual(channel.client_data, {})
+        self.assertEqual(channel.backend_data, {'a': 2})
+        self.assertEqual(backend.reads, [])
+
+    def test_fresh_session_not_read(self):
+        backend = RecordingBackend()
+        sess = session_factory_factory('secret', backend=backend)(
+            Request.blank('/'))
+        sess['a'] = 1
+        self.assertEqual(len(sess), 1)
+        sess.write_callback(sess.request, Response())
+        self.assertEqual(backend.reads, [])
+
+    def test_backend_chooses_id(self):
+        backend = RecordingBackend()
+        backend.make_session_id = lambda: b'ab' * 16
+        sess = session_factory_factory('secret', backend=backend)(
+            Request.blank('/'))
+        self.assertEqual(sess.id, b'ab' * 16)
+
+    def test_clean_channel_not_written(self):
+        backend = RecordingBackend(native_update=True)
+        sess = self._make_session(backend)
+        self.assertNotIn('a', sess)
+        sess.write_callback(sess.request, Response())
+        self.assertEqual(backend.writes, [])
+
+
+class TestCompareAndSet(TestCase):
+
+    def setUp(self):
+        self.backend = VersionedBackend()
+        self.sess = make_session(self.backend)
+        self.channel = self.sess.channels['nonperm']
+        self.backend[self.channel.id] = {'a': 1, 'b': 2}
+
+    def test_write_checks_version(self):
+        self.assertEqual(self.sess['a'], 1)
+        self.sess['a'] = 10
+        self.sess.write_callback(self.sess.request, Response())
+        self.assertEqual(self.backend.writes[1:], [
+            ('cas', self.channel.id, {'a': 10, 'b': 2}, 1),
+        ])
+        self.assertEqual(self.backend.data[self.channel.id],
+                         {'a': 10, 'b': 2})
+
+    def test_conflict_reapplies_dirty_keys(self):
+        self.assertEqual(self.sess['a'], 1)
+        self.sess['a'] = 10
+        del self.sess['b']
+        # Another request writes in between.
+        self.backend[self.channel.id] = {'a': 1, 'b': 3, 'c': 4}
+        self.sess.write_callback(self.sess.request, Response())
+        self.assertEqual(self.backend.writes[-1],
+                         ('update', self.channel.id, {'a': 10}, set(['b'])))
+        self.assertEqual(self.backend.data[self.channel.id],
+                         {'a': 10, 'c': 4})
+
+    def test_cached_backend_keeps_concurrent_changes(self):
+        backend = CachedBackend(SQLBackend(url='sqlite://'))
+        first = make_session(backend)
+        second = session_factory_factory('secret', backend=backend)(
+            first.request)
+        id = first.channels['nonperm'].id
+        backend[id] = {'a': 1}
+        self.assertEqual(first['a'], 1)
+        self.assertEqual(second['a'], 1)
+        first['b'] = 2
+        second['c'] = 3
+        first.write_callback(first.request, Response())
+        second.write_callback(second.request, Response())
+        self.assertEqual(backend.inner[id], {'a': 1, 'b': 2, 'c': 3})
+
+    def test_fresh_channel_only_created(self):
+        sess = session_factory_factory('secret', backend=self.backend)(
+            Request.blank('/'))
+        sess['a'] = 1
+        sess.write_callback(sess.request, Response())
+        self.assertEqual(self.backend.writes[-1],
+                         ('cas', sess.channels['nonperm'].id, {'a': 1}, None))
+        self.assertEqual(self.backend.reads, [])
+
+
+class TestFieldAccess(TestCase):
+
+    def setUp(self):
+        self.backend = RecordingBackend(native_update=True,
+                                        native_fields=True)
+        self.channel = make_session(self.backend).channels['nonperm']
+        self.id = self.channel.id
+        self.backend.data[self.id] = {'a': 1, 'b': 2}
+
+    def test_get_fetches_one_field(self):
+        self.assertEqual(self.channel.get('a'), 1)
+        self.assertEqual(self.channel.get('a'), 1)
+        self.assertEqual(self.backend.reads, [('get_field', self.id, 'a')])
+
+    def test_contains_and_len(self):
+        self.assertIn('b', self.channel)
+        self.assertNotIn('z', self.channel)
+        self.assertEqual(len(self.channel), 2)
+        self.assertEqual(self.backend.reads, [
+            ('has_field', self.id, 'b'),
+            ('has_field', self.id, 'z'),
+            ('field_count', self.id),
+        ])
+
+    def test_local_changes_win_over_read(self):
+        self.channel.set('a', 10)
+        self.channel.set('c', 3)
+        self.channel.dirty_keys.add('b')
+        self.channel.backend_data.pop('b', None)
+        self.assertEqual(self.channel.get('a'), 10)
+        with self.assertRaises(KeyError):
+            self.channel.get('b')
+        self.assertEqual(self.backend.reads, [])
+        self.assertEqual(sorted(self.channel), ['a', 'c'])
+
+
+class TestExpiry(TestCase):
+
+    def _make_session(self, backend=None, **options):
+        request = Request.blank('/')
+        factory = session_factory_factory('secret', backend=backend,
+                                          ttl=3600, **options)
+        return factory(request)
+
+    def _age(self, channel, seconds):
+        channel.fresh = False
+        channel.refreshed_timestamp = int(time.time()) - seconds
+
+    def test_ttl_propagates_to_backend(self):
+        backend = RecordingBackend()
+        self._make_session(backend)
+        self.assertEqual(backend.ttl, 3600)
+
+    def test_perm_cookie_max_age(self):
+        sess = self._make_session()
+        sess.channels
+        resp = Response()
+        sess.write_callback(sess.request, resp)
+        cookies = dict(hdr.split('=', 1) for hdr in
+                       resp.headers.getall('Set-Cookie'))
+        self.assertIn('Max-Age=3600', cookies['gimlet-p'])
+
+    def test_refresh_touches_backend(self):
+        backend = RecordingBackend()
+        sess = self._make_session(backend, refresh_interval=60)
+        channel = sess.channels['perm']
+        self._age(channel, 120)
+        self._age(sess.channels['nonperm'], 30)
+        resp = Response()
+        sess.write_callback(sess.request, resp)
+        self.assertEqual(backend.writes, [('touch', channel.id)])
+        self.assertAlmostEqual(channel.refreshed_timestamp, time.time(),
+                               delta=2)
+        names = [hdr.split('=', 1)[0] for hdr in
+                 resp.headers.getall('Set-Cookie')]
+        self.assertEqual(names, ['gimlet-p'])
+
+    def test_refresh_skips_touch_when_writing(self):
+        backend = RecordingBackend()
+        sess = self._make_session(backend, refresh_interval=60)
+        sess.set('a', 1, permanent=True)
+        channel = sess.channels['perm']
+        self._age(channel, 120)
+        sess.write_callback(sess.request, Response())
+        self.assertEqual(backend.writes, [('set', channel.id, {'a': 1})])
+
+    def test_refreshed_timestamp_in_cookie(self):
+        sess = self._make_session(refresh_interval=60)
+        channel = sess.channels['perm']
+        channel.refreshed_timestamp = channel.created_timestamp + 100
+        cookie = sess.serializer.dumps(channel)
+        id, created_timestamp, client_data = sess.serializer.loads(cookie)
+        loaded = SessionChannel(id, created_timestamp, None, fresh=False,
+                                client_data=client_data)
+        self.assertEqual(loaded.refreshed_timestamp,
+                         channel.created_timestamp + 100)
+        self.assertEqual(loaded.client_data, {})
+
+
+class TestSecretRotation(TestCase):
+
+    def _cookies(self, secret, **data):
+        factory = session_factory_factory(secret)
+        channel = SessionChannel(hexlify(os.urandom(16)), int(time.time()),
+                                 None, fresh=True, client_data=data)
+        return {'gimlet-n': factory.serializer.dumps(channel)}
+
+    def _make_session(self, secret, cookies):
+        request = Request.blank('/', cookies=cookies)
+        return session_factory_factory(secret)(request)
+
+    def _set_cookies(self, sess):
+        resp = Response()
+        sess.write_callback(sess.request, resp)
+        return dict(hdr.split(';', 1)[0].split('=', 1) for hdr in
+                    resp.headers.getall('Set-Cookie'))
+
+    def test_old_secret_verifies(self):
+        cookies = self._cookies('old', a=1)
+        sess = self._make_session(['new', 'old'], cookies)
+        self.assertEqual(sess.get('a', permanent=False), 1)
+        # Unchanged cookies aren't re-signed.
+        self.assertNotIn('gimlet-n', self._set_cookies(sess))
+
+    def test_resigned_when_written(self):
+        cookies = self._cookies('old', a=1)
+        sess = self._make_session(['new', 'old'], cookies)
+        sess.set('b', 2, clientside=True)
+        cookies = self._set_cookies(sess)
+        sess = self._make_session(['new'], cookies)
+        self.assertEqual(sess.get('a', permanent=False), 1)
+        self.assertEqual(sess.get('b', permanent=False), 2)
+
+    def test_unknown_secret(self):
+        cookies = self._cookies('old', a=1)
+        sess = self._make_session('new', cookies)
+        self.assertNotIn('a', sess)
+
+    def test_unprefixed_cookie(self):
+        cookies = self._cookies('old', a=1)
+        key_id, _, signed = cookies['gimlet-n'].partition('!')
+        sess = self._make_session(['new', 'old'], {'gimlet-n': signed})
+        self.assertEqual(sess.get('a', permanent=False), 1)
+
+
+class TestUnchangedCookies(TestCase):
+
+    def _make_session(self, **data):
+        factory = session_factory_factory('secret')
+        channel = SessionChannel(hexlify(os.urandom(16)), int(time.time()),
+                                 None, fresh=True, client_data=data)
+        cookies = {'gimlet-n': factory.serializer.dumps(channel)}
+        return factory(Request.blank('/', cookies=cookies))
+
+    def _set_cookie_names(self, sess):
+        resp = Response()
+        sess.write_callback(sess.request, resp)
+        return [hdr.split('=', 1)[0] for hdr in
+                resp.headers.getall('Set-Cookie')]
+
+    def test_save_unchanged(self):
+        sess = self._make_session(a=[1])
+        sess.save(permanent=False, clientside=True)
+        self.assertNotIn('gimlet-n', self._set_cookie_names(sess))
+
+    def test_set_same_value(self):
+        sess = self._make_session(a=1)
+        sess.set('a', 1, clientside=True)
+        self.assertNotIn('gimlet-n', self._set_cookie_names(sess))
+
+    def test_save_mutated(self):
+        sess = self._make_session(a=[1])
+        sess['a'].append(2)
+        sess.save(permanent=False, clientside=True)
+        self.assertIn('gimlet-n', self._set_cookie_names(sess))
+
+
 class TestRequest(webtest.TestRequest):
 
     @property
@@ -152,8 +595,9 @@ class TestSession_Functional(TestCase):
         self.app.get('/mangle_cookie')
         mangled_cookie = self.app.cookies['gimlet-p']
         self.assertEqual(mangled_cookie, orig_cookie.lower())
-        # Next request should succeed and then set a new cookie
-        self.app.get('/get')
+        # Next request which uses the session should succeed and then set a
+        # new cookie
+        self.app.get('/set')
         self.assertIn('gimlet-p', self.app.cookies)
         self.assertNotEqual(self.app.cookies['gimlet-p'], orig_cookie)
         self.assertNotEqual(self.app.cookies['gimlet-p'], mangled_cookie)
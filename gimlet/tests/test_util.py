@@ -2,6 +2,8 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 from unittest import TestCase
 
+from gimlet.backends.cached import CachedBackend
+from gimlet.backends.pyredis import RedisHashBackend
 from gimlet.backends.sql import SQLBackend
 from gimlet.util import asbool, parse_settings
 
@@ -22,13 +24,24 @@ class TestUtil(TestCase):
             'gimlet.backend.url': 'sqlite:///:memory:',
             'gimlet.secret': 'super-secret',
             'gimlet.permanent': 'true',
+            'gimlet.ttl': '3600',
             'non-gimlet-setting': None,
         }
         options = parse_settings(settings)
         self.assertNotIn('non-gimlet-setting', options)
         self.assertEqual(options['permanent'], True)
+        self.assertEqual(options['ttl'], 3600)
         self.assertIsInstance(options['backend'], SQLBackend)
 
+    def test_parse_settings_lists(self):
+        settings = {
+            'secret': '\n  new secret\n  old secret\n',
+            'encryption_key': 'aa' * 32 + ' ' + 'bb' * 32,
+        }
+        options = parse_settings(settings, prefix='')
+        self.assertEqual(options['secret'], ['new secret', 'old secret'])
+        self.assertEqual(options['encryption_key'], ['aa' * 32, 'bb' * 32])
+
     def test_parse_settings_absolute_backend(self):
         settings = {
             'backend': 'gimlet.backends.sql',
@@ -38,6 +51,38 @@ class TestUtil(TestCase):
         options = parse_settings(settings, prefix='')
         self.assertIsInstance(options['backend'], SQLBackend)
 
+    def test_parse_settings_backend_class(self):
+        settings = {
+            'backend': 'pyredis:RedisHashBackend',
+            'secret': 'super-secret',
+        }
+        options = parse_settings(settings, prefix='')
+        self.assertIsInstance(options['backend'], RedisHashBackend)
+
+    def test_parse_settings_nested_backend(self):
+        settings = {
+            'backend': 'cached',
+            'backend.max_entries': '10',
+            'backend.inner': 'sql',
+            'backend.inner.url': 'sqlite://',
+            'secret': 'super-secret',
+        }
+        options = parse_settings(settings, prefix='')
+        backend = options['backend']
+        self.assertIsInstance(backend, CachedBackend)
+        self.assertEqual(backend.max_entries, 10)
+        self.assertIsInstance(backend.inner, SQLBackend)
+
+    def test_parse_settings_backend_prefix(self):
+        settings = {
+            'backend': 'memcache',
+            'backend.prefix': 'myapp.',
+            'secret': 'super-secret',
+        }
+        options = parse_settings(settings, prefix='')
+        backend = options['backend']
+        self.assertEqual(backend.prefixed_key(b'abc'), b'myapp.abc')
+
     def test_parse_settings_None_backend(self):
         settings = {
             'backend': None,
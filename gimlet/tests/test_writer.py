@@ -0,0 +1,124 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from threading import Event, Timer
+from unittest import TestCase
+
+from webob import Request, Response
+
+from gimlet.writer import BackgroundWriter, coalesce
+
+from .test_session import RecordingBackend, make_session
+
+
+class BlockingBackend(RecordingBackend):
+
+    """Blocks every write until :attr:`proceed` is set."""
+
+    def __init__(self, *args, **kw):
+        self.started = Event()
+        self.proceed = Event()
+        RecordingBackend.__init__(self, *args, **kw)
+
+    def __setitem__(self, key, value):
+        self.started.set()
+        self.proceed.wait()
+        RecordingBackend.__setitem__(self, key, value)
+
+    def update(self, key, changed, deleted):
+        self.started.set()
+        self.proceed.wait()
+        RecordingBackend.update(self, key, changed, deleted)
+
+
+class TestCoalesce(TestCase):
+
+    def test_set_replaces(self):
+        self.assertEqual(coalesce((None, {'a': 1}, set()), ({'b': 2}, None,
+                                                            None)),
+                         ({'b': 2}, None, None))
+
+    def test_update_applies_to_set(self):
+        self.assertEqual(coalesce(({'a': 1, 'b': 2}, None, None),
+                                  (None, {'c': 3}, set(['a']))),
+                         ({'b': 2, 'c': 3}, None, None))
+
+    def test_updates_merge(self):
+        self.assertEqual(coalesce((None, {'a': 1}, set(['b'])),
+                                  (None, {'b': 2}, set(['a']))),
+                         (None, {'b': 2}, set(['a'])))
+
+
+class TestBackgroundWriter(TestCase):
+
+    def setUp(self):
+        self.writer = BackgroundWriter(max_pending=2, timeout=0)
+        self.addCleanup(self.writer.close)
+
+    def test_write(self):
+        backend = RecordingBackend()
+        self.writer.submit(backend, b'a', ({'x': 1}, None, None))
+        self.writer.flush()
+        self.assertEqual(backend.data[b'a'], {'x': 1})
+
+    def test_coalesce_while_busy(self):
+        backend = BlockingBackend()
+        self.writer.submit(backend, b'a', ({'x': 1}, None, None))
+        backend.started.wait()
+        # The first write is in flight, so these are combined, and not
+        # started until it finishes.
+        self.writer.submit(backend, b'a', ({'x': 2}, None, None))
+        self.writer.submit(backend, b'a', (None, {'y': 3}, set()))
+        backend.proceed.set()
+        self.writer.flush()
+        self.assertEqual(backend.writes, [
+            ('set', b'a', {'x': 1}),
+            ('set', b'a', {'x': 2, 'y': 3}),
+        ])
+
+    def test_queue_full(self):
+        backend = BlockingBackend()
+        other = RecordingBackend()
+        self.writer.submit(backend, b'a', ({'x': 1}, None, None))
+        backend.started.wait()
+        self.writer.submit(backend, b'b', ({'x': 1}, None, None))
+        self.writer.submit(backend, b'c', ({'x': 1}, None, None))
+        # No room left, so this is written right away.
+        self.writer.submit(other, b'd', ({'x': 1}, None, None))
+        self.assertEqual(other.data[b'd'], {'x': 1})
+        backend.proceed.set()
+        self.writer.flush()
+        self.assertEqual(sorted(backend.data), [b'a', b'b', b'c'])
+
+    def test_close(self):
+        backend = RecordingBackend()
+        self.writer.submit(backend, b'a', ({'x': 1}, None, None))
+        self.writer.close()
+        self.assertEqual(backend.data[b'a'], {'x': 1})
+        self.writer.submit(backend, b'b', ({'x': 1}, None, None))
+        self.assertEqual(backend.data[b'b'], {'x': 1})
+
+
+class TestBackgroundWrites(TestCase):
+
+    def test_write_callback(self):
+        backend = BlockingBackend()
+        sess = make_session(backend, background_writes=True)
+        self.addCleanup(sess.writer.close)
+        sess['a'] = 1
+        sess.write_callback(sess.request, Response())
+        backend.started.wait()
+        self.assertEqual(backend.data, {})
+        backend.proceed.set()
+        sess.writer.flush()
+        self.assertEqual(backend.data[sess.channel('nonperm').id], {'a': 1})
+
+    def test_read_waits_for_queued_write(self):
+        backend = BlockingBackend()
+        sess = make_session(backend, background_writes=True)
+        self.addCleanup(sess.writer.close)
+        sess['a'] = 1
+        sess.write_callback(sess.request, Response())
+        backend.started.wait()
+        Timer(0.05, backend.proceed.set).start()
+        later = type(sess)(Request.blank('/', cookies=sess.request.cookies))
+        self.assertEqual(later['a'], 1)
@@ -16,51 +16,92 @@ def parse_settings(settings, prefix='gimlet.'):
     don't start with ``prefix`` will be ignored. As a convenience, some
     of the options in ``settings`` may be specified as strings.
 
-    All of the boolean options can be passed as strings, which will be
-    parsed by :func:`asbool`.
+    All of the boolean and integer options can be passed as strings, which
+    will be parsed by :func:`asbool` and ``int()`` respectively. Several
+    encryption keys can be given as a string separated by whitespace, and
+    several secrets as a string with one per line.
 
     If `backend` is a string, it must be the name of a module containing
     a subclass of :class:`.backends.base.BaseBackend`. If the name
     contains one or more dots, it will be considered absolute;
-    otherwise, it will be considered relative to :mod:`.backends`.
+    otherwise, it will be considered relative to :mod:`.backends`. A
+    specific class can be chosen from a module containing several by
+    naming it after a colon, e.g. ``pyredis:RedisHashBackend``.
 
     """
     options = {}
-    bool_options = ('clientside', 'permanent')
+    bool_options = ('clientside', 'permanent', 'background_writes',
+                    'accept_pickle', 'compress_encrypted')
+    int_options = ('ttl', 'refresh_interval', 'compress_threshold',
+                   'writer_threads', 'writer_queue_size',
+                   'cookie_chunk_size')
+    list_options = ('encryption_key',)
     for k, v in settings.items():
         if k.startswith(prefix):
             k = k[len(prefix):]
             if k in bool_options:
                 v = asbool(v)
+            elif k in int_options and v is not None:
+                v = int(v)
+            elif k in list_options and isinstance(v, six.string_types):
+                v = v.split()
+            elif (k == 'secret' and isinstance(v, six.string_types) and
+                  '\n' in v):
+                v = [line.strip() for line in v.splitlines() if line.strip()]
             options[k] = v
     if 'secret' not in options:
         raise ValueError('secret is required')
-    if 'backend' in options and options['backend'] is not None:
-        backend = options['backend']
-        if isinstance(backend, six.string_types):
-            predicate = lambda m: (
-                isclass(m) and
-                issubclass(m, BaseBackend) and
-                (m is not BaseBackend))
-            module_name = backend
-            if '.' not in module_name:
-                module_name = 'gimlet.backends.' + backend
-            backend_module = import_module(module_name)
-            backend_cls = getmembers(backend_module, predicate)[0][1]
-            options['backend'] = backend_cls
-        backend = options['backend']
-        if not (isclass(backend) and issubclass(backend, BaseBackend)):
-            raise ValueError('backend must be a subclass of BaseBackend')
-    backend_cls = options.get('backend')
-    if backend_cls is not None:
-        backend_options = {}
-        for k in list(options.keys()):
-            if k.startswith('backend.'):
-                backend_options[k[8:]] = options.pop(k)
-        options['backend'] = options['backend'](**backend_options)
+    if options.get('backend') is not None:
+        backend_cls = backend_class(options['backend'])
+        options['backend'] = backend_cls(**pop_options(options, 'backend.'))
     return options
 
 
+def backend_class(backend):
+    """Return the :class:`.backends.base.BaseBackend` subclass named by
+    ``backend``, as described in :func:`parse_settings`."""
+    if isinstance(backend, six.string_types):
+        module_name, _, class_name = backend.partition(':')
+        if '.' not in module_name:
+            module_name = 'gimlet.backends.' + module_name
+        # Only consider backends defined in the module, not imported ones.
+        predicate = lambda m: (
+            isclass(m) and
+            issubclass(m, BaseBackend) and
+            (m.__module__ == module_name))
+        backend_module = import_module(module_name)
+        if class_name:
+            backend = getattr(backend_module, class_name)
+        else:
+            backend = getmembers(backend_module, predicate)[0][1]
+    if not (isclass(backend) and issubclass(backend, BaseBackend)):
+        raise ValueError('backend must be a subclass of BaseBackend')
+    return backend
+
+
+def make_backend(backend, options):
+    """Return a backend instance for ``backend``, which may already be an
+    instance, or a class or name to be instantiated with ``options``.
+
+    This lets backends which wrap other backends be configured with
+    nested settings, e.g. ``backend.inner = pyredis`` and
+    ``backend.inner.host = ...``.
+    """
+    if isinstance(backend, BaseBackend):
+        return backend
+    return backend_class(backend)(**options)
+
+
+def pop_options(options, prefix):
+    """Remove the options starting with ``prefix`` from ``options``, and
+    return them with the prefix stripped."""
+    popped = {}
+    for k in list(options.keys()):
+        if k.startswith(prefix):
+            popped[k[len(prefix):]] = options.pop(k)
+    return popped
+
+
 def asbool(s):
     """Convert value to bool. Copied from pyramid.settings."""
     if s is None:
@@ -0,0 +1,177 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import atexit
+import copy
+import logging
+import os
+import time
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
+
+from .backends.base import BaseBackend, merge_update
+
+log = logging.getLogger('gimlet.writer')
+
+
+def coalesce(old, new):
+    """Combine two pending writes to the same session into one.
+
+    Pending writes are ``(value, changed, deleted)`` tuples, where ``value``
+    is a whole session to store, or None for a partial update.
+    """
+    value, changed, deleted = new
+    if value is not None:
+        return new
+    old_value, old_changed, old_deleted = old
+    if old_value is not None:
+        value = copy.copy(old_value)
+        value.update(changed)
+        for k in deleted:
+            value.pop(k, None)
+        return value, None, None
+    merged = dict((k, v) for k, v in old_changed.items() if k not in deleted)
+    merged.update(changed)
+    return None, merged, (old_deleted - set(changed)) | deleted
+
+
+def apply_write(backend, key, write):
+    """Store a pending write from :func:`coalesce` in ``backend``."""
+    value, changed, deleted = write
+    if value is not None:
+        backend[key] = value
+    elif isinstance(backend, BaseBackend):
+        backend.update(key, changed, deleted)
+    else:
+        merge_update(backend, key, changed, deleted)
+
+
+class BackgroundWriter(object):
+
+    """Write sessions to their backends from a pool of background threads.
+
+    Writes to the same session which are queued at the same time are
+    combined into one, and are never run concurrently or out of order. At
+    most ``max_pending`` sessions are queued: beyond that, callers wait up
+    to ``timeout`` seconds (forever if None) for room, and then write
+    synchronously. Anything still queued is written at interpreter exit,
+    but will be lost if the process dies first.
+
+    Sessions read in this process wait for their own pending writes, but a
+    request served by another process shortly after may see stale data.
+    """
+
+    def __init__(self, threads=1, max_pending=1000, timeout=None):
+        self.threads = int(threads)
+        self.max_pending = int(max_pending)
+        self.timeout = float(timeout) if timeout is not None else None
+        self.errors = 0
+        self.reset()
+        atexit.register(self.close)
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.pending = OrderedDict()
+        self.inflight = set()
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+        self.workers = []
+        self.closed = False
+
+    def start(self):
+        # Called with the lock held.
+        while len(self.workers) < self.threads:
+            worker = Thread(target=self.run, name='gimlet-writer')
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, backend, key, write):
+        """Queue ``write``, as for :func:`apply_write`."""
+        value, changed, deleted = write
+        if value is not None:
+            write = (copy.copy(value), None, None)
+        if self.pid != os.getpid():
+            # Locks and threads don't survive a fork.
+            self.reset()
+        slot = (id(backend), key)
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        with self.lock:
+            while (slot not in self.pending and
+                   len(self.pending) >= self.max_pending and
+                   not self.closed):
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        log.warn('Background writer queue is full, '
+                                 'writing synchronously')
+                        break
+                self.changed.wait(remaining)
+            else:
+                if not self.closed:
+                    if slot in self.pending:
+                        write = coalesce(self.pending.pop(slot)[1], write)
+                    self.pending[slot] = (backend, write)
+                    self.start()
+                    self.changed.notify_all()
+                    return
+        apply_write(backend, key, write)
+
+    def take(self):
+        # Called with the lock held: return the oldest write whose session
+        # isn't already being written.
+        for slot in self.pending:
+            if slot not in self.inflight:
+                self.inflight.add(slot)
+                return slot, self.pending.pop(slot)
+        return None, None
+
+    def run(self):
+        while True:
+            with self.lock:
+                slot, item = self.take()
+                while item is None:
+                    if self.closed:
+                        return
+                    self.changed.wait()
+                    slot, item = self.take()
+            backend, write = item
+            try:
+                apply_write(backend, slot[1], write)
+            except Exception:
+                self.errors += 1
+                log.exception('Background write to %r failed', backend)
+            with self.lock:
+                self.inflight.discard(slot)
+                self.changed.notify_all()
+
+    def wait(self, backend, key):
+        """Wait until nothing is queued or being written for ``key``."""
+        slot = (id(backend), key)
+        with self.lock:
+            while slot in self.pending or slot in self.inflight:
+                self.changed.wait()
+
+    def flush(self):
+        """Wait until everything queued has been written."""
+        with self.lock:
+            while self.pending or self.inflight:
+                self.changed.wait()
+
+    def close(self):
+        """Write everything queued and stop the background threads."""
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            if not self.workers:
+                self.closed = True
+                return
+        self.flush()
+        with self.lock:
+            self.closed = True
+            self.changed.notify_all()
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.join()
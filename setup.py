@@ -7,18 +7,20 @@ PY3 = sys.version_info[0] > 2
 
 requirements = [
     'itsdangerous',
+    'six',
     'webob',
     'redis',
-    'sqlalchemy',
+    'sqlalchemy>=1.4',
     # Required for cookie encryption.
     'pycrypto',
 ]
 
 
-# Python 3 notes:
-# Currently the memcached backend depends on pylibmc, which is not python 3
+# pylibmc, used by the original memcached backend, is not python 3
 # compatible.
-if not PY3:
+if PY3:
+    requirements.append('pymemcache')
+else:
     requirements.append('pylibmc')
 
 
@@ -43,8 +45,21 @@ setup(name="gimlet",
       author='Scott Torborg',
       author_email='scott@cartlogic.com',
       install_requires=requirements,
+      extras_require={
+          'msgpack': ['msgpack'],
+          'zstd': ['zstandard'],
+          'lz4': ['lz4'],
+          'asyncsql': ['sqlalchemy[asyncio]>=1.4'],
+          'bench': ['pyperf'],
+          'aead': ['cryptography'],
+      },
       license='MIT',
       packages=find_packages(),
+      entry_points="""\
+      [console_scripts]
+      gimlet-sweep = gimlet.sweeper:main
+      gimlet-bench = gimlet.benchmarks:main
+      """,
       test_suite='nose.collector',
       tests_require=['nose'],
       zip_safe=False)